@@ -93,19 +93,50 @@ def readHS():
 
 
 ########################################################
+def calcEig(ispin, kpnt, verbose=True):
+    # Sorted eigenvalues at the "unitless" k-point kpnt.
+    # With general.sparse only the general.NumEig eigenvalues closest
+    # to the middle of the energy window are calculated (shift-invert
+    # Lanczos on the sparse H, S), the remaining entries are NaN.
+    HS.setkpoint(kpnt, verbose=verbose, sparse=general.sparse)
+    if not general.sparse:
+        eival = SLA.eigh(HS.H[ispin], HS.S, eigvals_only=True)
+        return N.sort(eival)
+    eival = N.empty((HS.N,), N.float)
+    eival[:] = N.nan
+    nev = min(general.NumEig, HS.N-2)
+    if nev < 1:
+        eival[:] = SLA.eigh(HS.H[ispin].toarray(), HS.S.toarray(), eigvals_only=True)
+        return eival
+    import scipy.sparse.linalg as SSLA
+    ev = SSLA.eigsh(HS.H[ispin].tocsc(), k=nev, M=HS.S.tocsc(), sigma=0.5*(general.eMin+general.eMax),
+                    which='LM', return_eigenvectors=False)
+    eival[:nev] = N.sort(ev.real)
+    return eival
+
+
+def calcEigs(ispin, kpnts):
+    # Sorted eigenvalues for a list of "unitless" k-points, the dense
+    # matrices are assembled for general.kBatch of them at once (HS.setkpoints)
+    if general.sparse:
+        return N.array([calcEig(ispin, kpnt, verbose=False) for kpnt in kpnts])
+    eival = []
+    for ik0 in range(0, len(kpnts), general.kBatch):
+        H, S = HS.setkpoints(kpnts[ik0:ik0+general.kBatch])
+        eival += [N.sort(SLA.eigh(H[ik, ispin], S[ik], eigvals_only=True)) for ik in range(len(S))]
+        del H, S
+    return N.array(eival)
+
+
 def calcFS(ispin):
     # Calculate Fermi-surface
     NNk = 31
     bands = N.zeros((NNk, NNk, NNk, HS.N), N.float)
     for ix in range(NNk):
         for iy in range(NNk):
-            for iz in range(NNk):
-                # "unitless" k-vect
-                kpnt = N.array([ix, iy, iz], N.float)/float(NNk-1)
-                HS.setkpoint(kpnt, verbose=False)
-                eival = SLA.eigh(HS.H[ispin], HS.S, eigvals_only=True)
-                ipiv = N.argsort(eival)
-                bands[ix, iy, iz, :] = eival[ipiv]
+            # "unitless" k-vect
+            kpnts = N.array([[ix, iy, iz] for iz in range(NNk)], N.float)/float(NNk-1)
+            bands[ix, iy, :, :] = calcEigs(ispin, kpnts)
         SIO.printDone(ix, NNk, 'Fermi Surface: ')
     writeFS(ispin, NNk, bands)
 
@@ -170,17 +201,12 @@ def calcBands(ispin):
         korig, kdir = f, t-f
         Nk = general.NNk
 
-        ev = N.zeros((Nk, HS.N), N.float)
+        kpnts = []
         for ii in range(Nk):
             kpnt = korig + kdir*(ii/float(Nk-1))
             # Change to "unitless" k-vect
-            kpnt2 = mm(N.array([geom.sym.a1, geom.sym.a2, geom.sym.a3]), kpnt)
-
-            HS.setkpoint(kpnt2)
-            eival = SLA.eigh(HS.H[ispin], HS.S, eigvals_only=True)
-            ipiv = N.argsort(eival)
-            ev[ii, :] = eival[ipiv]
-        bands += [ev]
+            kpnts.append(mm(N.array([geom.sym.a1, geom.sym.a2, geom.sym.a3]), kpnt))
+        bands += [calcEigs(ispin, kpnts)]
 
     writeBands(ispin, what, bands)
 
@@ -259,6 +285,12 @@ For help use --help!
                   help="min of energy range to plot [%default]")
     EC.add_option("-b", "--max", dest='eMax', default=5.0, type='float',
                   help="max of energy range to plot [%default]")
+    EC.add_option("-s", "--sparse", dest='sparse', default=False, action='store_true',
+                  help="Use sparse H, S and only calculate the eigenvalues closest to the middle of the energy range [%default]")
+    EC.add_option("-n", "--NumEig", dest='NumEig', default=20, type='int',
+                  help="Number of eigenvalues per k-point calculated with --sparse [%default]")
+    EC.add_option("-k", "--kBatch", dest='kBatch', default=64, type='int',
+                  help="Number of k-points for which the dense H, S are assembled at once [%default]")
 
     parser.add_option_group(EC)
 
@@ -109,6 +109,10 @@ def GetOptions(argv):
     # Use spectral matrices?
     p.add_argument('--SpectralCutoff', dest='SpectralCutoff', type=float, default=0.0,
                    help='Cutoff value for SpectralMatrix functions (for ordinary matrix representation set cutoff<=0.0) [default=%(default)s]')
+    p.add_argument('--RGF', dest='RGF', default=False, action='store_true',
+                   help='Use the block-tridiagonal recursive Green\'s function solver instead of inverting the full device matrix [default: %(default)s]')
+    p.add_argument('--HScache', dest='HScache', default=False, action='store_true',
+                   help='Keep the parsed TSHS files in sidecar caches (<file>.cache directories) for a faster startup of subsequent runs [default: %(default)s]')
 
     options = p.parse_args(argv)
 
@@ -140,17 +144,18 @@ def main(options):
     geom = MG.Geom(XV, BufferAtoms=options.buffer)
 
     # Set up device Greens function
-    elecL = NEGF.ElectrodeSelfEnergy(options.fnL, options.NA1L, options.NA2L, options.voltage/2.)
+    elecL = NEGF.ElectrodeSelfEnergy(options.fnL, options.NA1L, options.NA2L, options.voltage/2., TSHScache=options.HScache)
     elecL.scaling = options.scaleSigL
     elecL.semiinf = options.semiinfL
-    elecR = NEGF.ElectrodeSelfEnergy(options.fnR, options.NA1R, options.NA2R, -options.voltage/2.)
+    elecR = NEGF.ElectrodeSelfEnergy(options.fnR, options.NA1R, options.NA2R, -options.voltage/2., TSHScache=options.HScache)
     elecR.scaling = options.scaleSigR
     elecR.semiinf = options.semiinfR
     DevGF = NEGF.GF(options.TSHS, elecL, elecR, Bulk=options.UseBulk,
                     DeviceAtoms=options.DeviceAtoms,
-                    BufferAtoms=options.buffer)
+                    BufferAtoms=options.buffer, TSHScache=options.HScache)
     DevGF.calcGF(options.energy+options.eta*1.0j, options.kpoint[0:2], ispin=options.iSpin,
-                 etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff)
+                 etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff,
+                 RGF=options.RGF)
     NEGF.SavedSig.close() # Make sure saved Sigma is written to file
 
     # Transmission
@@ -15,6 +15,7 @@ Classes
 
    SigDir
    SavedSigClass
+   SigCache
    ElectrodeSelfEnergy
    GF
 
@@ -27,7 +28,11 @@ import hashlib
 import pickle
 import glob
 import os
-import netCDF4 as NC4
+import errno
+import time
+import uuid
+import socket
+import collections
 import Inelastica.misc.valuecheck as VC
 import Inelastica.io.siesta as SIO
 import Inelastica.math as MM
@@ -67,106 +72,309 @@ def myHash(data):
     return hashlib.md5(pickle.dumps(data)).hexdigest()
 
 
-def hash2dec(hash):
-    return [int(ii, 16) for ii in hash]
+def blockPartition(M, nuoL, nuoR):
+    """
+    Partition the orbitals of the (device) matrix M into blocks such that M
+    is block-tridiagonal, with the first nuoL orbitals forming the first block
+    and the last nuoR orbitals contained in the last block.
+    The blocks are the level sets of a breadth-first search on the sparsity
+    graph of M starting from the left electrode orbitals (i.e., a
+    Cuthill-McKee type reordering), hence the orbital ordering of M does not
+    need to follow the transport direction.
+    Levels reaching the right electrode orbitals (and orbitals not coupled to
+    the left electrode at all) are merged into the last block.
+    M may be a dense array or a scipy.sparse matrix, only its nonzero
+    pattern is used (as a sparse matrix).
+    Returns a list of sorted orbital index arrays.
+    """
+    import scipy.sparse as SS
+    nuo = M.shape[0]
+    mask = SS.csr_matrix(M, copy=True)
+    mask.data = N.array(mask.data != 0, N.float)
+    mask.eliminate_zeros()
+    mask = (mask+mask.T).tocsr()
+    level = -N.ones(nuo, N.int)
+    level[0:nuoL] = 0
+    front, il = N.arange(nuoL), 0
+    while len(front) > 0:
+        il += 1
+        reached = N.zeros(nuo, N.bool)
+        reached[mask[front, :].indices] = True
+        new = N.logical_and(reached, level < 0)
+        level[new] = il
+        front = new.nonzero()[0]
+    lR = N.min(level[nuo-nuoR:nuo])
+    if lR < 0: lR = N.max(level)
+    level[N.logical_or(level < 0, level > lR)] = lR
+    if lR == 0 or nuoL+nuoR > nuo:
+        # Electrodes are coupled directly: a single block
+        return [N.arange(nuo)]
+    return [(level == ii).nonzero()[0] for ii in range(lR+1)]
+
+
+def recursiveGF(eSmH, nuoL, nuoR, blocks=None):
+    """
+    Block-tridiagonal recursive Green's function solver for Gr = eSmH^-1.
+    The orbitals are partitioned with blockPartition (unless given) and the
+    left/right connected Green's functions are accumulated block by block,
+    i.e., O(nuo*b^2) instead of O(nuo^3) operations for block size b.
+    eSmH may be a dense array or a scipy.sparse matrix (only the blocks are
+    made dense).
+    Returns the columns Gr[:, 0:nuoL], Gr[:, nuo-nuoR:nuo], the rows
+    Gr[0:nuoL, :] and the list of diagonal blocks Gr[b_i, b_i].
+    """
+    import scipy.sparse as SS
+    nuo = eSmH.shape[0]
+    if blocks is None:
+        blocks = blockPartition(eSmH, nuoL, nuoR)
+    nb = len(blocks)
+    if SS.issparse(eSmH):
+        eSmH = SS.csr_matrix(eSmH)
+        rows = [eSmH[b, :].tocsc() for b in blocks]
+
+        def A(i, j):
+            return rows[i][:, blocks[j]].toarray()
+    else:
+        def A(i, j):
+            return eSmH[N.ix_(blocks[i], blocks[j])]
+    # Left- and right-connected Green's functions
+    gL, gR = [None]*nb, [None]*nb
+    gL[0] = LA.inv(A(0, 0))
+    for i in range(1, nb):
+        gL[i] = LA.inv(A(i, i)-MM.mm(A(i, i-1), gL[i-1], A(i-1, i)))
+    gR[nb-1] = LA.inv(A(nb-1, nb-1))
+    for i in range(nb-2, -1, -1):
+        gR[i] = LA.inv(A(i, i)-MM.mm(A(i, i+1), gR[i+1], A(i+1, i)))
+    # Diagonal blocks
+    GrDiag = [None]*nb
+    GrDiag[0], GrDiag[nb-1] = gR[0], gL[nb-1]
+    for i in range(1, nb-1):
+        GrDiag[i] = LA.inv(A(i, i)-MM.mm(A(i, i-1), gL[i-1], A(i-1, i))
+                           -MM.mm(A(i, i+1), gR[i+1], A(i+1, i)))
+    # First/last columns and first row
+    GrFirst = N.zeros((nuo, len(blocks[0])), N.complex)
+    GrFirstRow = N.zeros((len(blocks[0]), nuo), N.complex)
+    GrLast = N.zeros((nuo, len(blocks[nb-1])), N.complex)
+    Gi0 = G0i = gR[0]
+    GiN = gL[nb-1]
+    GrFirst[blocks[0], :], GrFirstRow[:, blocks[0]], GrLast[blocks[nb-1], :] = Gi0, G0i, GiN
+    for i in range(1, nb):
+        Gi0 = -MM.mm(gR[i], A(i, i-1), Gi0)
+        G0i = -MM.mm(G0i, A(i-1, i), gR[i])
+        GrFirst[blocks[i], :], GrFirstRow[:, blocks[i]] = Gi0, G0i
+    for i in range(nb-2, -1, -1):
+        GiN = -MM.mm(gL[i], A(i, i+1), GiN)
+        GrLast[blocks[i], :] = GiN
+    # The left (right) electrode orbitals are the first (last) ones
+    # in the first (last) block
+    return GrFirst[:, 0:nuoL], GrLast[:, -nuoR:], GrFirstRow[0:nuoL, :], GrDiag
 
 
-def dec2hash(dec):
-    s = ''
-    for ii in range(len(dec)):
-        s += hex(dec[ii])[2:]
-    return s
+class SigDir(object):
 
+    """
+    Indexed on-disk store of self-energies in the directory of an electrode.
+    Files in <path>/SigStore:
+
+    - *index*      : Fixed-size binary records (hash, fragment, offset, dim)
+    - *index.lock* : Lock file held while the index is appended or rewritten
+    - *Sig_*.frag* : Payload fragments, complex arrays stored back to back
+    - *Sig_*.frag.writer* : Host and process id of the process appending to the
+      fragment, removed by close()
+
+    Each process appends to its own fragment and publishes every entry in the
+    index as soon as it is written, i.e., sibling jobs can use it right away.
+    Opening the store only reads the index and a lookup memory-maps only
+    the requested entry. Use compact() to merge the fragments.
+    """
 
-class SigDir(object):
+    recdtype = N.dtype([('hash', 'S32'), ('frag', 'S48'), ('offset', '<i8'), ('dim', '<i8')])
 
     def __init__(self, path):
-        self.path, self.data = path, {}
-        self.files, self.newFile = [], None
-        for ii in glob.glob(path+'/Sig*.nc'):
-            print(ii)
-            self.add(ii)
-
-    def add(self, fn):
-        ncfile = NC4.Dataset(fn, 'r')
-        if 'Done' in ncfile.variables:
-            print("Read ", fn)
-            ncv = ncfile.variables
-            hash1, hash2l, reE, imE, LR, ispin, etaLead = ncv['hash'][:], ncv['hash2'][:], ncv['reE'][:], ncv['imE'][:], ncv['left'][:], ncv['ispin'][:], ncv['etaLead'][:]
-            hash1 = [dec2hash(ii) for ii in hash1]
-            for ii in range(len(reE)):
-                hash2 = dec2hash(hash2l[ii])
-                print("Found ", hash2)
-                self.data[hash2] = [ncfile, ii]
-            self.files += [ncfile]
-        else:
-            ncfile.close()
-
-    def getSig(self, hash, ee, kp, left, ispin, etaLead):
+        self.path = os.path.join(path, 'SigStore') # Created when first written to
+        self.index = os.path.join(self.path, 'index')
+        self.data, self.indexSize, self.indexIno = {}, 0, None
+        self.newFile = None
+        self.update()
+        if len(self.data) > 0:
+            print('NEGF.SigDir: %i self-energies indexed in %s'%(len(self.data), self.path))
+
+    def key(self, hash, ee, kp, left, ispin, etaLead):
         if left:
             left = 1
         else:
             left = 0
-        hash2 = myHash([N.array(hash), N.array(ee.real), N.array(ee.imag), N.array(kp), N.array(left), N.array(ispin), N.array(etaLead)])
-        print("Get ", hash2)
+        return myHash([N.array(hash), N.array(ee.real), N.array(ee.imag), N.array(kp), N.array(left), N.array(ispin), N.array(etaLead)])
+
+    def update(self):
+        "Read index records added (by any process) since the last update"
+        try:
+            st = os.stat(self.index)
+        except OSError:
+            return
+        if st.st_ino != self.indexIno:
+            # New or rewritten (compacted) index, read from the start
+            self.data, self.indexSize, self.indexIno = {}, 0, st.st_ino
+        nrec = (st.st_size-self.indexSize)//self.recdtype.itemsize
+        if nrec <= 0:
+            return
+        with open(self.index, 'rb') as f:
+            f.seek(self.indexSize)
+            recs = N.fromfile(f, dtype=self.recdtype, count=nrec)
+        for rec in recs:
+            self.data[rec['hash'].decode()] = (rec['frag'].decode(), int(rec['offset']), int(rec['dim']))
+        self.indexSize += len(recs)*self.recdtype.itemsize
+
+    def lock(self, timeout=600.0):
+        "Acquire the index lock (stale locks older than timeout seconds are removed)"
+        fn = self.index+'.lock'
+        while True:
+            try:
+                fd = os.open(fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, ('%i\n'%os.getpid()).encode())
+                os.close(fd)
+                return
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                if time.time()-os.path.getmtime(fn) > timeout:
+                    print('NEGF.SigDir: Removing stale lock', fn)
+                    os.remove(fn)
+                    continue
+            except OSError:
+                continue
+            time.sleep(0.05)
+
+    def unlock(self):
+        os.remove(self.index+'.lock')
+
+    def read(self, hash2):
+        frag, offset, dim = self.data[hash2]
+        try:
+            Sig = N.memmap(os.path.join(self.path, frag), dtype=N.complex128, mode='r',
+                           offset=offset, shape=(dim, dim))
+        except (IOError, OSError):
+            # Fragment merged by a compact() since our index was read
+            self.update()
+            frag, offset, dim = self.data[hash2]
+            Sig = N.memmap(os.path.join(self.path, frag), dtype=N.complex128, mode='r',
+                           offset=offset, shape=(dim, dim))
+        return N.array(Sig)
+
+    def getSig(self, hash, ee, kp, left, ispin, etaLead):
+        hash2 = self.key(hash, ee, kp, left, ispin, etaLead)
+        if not hash2 in self.data:
+            # Maybe written by another process in the meantime
+            self.update()
         if hash2 in self.data:
-            print("Found")
-            ncf, ii = self.data[hash2]
-            return True, ncf.variables['reSig'][ii, :, :]+1j*ncf.variables['imSig'][ii, :, :]
+            return True, self.read(hash2)
         else:
             return False, None
 
     def addSig(self, hash, ee, kp, left, ispin, etaLead, Sig):
-        #print "Add ",hash,ee,kp,left,ispin,etaLead,Sig
-        if left:
-            left = 1
-        else:
-            left = 0
-        if self.newFile == None:
-            self.newFileIndx = 0
-            nf = NC4.Dataset(self.path+'/Sig_'+str(N.floor(N.random.rand()*1e9))+'.nc', 'w')
-            nf.createDimension('One', 1)
-            nf.createDimension('Two', 2)
-            nf.createDimension('32', 32)
-            nf.createDimension('Dim', len(Sig))
-            nf.createDimension('List', None)
-            nf.createVariable('kp', 'd', ('List', 'Two'))
-            nf.createVariable('reE', 'd', ('List',))
-            nf.createVariable('imE', 'd', ('List',))
-            nf.createVariable('left', 'i', ('List',))
-            nf.createVariable('hash', 'i', ('List', '32'))
-            nf.createVariable('hash2', 'i', ('List', '32'))
-            nf.createVariable('ispin', 'i', ('List',))
-            nf.createVariable('etaLead', 'd', ('List',))
-            nf.createVariable('reSig', 'd', ('List', 'Dim', 'Dim'))
-            nf.createVariable('imSig', 'd', ('List', 'Dim', 'Dim'))
-            self.newFile = nf
-            self.files += [nf]
-        NN = self.newFileIndx
-        hash2 = myHash([N.array(hash), N.array(ee.real), N.array(ee.imag), N.array(kp), N.array(left), N.array(ispin), N.array(etaLead)])
-        nfv = self.newFile.variables
-        nfv['hash'][NN, :], nfv['reE'][NN], nfv['imE'][NN] = hash2dec(hash), ee.real, ee.imag
-        nfv['hash2'][NN, :] = hash2dec(hash2)
-        nfv['kp'][NN, :], nfv['left'][NN], nfv['ispin'][NN], nfv['etaLead'][NN] = kp, left, ispin, etaLead
-        nfv['reSig'][NN, :, :], nfv['imSig'][NN, :, :] = Sig.real, Sig.imag
-        print("Put ", hash2)
-        self.data[hash2] = [self.newFile, NN]
-        self.newFileIndx += 1
+        hash2 = self.key(hash, ee, kp, left, ispin, etaLead)
+        if self.newFile is None:
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+            self.newFrag = 'Sig_%s.frag'%uuid.uuid4().hex
+            with open(os.path.join(self.path, self.newFrag+'.writer'), 'w') as f:
+                f.write('%s %i\n'%(socket.gethostname(), os.getpid()))
+            self.newFile = open(os.path.join(self.path, self.newFrag), 'ab')
+        # Write payload before publishing it in the index
+        offset = self.newFile.tell()
+        self.newFile.write(N.require(Sig, N.complex128, ['C']).tobytes())
+        self.newFile.flush()
+        os.fsync(self.newFile.fileno())
+        rec = N.array([(hash2.encode(), self.newFrag.encode(), offset, len(Sig))], dtype=self.recdtype)
+        self.lock()
+        try:
+            with open(self.index, 'ab') as f:
+                f.write(rec.tobytes())
+        finally:
+            self.unlock()
+        self.data[hash2] = (self.newFrag, offset, len(Sig))
+
+    def writers(self):
+        """
+        Fragments still appended to by other processes (see addSig), the
+        markers of processes on this host that no longer exist are removed
+        """
+        active = []
+        for fn in glob.glob(os.path.join(self.path, 'Sig_*.frag.writer')):
+            try:
+                with open(fn) as f:
+                    host, pid = f.read().split()
+            except (IOError, OSError, ValueError):
+                continue
+            if host == socket.gethostname():
+                try:
+                    os.kill(int(pid), 0)
+                except OSError as e:
+                    if e.errno == errno.ESRCH:
+                        print('NEGF.SigDir: Removing stale writer marker', fn)
+                        os.remove(fn)
+                        continue
+            active.append(fn[:-len('.writer')])
+        return active
+
+    def compact(self, force=False):
+        """
+        Merge all fragments into one and rewrite the index without duplicate
+        or unreferenced entries. New files are written under temporary names
+        and moved into place by atomic renames. Readers of the old index
+        find their entries again on the next read (see read).
+        Returns False without changes while other processes are writing to
+        the store (see writers), unless force=True.
+        """
+        self.close()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.lock()
+        try:
+            active = self.writers()
+            if len(active) > 0 and not force:
+                print('NEGF.SigDir: Not compacting %s, %i fragments are being written to'%(self.path, len(active)))
+                return False
+            self.update()
+            frag = 'Sig_%s.frag'%uuid.uuid4().hex
+            recs = []
+            with open(os.path.join(self.path, frag+'.tmp'), 'wb') as fo:
+                for hash2 in sorted(self.data):
+                    Sig = self.read(hash2)
+                    recs.append((hash2.encode(), frag.encode(), fo.tell(), len(Sig)))
+                    fo.write(Sig.tobytes())
+            os.rename(os.path.join(self.path, frag+'.tmp'), os.path.join(self.path, frag))
+            with open(self.index+'.tmp', 'wb') as fo:
+                fo.write(N.array(recs, dtype=self.recdtype).tobytes())
+            os.rename(self.index+'.tmp', self.index)
+            for fn in glob.glob(os.path.join(self.path, 'Sig_*.frag')):
+                if os.path.basename(fn) != frag:
+                    os.remove(fn)
+            self.data, self.indexSize, self.indexIno = {}, 0, None
+            self.update()
+        finally:
+            self.unlock()
+        print('NEGF.SigDir: Compacted %i self-energies into %s'%(len(self.data), frag))
+        return True
 
     def close(self):
-        if not self.newFile == None:
-            self.newFile.createVariable('Done', 'i', ('One',))
-        for f in self.files:
-            f.close()
+        if not self.newFile is None:
+            self.newFile.close()
+            self.newFile = None
+            os.remove(os.path.join(self.path, self.newFrag+'.writer'))
 
 
 class SavedSigClass(object):
 
     """
-    Saves calculated Sig in files in the directory of the TSHS file for the electrode.
-    1: Each process opens a new file if it needs to write Sigma
-    2: The file cannot be read before the finished flag is set
-    3: The integrity of the data is maintained by a hash of HS, NA1, NA2, voltage
+    Saves calculated Sig in the directory of the TSHS file for the electrode.
+    1: Each process appends to its own fragment of the store (see SigDir)
+    2: Entries are indexed as soon as they are written and can be read by other processes
+    3: The integrity of the data is maintained by a hash of the TSHS file content, NA1, NA2, voltage
     """
 
     def __init__(self):
@@ -190,6 +398,53 @@ global SavedSig
 SavedSig = SavedSigClass()
 
 
+class SigCache(object):
+
+    """
+    In-memory store of self-energies with least-recently-used eviction.
+    The memory budget is given in MB; when exceeded the entries that
+    were used longest ago are dropped. Hits, misses and evictions are
+    counted for reporting.
+    """
+
+    def __init__(self, maxMB=256.0):
+        self.maxMB = maxMB
+        self.data = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, key):
+        if key in self.data:
+            self.hits += 1
+            # Move to the end (most recently used)
+            Sig = self.data.pop(key)
+            self.data[key] = Sig
+            return Sig
+        self.misses += 1
+        return None
+
+    def put(self, key, Sig):
+        budget = self.maxMB*1024**2
+        if Sig.nbytes > budget:
+            return
+        if key in self.data:
+            self.nbytes -= self.data.pop(key).nbytes
+        self.data[key] = Sig
+        self.nbytes += Sig.nbytes
+        while self.nbytes > budget:
+            key, old = self.data.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self.data = collections.OrderedDict()
+        self.nbytes = 0
+
+    def __str__(self):
+        return 'SigCache: %i entries (%.1f/%.1f MB), hits= %i, misses= %i, evictions= %i'\
+            %(len(self.data), self.nbytes/1024.**2, self.maxMB, self.hits, self.misses, self.evictions)
+
+
 class ElectrodeSelfEnergy(object):
 
     """
@@ -200,10 +455,13 @@ class ElectrodeSelfEnergy(object):
     """
     global SavedSig
 
-    def __init__(self, fn, NA1, NA2, voltage=0.0, UseF90helpers=True):
+    def __init__(self, fn, NA1, NA2, voltage=0.0, UseF90helpers=True, cacheMB=256.0, HScacheSize=1, sparseHS=False,
+                 TSHScache=False):
         self.path = os.path.split(os.path.abspath(fn))[0]
-        self.HS = SIO.HS(fn, UseF90helpers=UseF90helpers) # An electrode HS
-        self.hash = myHash([self.HS, NA1, NA2, voltage])
+        self.HS = SIO.SharedHS(fn, UseF90helpers=UseF90helpers, cache=TSHScache) # An electrode HS
+        # NOTE: Keyed on the file content instead of the pickled HS object, i.e.,
+        # self-energies saved (Sig*.nc) by earlier versions are not reused
+        self.hash = myHash([self.HS.contentHash(), NA1, NA2, voltage])
         SavedSig.add_hsfile(self.path)
         if self.HS.gamma:
             raise IOError("Are you trying to sneak a Gamma point electrode calculation past me?")
@@ -212,6 +470,11 @@ class ElectrodeSelfEnergy(object):
         self.kpoint = N.array([1e10, 1e10], N.float)
         self.voltage = voltage
         self.scaling = 1.0 # Default scale factor for coupling to device
+        self.SigBatch = {} # Self-energies precomputed with prefetchSig, until used
+        self.cache = SigCache(cacheMB) # Recently computed self-energies (unscaled)
+        self.HScache = collections.OrderedDict() # (H, S, H01, S01) per k-point, see setupHS
+        self.HScacheSize = HScacheSize
+        self.sparseHS = sparseHS # Assemble H, S as sparse matrices in setupHS
 
     def getSig(self, ee, qp=N.array([0, 0], N.float), left=True, Bulk=False, ispin=0, UseF90helpers=True, etaLead=0.0, useSigNCfiles=False):
         """
@@ -229,6 +492,11 @@ class ElectrodeSelfEnergy(object):
         The voltage is assumed to be applied symmetrically and just shifts the energies of the self-energy
         """
 
+        key = self.__batchKey(ee, qp, left, Bulk, ispin, etaLead)
+        if key in self.SigBatch:
+            # Already computed in a vectorized pass (prefetchSig), used once
+            return self.SigBatch.pop(key)
+
         eeshifted = ee-self.voltage # Shift of self energies due to voltage
 
         if useSigNCfiles:
@@ -242,6 +510,13 @@ class ElectrodeSelfEnergy(object):
             ispin = 0
             print("Warning: Non-spinpolarized electrode calculation used for both spin up and down")
 
+        cachekey = self.__cacheKey(eeshifted, qp, left, Bulk, ispin, etaLead)
+        Sig = self.cache.get(cachekey)
+        if Sig is not None:
+            if self.scaling != 1.0:
+                print('NEGF.getSig: Scaling self-energy with a factor', self.scaling)
+            return Sig*self.scaling
+
         NA1, NA2 = self.NA1, self.NA2
         nuo = self.HS.nuo
 
@@ -255,75 +530,24 @@ class ElectrodeSelfEnergy(object):
                 # if not bulk
                 ESH = eeshifted* self.S-self.H[ispin, :, :]
 
-        elif SIO.F90imported and UseF90helpers:
-
+        else:
+            # Surface GFs of the small electrode at the NA1*NA2 folded k-points
             g0 = N.empty((nuo, nuo, NA1*NA2), N.complex, order='F')
             mESH = N.empty((nuo, nuo, NA1*NA2), N.complex, order='F')
-
-            iq = -1
-            for ik2 in range(NA2):
-                for ik1 in range(NA1):
-                    iq += 1
-                    kpoint = qp.copy() # Checked against 1x1 and 3x3 electrode calculation
-                    kpoint[0] = (kpoint[0]+float(ik1))/float(NA1)
-                    kpoint[1] = (kpoint[1]+float(ik2))/float(NA2)
-                    # Surface GF with possible extra imaginary part (etaLead):
-                    g0[:, :, iq] = self.getg0(eeshifted+1j*etaLead, kpoint, left=left, ispin=ispin, UseF90=UseF90helpers)
-                    mESH[:, :, iq] = eeshifted*self.S-self.H[ispin, :, :]
-
-            ESH, SGF = SIO.F90.expansion_se(no_u=nuo, no_s=nuo*NA1*NA2, na1=NA1, na2=NA2, kpt=qp,
-                                            na_u=self.HS.nua, lasto=self.HS.lasto, esh=mESH, g0=g0)
+            for iq, kpoint in enumerate(self.replicaKpoints(qp)):
+                # Surface GF with possible extra imaginary part (etaLead):
+                g0[:, :, iq] = self.getg0(eeshifted+1j*etaLead, kpoint, left=left, ispin=ispin, UseF90=UseF90helpers)
+                mESH[:, :, iq] = eeshifted*self.S-self.H[ispin, :, :]
+            ESH, SGF = self.expandSig(qp, g0, mESH, UseF90helpers)
             # Clean up before calculating the self-energy
             del g0, mESH
 
-        else:
-
-            # Make list for the loop containing
-            #       [iatom,i1,i2,SGFstart,SGFend,g0start,g0end]
-            # where iatom is the atom number in g0 corresponding to g0start and g0end orbital
-            # i1 and i2 posision in the repeated lattice which together with iatom gives SGFstart/end
-            nua, lasto = self.HS.nua, self.HS.lasto
-            SGFstart, loop = 0, []
-            for ia in range(nua):         # Atoms in electrode
-                g0start, g0end = lasto[ia], lasto[ia+1]-1
-                for i2 in range(NA2):     # Repetition NA2
-                    for i1 in range(NA1): # Repetition NA1
-                        SGFend = SGFstart+(g0end-g0start+1)-1 # add the number of orbitals in atom ia
-                        loop.append([ia, i1, i2, SGFstart, SGFend, g0start, g0end])
-                        SGFstart = SGFend+1
-            if SGFstart != NA1*NA2*nuo:
-                raise ValueError("Error: Check of orbitals in making Sigma not correct")
-            # Complete the full Gs with atoms copied out NA1*NA2
-            # To obtain Sigma we also need H expanded, i.e.,
-            # Gs = (E S - H - Sig)^-1 -> Sig = E S - H-SGF^-1
-            # ESmH = E S - H
-            SGF = N.zeros((NA1*NA2*nuo, NA1*NA2*nuo), N.complex)
-            ESH = N.zeros((NA1*NA2*nuo, NA1*NA2*nuo), N.complex) # Temporary E S00 - H00
-            for ik2 in range(NA2):
-                for ik1 in range(NA1):
-                    kpoint = qp.copy() # Checked against 1x1 and 3x3 electrode calculation
-                    kpoint[0] = kpoint[0]/NA1
-                    kpoint[1] = kpoint[1]/NA2
-                    kpoint[0] += ik1*1.0/NA1
-                    kpoint[1] += ik2*1.0/NA2
-                    # Surface GF with possible extra imaginary part (etaLead):
-                    g0 = self.getg0(eeshifted+1j*etaLead, kpoint, left=left, ispin=ispin, UseF90=UseF90helpers)
-
-                    matESmH = eeshifted*self.S-self.H[ispin, :, :]
-                    for ia, i1, i2, iSGFs, iSGFe, ig0s, ig0e in loop:
-                        for ja, j1, j2, jSGFs, jSGFe, jg0s, jg0e in loop:
-                            # Same convention as for H_ij above: exp(2 pi i k * (jatom-iatom))
-                            # The phases etc have been checked by comparing the self-energy from
-                            # 1x1 and 3x3 electrode calculations
-                            phase = 1.0/(NA1*NA2)*N.exp(-2.0j*N.pi*((j1-i1)*kpoint[0]+(j2-i2)*kpoint[1]))
-                            ESH[iSGFs:iSGFe+1, jSGFs:jSGFe+1] += phase*matESmH[ig0s:ig0e+1, jg0s:jg0e+1]
-                            SGF[iSGFs:iSGFe+1, jSGFs:jSGFe+1] += phase*g0[ig0s:ig0e+1, jg0s:jg0e+1]
-
         # Calculate self-energy or inverse of SGF for Bulk: SGF^-1 = E S - H - Sig
         if Bulk:
             Sig = LA.inv(SGF) # SGF^1
         else:
             Sig = ESH - LA.inv(SGF)
+        self.cache.put(cachekey, Sig)
 
         if useSigNCfiles:
             SavedSig.addSig(self.path, self.hash, eeshifted, qp, left, ispin, etaLead, Sig)
@@ -331,6 +555,151 @@ class ElectrodeSelfEnergy(object):
             print('NEGF.getSig: Scaling self-energy with a factor', self.scaling)
         return Sig*self.scaling
 
+    def getSigBatch(self, Elist, qp=N.array([0, 0], N.float), left=True, Bulk=False, ispin=0, UseF90helpers=True, etaLead=0.0, useSigNCfiles=False):
+        """
+        Get self-energies for a list of energies at the 2-D surface k-point qp.
+        Same conventions as getSig, but the surface Green's functions of all
+        energies are obtained in a single vectorized decimation (calcg0_batch)
+        instead of one Lopez-Sancho run per energy.
+        Returns an array of shape (len(Elist), NA1*NA2*nuo, NA1*NA2*nuo).
+        """
+        Elist = N.array(Elist, N.complex).reshape((-1,))
+        eeshifted = Elist-self.voltage # Shift of self energies due to voltage
+        NA1, NA2 = self.NA1, self.NA2
+        nuo = self.HS.nuo
+        Sig = N.empty((len(Elist), NA1*NA2*nuo, NA1*NA2*nuo), N.complex)
+
+        # Energies not already available from the SigNC-files
+        todo = N.ones(len(Elist), N.bool)
+        if useSigNCfiles:
+            for ie, ee in enumerate(eeshifted):
+                Found, tmp = SavedSig.getSig(self.path, self.hash, ee, qp, left*1, ispin, etaLead)
+                if Found:
+                    Sig[ie], todo[ie] = tmp, False
+        if ispin >= self.HS.nspin:
+            ispin = 0
+            print("Warning: Non-spinpolarized electrode calculation used for both spin up and down")
+        cachekeys = [self.__cacheKey(ee, qp, left, Bulk, ispin, etaLead) for ee in eeshifted]
+        for ie in todo.nonzero()[0]:
+            tmp = self.cache.get(cachekeys[ie])
+            if tmp is not None:
+                Sig[ie], todo[ie] = tmp, False
+        indx = todo.nonzero()[0]
+
+        if len(indx) > 0:
+            ee = eeshifted[indx]
+            if NA1 * NA2 == 1:
+                self.setupHS(qp)
+                SGF = self.calcg0_batch(ee+1j*etaLead, left=left, ispin=ispin)
+                ESH = ee.reshape((-1, 1, 1))*self.S-self.H[ispin, :, :]
+            else:
+                g0 = N.empty((len(ee), nuo, nuo, NA1*NA2), N.complex)
+                mESH = N.empty((len(ee), nuo, nuo, NA1*NA2), N.complex)
+                for iq, kpoint in enumerate(self.replicaKpoints(qp)):
+                    self.setupHS(kpoint)
+                    g0[:, :, :, iq] = self.calcg0_batch(ee+1j*etaLead, left=left, ispin=ispin)
+                    mESH[:, :, :, iq] = ee.reshape((-1, 1, 1))*self.S-self.H[ispin, :, :]
+                ESH = N.empty((len(ee), NA1*NA2*nuo, NA1*NA2*nuo), N.complex)
+                SGF = N.empty((len(ee), NA1*NA2*nuo, NA1*NA2*nuo), N.complex)
+                for ie in range(len(ee)):
+                    ESH[ie], SGF[ie] = self.expandSig(qp, N.asfortranarray(g0[ie]), N.asfortranarray(mESH[ie]), UseF90helpers)
+                del g0, mESH
+
+            # Calculate self-energy or inverse of SGF for Bulk: SGF^-1 = E S - H - Sig
+            if Bulk:
+                Sig[indx] = LA.inv(SGF)
+            else:
+                Sig[indx] = ESH - LA.inv(SGF)
+            for ie in indx:
+                self.cache.put(cachekeys[ie], Sig[ie].copy())
+
+            if useSigNCfiles:
+                for ie in indx:
+                    SavedSig.addSig(self.path, self.hash, eeshifted[ie], qp, left, ispin, etaLead, Sig[ie])
+        if self.scaling != 1.0:
+            print('NEGF.getSigBatch: Scaling self-energy with a factor', self.scaling)
+        return Sig*self.scaling
+
+    def prefetchSig(self, Elist, qp=N.array([0, 0], N.float), left=True, Bulk=False, ispin=0, etaLead=0.0, useSigNCfiles=False):
+        """
+        Compute self-energies for all energies in Elist with getSigBatch and keep
+        them until the first getSig call with the same arguments uses them.
+        At most the memory budget of the SigCache (cacheMB) is kept, the
+        self-energies beyond it are computed again by getSig.
+        """
+        Sig = self.getSigBatch(Elist, qp, left=left, Bulk=Bulk, ispin=ispin,
+                               etaLead=etaLead, useSigNCfiles=useSigNCfiles)
+        nbytes = sum(val.nbytes for val in self.SigBatch.values())
+        for ie, ee in enumerate(N.array(Elist, N.complex).reshape((-1,))):
+            nbytes += Sig[ie].nbytes
+            if nbytes > self.cache.maxMB*1024**2:
+                print('NEGF.prefetchSig: Memory budget (%.1f MB) exceeded, keeping %i of %i self-energies'%(self.cache.maxMB, ie, len(Sig)))
+                break
+            self.SigBatch[self.__batchKey(ee, qp, left, Bulk, ispin, etaLead)] = Sig[ie].copy()
+
+    def __batchKey(self, ee, qp, left, Bulk, ispin, etaLead):
+        return (complex(ee), tuple(N.array(qp, N.float)), bool(left), bool(Bulk), ispin, etaLead)
+
+    def __cacheKey(self, eeshifted, qp, left, Bulk, ispin, etaLead):
+        return (complex(eeshifted), tuple(N.array(qp, N.float)), bool(left), ispin, etaLead, bool(Bulk))
+
+    def replicaKpoints(self, qp):
+        """
+        k-points of the small electrode calculation folded into the
+        NA1*NA2 repeated electrode at 2-D k-point qp (ordering as in expandSig)
+        """
+        kpoints = []
+        for ik2 in range(self.NA2):
+            for ik1 in range(self.NA1):
+                kpoint = N.array(qp, N.float) # Checked against 1x1 and 3x3 electrode calculation
+                kpoint[0] = (kpoint[0]+float(ik1))/float(self.NA1)
+                kpoint[1] = (kpoint[1]+float(ik2))/float(self.NA2)
+                kpoints.append(kpoint)
+        return kpoints
+
+    def expandSig(self, qp, g0, mESH, UseF90helpers=True):
+        """
+        Copy out g0[:, :, iq] and mESH[:, :, iq] = E S - H, given at the
+        k-points replicaKpoints(qp), onto the NA1*NA2*nuo matrices
+        (ESH, SGF) of the repeated electrode.
+        """
+        NA1, NA2 = self.NA1, self.NA2
+        nuo = self.HS.nuo
+
+        if SIO.F90imported and UseF90helpers:
+            return SIO.F90.expansion_se(no_u=nuo, no_s=nuo*NA1*NA2, na1=NA1, na2=NA2, kpt=qp,
+                                        na_u=self.HS.nua, lasto=self.HS.lasto, esh=mESH, g0=g0)
+
+        # Each orbital of the repeated electrode corresponds to an orbital in g0
+        # and a position (i1, i2) in the repeated lattice. The ordering is
+        # atoms outermost, then i2, i1 and the orbitals of the atom innermost
+        nua, lasto = self.HS.nua, self.HS.lasto
+        orb, pos1, pos2 = [], [], []
+        for ia in range(nua):         # Atoms in electrode
+            norb = lasto[ia+1]-lasto[ia]
+            orb.append(N.tile(N.arange(lasto[ia], lasto[ia+1]), NA1*NA2))
+            pos1.append(N.repeat(N.tile(N.arange(NA1), NA2), norb))
+            pos2.append(N.repeat(N.repeat(N.arange(NA2), NA1), norb))
+        orb, pos1, pos2 = N.concatenate(orb), N.concatenate(pos1), N.concatenate(pos2)
+        if len(orb) != NA1*NA2*nuo:
+            raise ValueError("Error: Check of orbitals in making Sigma not correct")
+        # Complete the full Gs with atoms copied out NA1*NA2
+        # To obtain Sigma we also need H expanded, i.e.,
+        # Gs = (E S - H - Sig)^-1 -> Sig = E S - H-SGF^-1
+        # ESmH = E S - H
+        SGF = N.zeros((NA1*NA2*nuo, NA1*NA2*nuo), N.complex)
+        ESH = N.zeros((NA1*NA2*nuo, NA1*NA2*nuo), N.complex) # Temporary E S00 - H00
+        ix = N.ix_(orb, orb)
+        for iq, kpoint in enumerate(self.replicaKpoints(qp)):
+            # Same convention as for H_ij above: exp(2 pi i k * (jatom-iatom))
+            # The phases etc have been checked by comparing the self-energy from
+            # 1x1 and 3x3 electrode calculations
+            phase = N.exp(2.0j*N.pi*(pos1*kpoint[0]+pos2*kpoint[1]))
+            phase = N.outer(phase, N.conjugate(phase))/(NA1*NA2)
+            ESH += phase*mESH[:, :, iq][ix]
+            SGF += phase*g0[:, :, iq][ix]
+        return ESH, SGF
+
     def getg0(self, ee, kpoint, left=True, ispin=0, UseF90=True):
         # Calculate surface Green's function for small electrode calculation
         self.setupHS(kpoint)
@@ -372,7 +741,7 @@ class ElectrodeSelfEnergy(object):
         ipiv = N.where(N.abs(ev) < 1.0)[0]
         ev, evec = ev[ipiv], N.transpose(evec[:NN, ipiv])
         # Normalize evec
-        norm = N.sqrt(N.diag(MM.mm(evec, MM.dagger(evec))))
+        norm = N.sqrt(MM.diag_mm(evec, MM.dagger(evec)))
         evec = MM.mm(N.diag(1.0/norm), evec)
 
         # E^+ Lambda_+ (E^+)^-1 --->>> g00
@@ -453,8 +822,9 @@ class ElectrodeSelfEnergy(object):
             iteration += 1
             oldeps, oldepss = eps.copy(), epss.copy()
             oldalpha, oldbeta = alpha.copy(), beta.copy()
-            tmpa = LA.solve(ee*S - oldeps, oldalpha)
-            tmpb = LA.solve(ee*S - oldeps, oldbeta)
+            # One factorization for both right hand sides
+            tmp = LA.solve(ee*S - oldeps, N.concatenate((oldalpha, oldbeta), axis=1))
+            tmpa, tmpb = tmp[:, :len(H)], tmp[:, len(H):]
             alpha, beta = MM.mm(oldalpha, tmpa), MM.mm(oldbeta, tmpb)
             eps = oldeps + MM.mm(oldalpha, tmpb)+MM.mm(oldbeta, tmpa)
             if left:
@@ -480,25 +850,91 @@ class ElectrodeSelfEnergy(object):
                              "Error: gs iteration {0}".format(iteration))
         return gs
 
+    def calcg0_batch(self, Elist, ispin=0, left=True):
+        """
+        Vectorized version of calcg0_old for a list of energies.
+        The Lopez-Sancho iterations run on stacked (nE, nuo, nuo) arrays and
+        each energy is removed from the active set once it has converged.
+        Returns the surface Green's functions with shape (nE, nuo, nuo).
+        """
+        H, S, H01, S01 = self.H[ispin, :, :], self.S, self.H01[ispin, :, :], self.S01
+        ee = N.array(Elist, N.complex).reshape((-1, 1, 1))
+        nE, NN = len(ee), len(H)
+        I = N.identity(NN, N.complex)
+
+        gs = N.empty((nE, NN, NN), N.complex)
+        active = N.arange(nE) # Energies not yet converged
+        alpha, beta = MM.dagger(H01)-ee*MM.dagger(S01), H01-ee*S01
+        eps = N.repeat(H.reshape((1, NN, NN)), nE, axis=0)
+        epss = eps.copy()
+        iteration = 0
+        while len(active) > 0:
+            iteration += 1
+            eeS = ee[active]*S
+            tmp = LA.solve(eeS - eps, N.concatenate((alpha, beta), axis=2))
+            tmpa, tmpb = tmp[:, :, :NN], tmp[:, :, NN:]
+            atmpb, btmpa = N.matmul(alpha, tmpb), N.matmul(beta, tmpa)
+            alpha, beta = N.matmul(alpha, tmpa), N.matmul(beta, tmpb)
+            eps = eps + atmpb + btmpa
+            if left:
+                epss = epss + atmpb
+            else:
+                epss = epss + btmpa
+            LopezConvTest = N.max(abs(alpha)+abs(beta), axis=(1, 2))
+            conv = LopezConvTest < 1.0e-40
+            if not N.any(conv):
+                continue
+            # Surface GF for the converged energies
+            e = ee[active[conv]]
+            g = LA.inv(e*S-epss[conv])
+            if left:
+                test = e*S-H-N.matmul(N.matmul(e*MM.dagger(S01)-MM.dagger(H01), g), e*S01-H01)
+            else:
+                test = e*S-H-N.matmul(N.matmul(e*S01-H01, g), e*MM.dagger(S01)-MM.dagger(H01))
+            myConvTest = N.max(abs(N.matmul(test, g)-I), axis=(1, 2))
+            VC.Check("Lopez-Sancho", myConvTest,
+                     "Error: gs iteration {0}".format(iteration))
+            for ie in (myConvTest > VC.GetCheck("Lopez-Sancho-warning")).nonzero()[0]:
+                v = "RIGHT"
+                if left: v = "LEFT"
+                print("WARNING: Lopez-scheme not-so-well converged for "+v+" electrode at E = %.4f eV:"%e[ie].real, myConvTest[ie])
+            gs[active[conv]] = g
+            # Continue with the remaining energies only
+            keep = N.logical_not(conv)
+            active = active[keep]
+            alpha, beta, eps, epss = alpha[keep], beta[keep], eps[keep], epss[keep]
+        return gs
+
     def setupHS(self, kpoint):
         """
         Setup H, S, H01 and S01 where H01 has large elements in the lower left corner, i.e., H01 = Hi,i+1
         (... 0     H01^+ H     H01   0      ...  )
         (... 0     0     H01^+ H     H01    0      ...  )
+        The matrices of the last HScacheSize k-points are kept, set HScacheSize
+        to the number of (replicated) k-points of the mesh to compute them only once.
+        With sparseHS the k-point matrices are combined as sparse matrices
+        and only the results are made dense.
         """
         # Save time by not repeating too often
         if N.max(abs(kpoint-self.kpoint)) > 1e-10:
             self.kpoint = kpoint.copy()
+            key = tuple(N.round(kpoint, 10)+0.0)
+            try:
+                self.H, self.S, self.H01, self.S01 = self.HScache.pop(key)
+                self.HScache[key] = (self.H, self.S, self.H01, self.S01)
+                return
+            except KeyError:
+                pass
             # Do the trick:
             # H(k=0)+H(kz=0.5) = H + H01 + H10 + H - H01 - H10 = 2 H
             kp = N.zeros((3), N.float)
 
             kp[0:2] = kpoint
-            self.HS.setkpoint(kp, verbose=False)
+            self.HS.setkpoint(kp, verbose=False, sparse=self.sparseHS)
             tmpH, tmpS = self.HS.H.copy(), self.HS.S.copy()
 
             kp[self.semiinf] = 0.5
-            self.HS.setkpoint(kp, verbose=False)
+            self.HS.setkpoint(kp, verbose=False, sparse=self.sparseHS)
             self.H = 0.5 * (tmpH + self.HS.H)
             self.S = 0.5 * (tmpS + self.HS.S)
 
@@ -507,19 +943,27 @@ class ElectrodeSelfEnergy(object):
             # 2: H(kz=0)-H  = H + H01 + H10 - H =  H01+H10
             # -> H10 = (-i*(H(kz=0.25)-H) + H(kz=0)-H)/2
             kp[self.semiinf] = 0.25
-            self.HS.setkpoint(kp, verbose=False)
+            self.HS.setkpoint(kp, verbose=False, sparse=self.sparseHS)
             self.H01 = 0.5*(-1j*(self.HS.H - self.H) + tmpH - self.H)
             self.S01 = 0.5*(-1j*(self.HS.S - self.S) + tmpS - self.S)
+            if self.sparseHS:
+                self.H = N.array([h.toarray() for h in self.H])
+                self.H01 = N.array([h.toarray() for h in self.H01])
+                self.S, self.S01 = self.S.toarray(), self.S01.toarray()
 
             self.HS.resetkpoint()
             del tmpH, tmpS
+            self.HScache[key] = (self.H, self.S, self.H01, self.S01)
+            while len(self.HScache) > max(self.HScacheSize, 0):
+                self.HScache.popitem(last=False)
 
 #############################################################################
 
 
 class GF(object):
 
-    def __init__(self, TSHSfile, elecL, elecR, Bulk=True, DeviceAtoms=[0, 0], BufferAtoms=N.empty((0,))):
+    def __init__(self, TSHSfile, elecL, elecR, Bulk=True, DeviceAtoms=[0, 0], BufferAtoms=N.empty((0,)), lean=False, sparse=False,
+                 TSHScache=False):
         """
         Calculate Green's functions etc for TSHSfile connected to left/right
         electrode (class ElectrodeSelfEnergy).
@@ -537,9 +981,16 @@ class GF(object):
         DeviceAtoms : start/end Siesta numbering of atoms included in device
         DeviceOrbs : Start/end of orbitals. Siesta ordering.
         BufferAtoms: A list of buffer atoms
+        lean   : Do not keep the derived quantities AL, AR, TT etc of calcGF
+                 but evaluate them on each access
+        sparse : Keep H, S, H0, S0 as scipy.sparse CSR matrices, intended for
+                 the RGF solver (the full inversion works on a dense copy)
+        TSHScache : Read TSHSfile through its sidecar cache (see io.siesta.HS)
         """
         self.elecL, self.elecR, self.Bulk = elecL, elecR, Bulk
-        self.HS = SIO.HS(TSHSfile, BufferAtoms=BufferAtoms)
+        self.HS = SIO.SharedHS(TSHSfile, BufferAtoms=BufferAtoms, cache=TSHScache)
+        self.HSkey = None # (kpoint, ispin) of H, S, see setkpoint
+        self.sparse = sparse
         print('GF: UseBulk=', Bulk)
         self.DeviceAtoms = DeviceAtoms
         if DeviceAtoms[0] <= 1:
@@ -571,15 +1022,19 @@ class GF(object):
             self.setkpoint(kpoint, ispin=0) # At least for one spin
 
             devSt, devEnd = self.DeviceOrbs[0], self.DeviceOrbs[1]
-            VC.Check("Device-Elec-overlap", N.abs(self.S0[0:devSt, devEnd:self.nuo0]),
+            if self.sparse:
+                H0, S0 = self.H0.toarray(), self.S0.toarray()
+            else:
+                H0, S0 = self.H0, self.S0
+            VC.Check("Device-Elec-overlap", N.abs(S0[0:devSt, devEnd:self.nuo0]),
                      "Too much overlap directly from left-top right",
                      "Make device region larger")
-            VC.Check("Device-Elec-overlap", N.abs(self.H0[0:devSt, devEnd:self.nuo0]),
+            VC.Check("Device-Elec-overlap", N.abs(H0[0:devSt, devEnd:self.nuo0]),
                      "Too large Hamiltonian directly from left-top right.",
                      "Make device region larger")
         if self.FoldedL:
             # Find orbitals in device region coupling to left and right.
-            tau = abs(self.S0[0:devSt-1, 0:devEnd])
+            tau = abs(S0[0:devSt-1, 0:devEnd])
             coupling = N.sum(tau, axis=0)
             ii = devEnd-1
             while coupling[ii] < 1e-10: ii = ii-1
@@ -587,7 +1042,7 @@ class GF(object):
             self.nuoL = self.devEndL-devSt+1
             print("Left self energy on orbitals %i-%i"%(devSt, self.devEndL))
         if self.FoldedR:
-            tau = abs(self.S0[devEnd-1:self.nuo0, 0:self.nuo0])
+            tau = abs(S0[devEnd-1:self.nuo0, 0:self.nuo0])
             coupling = N.sum(tau, axis=0)
             ii = devSt-1
             while coupling[ii] < 1e-10: ii = ii+1
@@ -596,6 +1051,23 @@ class GF(object):
             print("Right self energy on orbitals %i-%i"%(self.devStR, devEnd))
         # Quantities expressed in nonorthogonal basis:
         self.OrthogonalDeviceRegion = False
+        # Derived quantities of calcGF (see memory_report)
+        self.lean = lean
+        self.GFkey, self.__lazy, self.Gr = None, {}, None
+
+    def precalcSigLR(self, Elist, kpoints, ispin=0, etaLead=0.0, useSigNCfiles=False):
+        """
+        Precompute the electrode self-energies for all energies in Elist at each
+        of the 2d k-points in one vectorized pass per k-point and electrode
+        (see ElectrodeSelfEnergy.getSigBatch). Subsequent calls to calcSigLR
+        at these energies and k-points use them (once, see ElectrodeSelfEnergy.prefetchSig).
+        Previously precomputed self-energies are discarded.
+        """
+        self.elecL.SigBatch, self.elecR.SigBatch = {}, {}
+        for kpoint in kpoints:
+            kpoint = N.array(kpoint[0:2], N.float)
+            self.elecL.prefetchSig(Elist, kpoint, left=True, Bulk=self.Bulk, ispin=ispin, etaLead=etaLead, useSigNCfiles=useSigNCfiles)
+            self.elecR.prefetchSig(Elist, kpoint, left=False, Bulk=self.Bulk, ispin=ispin, etaLead=etaLead, useSigNCfiles=useSigNCfiles)
 
     def calcSigLR(self, ee, kpoint, ispin=0, etaLead=0.0, useSigNCfiles=False, SpectralCutoff=0.0):
         """
@@ -620,8 +1092,10 @@ class GF(object):
             # Sigma = A21.A11^-1.A12          (tau=A12)
             devEndL = self.devEndL
             # Do folding
-            eSmH = ee*self.S0-self.H0
-            eSmHmS = eSmH[0:devEndL, 0:devEndL].copy()
+            eSmH = ee*self.S0[0:devEndL, 0:devEndL]-self.H0[0:devEndL, 0:devEndL]
+            if self.sparse:
+                eSmH = eSmH.toarray()
+            eSmHmS = eSmH.copy()
             if self.Bulk:
                 eSmHmS[0:nuoL0, 0:nuoL0] = SigL0 # SGF^1
             else:
@@ -643,8 +1117,10 @@ class GF(object):
         if FoldedR:
             # Fold down from nuoR0 to the device region
             devStR = self.devStR
-            eSmH = ee*self.S0-self.H0
-            eSmHmS = eSmH[devStR-1:nuo0, devStR-1:nuo0].copy()
+            eSmH = ee*self.S0[devStR-1:nuo0, devStR-1:nuo0]-self.H0[devStR-1:nuo0, devStR-1:nuo0]
+            if self.sparse:
+                eSmH = eSmH.toarray()
+            eSmHmS = eSmH.copy()
             tmpnuo = len(eSmHmS)
             if self.Bulk:
                 eSmHmS[tmpnuo-nuoR0:tmpnuo, tmpnuo-nuoR0:tmpnuo] = SigR0 # SGF^1
@@ -654,7 +1130,7 @@ class GF(object):
             taud = eSmHmS[nuoR:tmpnuo, 0:nuoR].copy()
             inv = LA.inv(eSmHmS[nuoR:tmpnuo, nuoR:tmpnuo])
             eSmHmS[0:nuoR, 0:nuoR] = eSmHmS[0:nuoR, 0:nuoR]-MM.mm(tau, inv, taud)
-            self.SigR = eSmH[devStR-1:devEnd, devStR-1:devEnd]-eSmHmS[0:nuoR, 0:nuoR]
+            self.SigR = eSmH[0:nuoR, 0:nuoR]-eSmHmS[0:nuoR, 0:nuoR]
         else:
             self.SigR = SigR0
         self.GamR = 1.0j*(self.SigR-MM.dagger(self.SigR))
@@ -663,12 +1139,13 @@ class GF(object):
             self.GamR = -1.0*self.GamR
         AssertReal(N.diag(self.GamR), 'GamR')
 
-    def calcGF(self, ee, kpoint, ispin=0, etaLead=0.0, useSigNCfiles=False, SpectralCutoff=0.0):
-        "Calculate GF etc at energy ee and 2d k-point"
+    def __calcESmH(self, ee, kpoint, ispin=0, etaLead=0.0, useSigNCfiles=False, SpectralCutoff=0.0, RGF=False):
+        """
+        Calculate self-energies and return the device matrix ee*S-H-SigL-SigR at energy ee and 2d k-point
+        (a scipy.sparse CSR matrix if sparse or for the RGF solver, see RGFsetup)
+        """
         nuo, nuoL, nuoR = self.nuo, self.nuoL, self.nuoR
-        nuo0, nuoL0, nuoR0 = self.nuo0, self.nuoL0, self.nuoR0
         FoldedL, FoldedR = self.FoldedL, self.FoldedR
-        devSt, devEnd = self.DeviceOrbs[0], self.DeviceOrbs[1]
 
         # Determine whether electrode self-energies should be k-sampled or not
         try:
@@ -704,7 +1181,12 @@ class GF(object):
 
         # Ready to calculate Gr
         self.setkpoint(kpoint, ispin)
+        if RGF and not self.sparse:
+            H, S = self.RGFsetup()[0:2]
+            return self.__addSigSparse(ee*S-H)
         eSmH = ee*self.S-self.H
+        if self.sparse:
+            return self.__addSigSparse(eSmH)
         if FoldedL:
             eSmH[0:nuoL, 0:nuoL] = eSmH[0:nuoL, 0:nuoL]-self.SigL
         else:
@@ -719,46 +1201,259 @@ class GF(object):
                 eSmH[nuo-nuoR:nuo, nuo-nuoR:nuo] = self.SigR # SGF^1
             else:
                 eSmH[nuo-nuoR:nuo, nuo-nuoR:nuo] = eSmH[nuo-nuoR:nuo, nuo-nuoR:nuo]-self.SigR
-        self.Gr = LA.inv(eSmH)
-        self.Ga = MM.dagger(self.Gr)
-        # Calculate spectral functions
-        if SpectralCutoff > 0.0:
-            self.AL = MM.SpectralMatrix(MM.mm(self.Gr[:, 0:nuoL], self.GamL, self.Ga[0:nuoL, :]), cutoff=SpectralCutoff)
-            tmp = MM.mm(self.GamL, self.Gr[0:nuoL, :])
-            self.ALT = MM.SpectralMatrix(MM.mm(self.Ga[:, 0:nuoL], tmp), cutoff=SpectralCutoff)
-            self.AR = MM.SpectralMatrix(MM.mm(self.Gr[:, nuo-nuoR:nuo], self.GamR, self.Ga[nuo-nuoR:nuo, :]), cutoff=SpectralCutoff)
-            self.ARGLG = MM.mm(self.AR.L, self.AR.R[:, 0:nuoL], tmp)
-            self.A = self.AL+self.AR
-            # transmission matrix AL.GamR
-            self.TT = MM.mm(self.AL.R[:, nuo-nuoR:nuo], self.GamR, self.AL.L[nuo-nuoR:nuo, :])
+        return eSmH
+
+    def __addSigSparse(self, eSmH):
+        "Sparse version of the self-energy insertion of __calcESmH"
+        import scipy.sparse as SS
+        nuo, nuoL, nuoR = self.nuo, self.nuoL, self.nuoR
+
+        def block(B, i0):
+            # Dense block B at (i0, i0) as a sparse nuo x nuo matrix
+            ii = N.arange(len(B))+i0
+            return SS.csr_matrix((N.ravel(B), (N.repeat(ii, len(B)), N.tile(ii, len(B)))), shape=(nuo, nuo))
+        eSmH = SS.csr_matrix(eSmH)
+        if self.Bulk and not self.FoldedL:
+            eSmH = eSmH-block(eSmH[0:nuoL, 0:nuoL].toarray(), 0)+block(self.SigL, 0) # SGF^1
+        else:
+            eSmH = eSmH-block(self.SigL, 0)
+        if self.Bulk and not self.FoldedR:
+            eSmH = eSmH-block(eSmH[nuo-nuoR:nuo, nuo-nuoR:nuo].toarray(), nuo-nuoR)+block(self.SigR, nuo-nuoR) # SGF^1
         else:
-            self.AL = MM.mm(self.Gr[:, 0:nuoL], self.GamL, self.Ga[0:nuoL, :])
-            tmp = MM.mm(self.GamL, self.Gr[0:nuoL, :])
-            self.ALT = MM.mm(self.Ga[:, 0:nuoL], tmp)
-            self.AR = MM.mm(self.Gr[:, nuo-nuoR:nuo], self.GamR, self.Ga[nuo-nuoR:nuo, :])
-            self.ARGLG = MM.mm(self.AR[:, 0:nuoL], tmp)
-            self.A = self.AL+self.AR
-            # transmission matrix AL.GamR
-            self.TT = MM.mm(self.AL[nuo-nuoR:nuo, nuo-nuoR:nuo], self.GamR)
-
-        print('NEGF.calcGF: Shape of transmission matrix (TT):', self.TT.shape)
-        print('NEGF.calcGF: Energy and total transmission Tr[TT].real:', ee, N.trace(self.TT).real)
-        # Write also the Gammas in the full space of Gr/Ga/A
-        # (needed for the inelastic shot noise)
-        self.GammaL = N.zeros(self.Gr.shape, N.complex)
-        self.GammaL[0:nuoL, 0:nuoL] = self.GamL
-        self.GammaR = N.zeros(self.Gr.shape, N.complex)
-        self.GammaR[nuo-nuoR:nuo, nuo-nuoR:nuo] = self.GamR
+            eSmH = eSmH-block(self.SigR, nuo-nuoR)
+        return eSmH
+
+    def calcGF(self, ee, kpoint, ispin=0, etaLead=0.0, useSigNCfiles=False, SpectralCutoff=0.0, RGF=False):
+        """
+        Calculate GF etc at energy ee and 2d k-point
+        Only Gr is calculated here, the derived quantities AL, ALT, AR, ARGLG,
+        TT, GammaL and GammaR are evaluated on first use and kept until the
+        next call with a different (ee, kpoint, ispin, ...). Ga and A are not
+        stored but evaluated on each access (see memory_report).
+        With RGF=True the block-tridiagonal recursive Green's function solver
+        (see recursiveGF) is used instead of inverting the full device matrix.
+        Only the columns Gr[:, 0:nuoL], Gr[:, nuo-nuoR:nuo], the rows
+        Gr[0:nuoL, :] and the diagonal blocks GrDiag (orbitals RGFblocks)
+        are then computed and Gr/Ga are None. AL, ALT and AR are then kept
+        in the exact low-rank form L.R of a SpectralMatrix (rank nuoL/nuoR),
+        i.e., no nuo x nuo products are formed.
+        """
+        nuo, nuoL, nuoR = self.nuo, self.nuoL, self.nuoR
+
+        key = (ee, tuple(kpoint), ispin, etaLead, useSigNCfiles, SpectralCutoff, RGF)
+        if key == self.GFkey and not self.OrthogonalDeviceRegion:
+            # H, S are those of key as well (see setkpoint)
+            print('NEGF.calcGF: Reusing Green\'s function for ispin= %i e= %s'%(ispin, ee))
+            return
+        self.GFkey = None
+        self.__lazy = {}
+
+        eSmH = self.__calcESmH(ee, kpoint, ispin, etaLead, useSigNCfiles, SpectralCutoff, RGF)
+        if RGF:
+            self.RGFblocks = self.RGFsetup()[2]
+            self.GrL, self.GrR, self.GrLrow, self.GrDiag = recursiveGF(eSmH, nuoL, nuoR, self.RGFblocks)
+            self.Gr = None
+        else:
+            if self.sparse:
+                eSmH = eSmH.toarray()
+            self.Gr = LA.inv(eSmH)
+            # Views into Gr
+            self.GrL, self.GrR, self.GrLrow = self.Gr[:, 0:nuoL], self.Gr[:, nuo-nuoR:nuo], self.Gr[0:nuoL, :]
+        del eSmH
+        self.SpectralCutoff = SpectralCutoff
+        self.GFkey = key
+
+        TT = self.TT # evaluated once also if lean
+        print('NEGF.calcGF: Shape of transmission matrix (TT):', TT.shape)
+        print('NEGF.calcGF: Energy and total transmission Tr[TT].real:', ee, N.trace(TT).real)
+
+    def __getLazy(self, name, func):
+        # Derived quantities of calcGF, evaluated on first use
+        try:
+            return self.__lazy[name]
+        except KeyError:
+            pass
+        val = func()
+        if not self.lean:
+            self.__lazy[name] = val
+        return val
+
+    def __setLazy(self, name, val):
+        self.__lazy[name] = val
+
+    def __lowRank(self, L, R):
+        # Exact factorization L.R of a spectral function (no eigenvalue cutoff)
+        A = MM.SpectralMatrix()
+        A.L, A.R = L, R
+        return A
+
+    def __calcAL(self):
+        if self.Gr is None:
+            return self.__lowRank(MM.mm(self.GrL, self.GamL), MM.dagger(self.GrL))
+        AL = MM.mm(self.GrL, self.GamL, MM.dagger(self.GrL))
+        if self.SpectralCutoff > 0.0:
+            AL = MM.SpectralMatrix(AL, cutoff=self.SpectralCutoff)
+        return AL
+
+    def __calcALT(self):
+        if self.Gr is None:
+            return self.__lowRank(MM.mm(MM.dagger(self.GrLrow), self.GamL), self.GrLrow)
+        ALT = MM.mm(MM.dagger(self.GrLrow), self.GamL, self.GrLrow)
+        if self.SpectralCutoff > 0.0:
+            ALT = MM.SpectralMatrix(ALT, cutoff=self.SpectralCutoff)
+        return ALT
+
+    def __calcAR(self):
+        if self.Gr is None:
+            return self.__lowRank(MM.mm(self.GrR, self.GamR), MM.dagger(self.GrR))
+        AR = MM.mm(self.GrR, self.GamR, MM.dagger(self.GrR))
+        if self.SpectralCutoff > 0.0:
+            AR = MM.SpectralMatrix(AR, cutoff=self.SpectralCutoff)
+        return AR
+
+    def __calcARGLG(self):
+        tmp = MM.mm(self.GamL, self.GrLrow)
+        if isinstance(self.AR, MM.SpectralMatrix):
+            return MM.mm(self.AR.L, self.AR.R[:, 0:self.nuoL], tmp)
+        return MM.mm(self.AR[:, 0:self.nuoL], tmp)
+
+    def __calcTT(self):
+        # transmission matrix AL.GamR
+        nuo, nuoR = self.nuo, self.nuoR
+        if self.SpectralCutoff > 0.0:
+            return MM.mm(self.AL.R[:, nuo-nuoR:nuo], self.GamR, self.AL.L[nuo-nuoR:nuo, :])
+        if isinstance(self.__lazy.get('AL', None), N.ndarray):
+            return MM.mm(self.AL[nuo-nuoR:nuo, nuo-nuoR:nuo], self.GamR)
+        # Only the right electrode rows of Gr[:, 0:nuoL] are needed
+        GRL = self.GrL[nuo-nuoR:nuo, :]
+        return MM.mm(MM.mm(GRL, self.GamL, MM.dagger(GRL)), self.GamR)
+
+    def __calcGammaL(self):
+        # Gammas in the full space of Gr/Ga/A (needed for the inelastic shot noise)
+        nuoL = self.nuoL
+        GammaL = N.zeros((self.nuo, self.nuo), N.complex)
+        GammaL[0:nuoL, 0:nuoL] = self.GamL
+        return GammaL
+
+    def __calcGammaR(self):
+        nuo, nuoR = self.nuo, self.nuoR
+        GammaR = N.zeros((nuo, nuo), N.complex)
+        GammaR[nuo-nuoR:nuo, nuo-nuoR:nuo] = self.GamR
+        return GammaR
+
+    AL = property(lambda self: self.__getLazy('AL', self.__calcAL),
+                  lambda self, val: self.__setLazy('AL', val), doc="Left spectral function Gr.GamL.Ga")
+    ALT = property(lambda self: self.__getLazy('ALT', self.__calcALT),
+                   lambda self, val: self.__setLazy('ALT', val), doc="Ga.GamL.Gr")
+    AR = property(lambda self: self.__getLazy('AR', self.__calcAR),
+                  lambda self, val: self.__setLazy('AR', val), doc="Right spectral function Gr.GamR.Ga")
+    ARGLG = property(lambda self: self.__getLazy('ARGLG', self.__calcARGLG),
+                     lambda self, val: self.__setLazy('ARGLG', val), doc="AR.GamL.Gr")
+    TT = property(lambda self: self.__getLazy('TT', self.__calcTT),
+                  lambda self, val: self.__setLazy('TT', val), doc="Transmission matrix AL.GamR in the right electrode orbitals")
+    GammaL = property(lambda self: self.__getLazy('GammaL', self.__calcGammaL),
+                      lambda self, val: self.__setLazy('GammaL', val), doc="GamL in the full device space")
+    GammaR = property(lambda self: self.__getLazy('GammaR', self.__calcGammaR),
+                      lambda self, val: self.__setLazy('GammaR', val), doc="GamR in the full device space")
+
+    @property
+    def Ga(self):
+        "Advanced Green's function, evaluated on each access"
+        if self.Gr is None:
+            return None
+        return MM.dagger(self.Gr)
+
+    @property
+    def A(self):
+        "Spectral function AL+AR, evaluated on each access"
+        return self.AL+self.AR
+
+    def snapshot(self):
+        """
+        The derived quantities AL, ALT, AR and ARGLG of the last calcGF
+        (evaluated if needed) and its SigL, SigR, GamL, GamR for a later restore.
+        """
+        snap = dict((name, getattr(self, name)) for name in ['AL', 'ALT', 'AR', 'ARGLG'])
+        for name in ['SigL', 'SigR', 'GamL', 'GamR']:
+            snap[name] = getattr(self, name)
+        return snap
+
+    def restore(self, snapshot):
+        """
+        Reinstate the quantities of a snapshot (see snapshot) as if calcGF
+        had been called at its energy. TT, GammaL and GammaR are evaluated
+        from them on access, Gr is not available until the next calcGF.
+        """
+        self.GFkey = None
+        self.Gr = self.GrL = self.GrR = self.GrLrow = self.GrDiag = None
+        self.__lazy = {}
+        for name, val in snapshot.items():
+            if name in ['SigL', 'SigR', 'GamL', 'GamR']:
+                setattr(self, name, val)
+            else:
+                self.__lazy[name] = val
+
+    def memory_report(self):
+        """
+        Print the arrays currently held by the GF instance (including the
+        derived quantities of calcGF already evaluated) and return their
+        total size in MB.
+        """
+        arrays = list(self.__dict__.items())+[(k, v) for k, v in self.__lazy.items()]
+        total, seen = 0.0, set()
+        print('NEGF.GF.memory_report:')
+        for name, val in sorted(arrays, key=lambda x: x[0]):
+            if id(val) in seen: continue
+            seen.add(id(val))
+            if isinstance(val, MM.SpectralMatrix):
+                size, shape = val.L.nbytes+val.R.nbytes, '%s.%s'%(val.L.shape, val.R.shape)
+            elif isinstance(val, N.ndarray) and val.base is None:
+                size, shape = val.nbytes, str(val.shape)
+            elif isinstance(val, N.ndarray):
+                print('  %-12s %-20s view'%(name, val.shape))
+                continue
+            else:
+                continue
+            if size < 1024: continue
+            total += size/1024.**2
+            print('  %-12s %-20s %10.2f MB'%(name.replace('_GF__', ''), shape, size/1024.**2))
+        print('  Ga, A are not stored (evaluated on access)')
+        print('  Total %.2f MB'%total)
+        return total
+
+    def RGFsetup(self):
+        """
+        H, S as scipy.sparse CSR matrices and the RGF blocks (see blockPartition)
+        from their sparsity pattern, kept until H, S change (see setkpoint)
+        """
+        import scipy.sparse as SS
+        if self.RGFinput is None:
+            H, S = SS.csr_matrix(self.H), SS.csr_matrix(self.S)
+            blocks = blockPartition(abs(H)+abs(S), self.nuoL, self.nuoR)
+            sizes = [len(b) for b in blocks]
+            print('NEGF.GF: RGF with %i blocks of %i-%i orbitals'%(len(blocks), min(sizes), max(sizes)))
+            self.RGFinput = (H, S, blocks)
+        return self.RGFinput
 
     def setkpoint(self, kpoint, ispin=0):
         # Initiate H, S to correct kpoint
         nuo, nuoL, nuoR = self.nuo0, self.nuoL0, self.nuoR0
+        # H, S are kept until kpoint or ispin changes
+        key = (tuple(N.array(kpoint, N.float)), ispin)
+        if key == self.HSkey and not self.OrthogonalDeviceRegion:
+            return
+        # The Green's function of calcGF (if any) is not for the new H, S
+        self.HSkey, self.GFkey, self.RGFinput = None, None, None
 
         kpoint3 = N.zeros((3), N.float)
         kpoint3[0:2] = kpoint[:]
-        self.HS.setkpoint(kpoint3, verbose=False)
+        self.HS.setkpoint(kpoint3, verbose=False, sparse=self.sparse)
         # Remove PBC in z-direction
-        if self.HS.gamma:
+        if self.HS.gamma and self.sparse:
+            # Remove direct left/right coupling
+            self.H0 = self.__removeLR(self.HS.H[ispin])
+            self.S0 = self.__removeLR(self.HS.S)
+        elif self.HS.gamma:
             self.H0 = self.HS.H[ispin, :, :].copy()
             self.S0 = self.HS.S.copy()
             # Remove direct left/right coupling
@@ -768,7 +1463,7 @@ class GF(object):
             self.S0[nuo-nuoR:nuo, 0:nuoL] = 0.
         else:
             # Do trick with kz
-            tmpH, tmpS = self.HS.H[ispin, :, :].copy(), self.HS.S.copy()
+            tmpH, tmpS = self.HS.H[ispin].copy(), self.HS.S.copy()
             if self.elecL.semiinf == 0 and self.elecR.semiinf == 0:
                 # Periodicity along A1
                 if kpoint[0] == 0.0:
@@ -786,8 +1481,8 @@ class GF(object):
             else:
                 # Default is along A3
                 kpoint3[2] = 0.5
-            self.HS.setkpoint(kpoint3, verbose=False)
-            self.H0 = 0.5 * (tmpH + self.HS.H[ispin, :, :])
+            self.HS.setkpoint(kpoint3, verbose=False, sparse=self.sparse)
+            self.H0 = 0.5 * (tmpH + self.HS.H[ispin])
             self.S0 = 0.5 * (tmpS + self.HS.S)
 
         if self.FoldedL or self.FoldedR:
@@ -798,6 +1493,16 @@ class GF(object):
             self.H, self.S = self.H0, self.S0
 
         self.OrthogonalDeviceRegion = False
+        self.HSkey = key
+
+    def __removeLR(self, M):
+        "Sparse matrix M without the elements coupling the left/right electrode orbitals directly"
+        nuo, nuoL, nuoR = self.nuo0, self.nuoL0, self.nuoR0
+        M = M.tocoo()
+        keep = N.logical_not(N.logical_or(N.logical_and(M.row < nuoL, M.col >= nuo-nuoR),
+                                          N.logical_and(M.row >= nuo-nuoR, M.col < nuoL)))
+        M.data, M.row, M.col = M.data[keep], M.row[keep], M.col[keep]
+        return M.tocsr()
 
     def calcTEIG(self, channels=10):
         # Transmission matrix (complex array)
@@ -812,7 +1517,7 @@ class GF(object):
         tvec = tvec[:, idx]
         # Compute shot noise
         Smat = MM.mm(TT, N.identity(len(TT))-TT)
-        sval = N.diag(MM.mm(MM.dagger(tvec), Smat, tvec))
+        sval = MM.diag_mm(MM.dagger(tvec), Smat, tvec)
         # set up arrays
         T = N.zeros(channels+1)
         SN = N.zeros(channels+1)
@@ -823,9 +1528,43 @@ class GF(object):
             SN[i+1] = sval[i].real
         return T, SN
 
+    def calcTransmission(self, ee, kpoint, ispin=0, etaLead=0.0, useSigNCfiles=False, channels=10, RGF=False):
+        """
+        Transmission-only fast path of calcGF+calcTEIG at energy ee and 2d k-point.
+        Only the columns Gr[:, 0:nuoL] are obtained (LU solve, or recursiveGF
+        if RGF=True) and the nuoR x nuoR transmission matrix TT is formed directly
+        from G_RL. Gr, AL, AR etc are not computed.
+        Returns T, SN as calcTEIG: total and eigenchannel transmissions and shot noise.
+        """
+        nuo, nuoL, nuoR = self.nuo, self.nuoL, self.nuoR
+
+        # Gr and its derived quantities are not available after this
+        self.GFkey, self.__lazy = None, {}
+        self.Gr, self.GrL, self.GrR, self.GrLrow = None, None, None, None
+
+        eSmH = self.__calcESmH(ee, kpoint, ispin, etaLead, useSigNCfiles, RGF=RGF)
+        if RGF:
+            GRL = recursiveGF(eSmH, nuoL, nuoR, self.RGFsetup()[2])[0][nuo-nuoR:nuo, :]
+        else:
+            unit = N.zeros((nuo, nuoL), N.complex)
+            unit[0:nuoL, 0:nuoL] = N.eye(nuoL)
+            if self.sparse:
+                eSmH = eSmH.toarray()
+            GRL = LA.solve(eSmH, unit)[nuo-nuoR:nuo, :]
+        # Transmission matrix G_RL.GamL.G_RL^+.GamR has the eigenvalues of t.t^+ with
+        # t = GamR^1/2 G_RL GamL^1/2, but GamL/GamR need not be positive definite
+        self.TT = MM.mm(GRL, self.GamL, MM.dagger(GRL), self.GamR)
+        T, SN = self.calcTEIG(channels)
+        print('NEGF.calcTransmission: Energy and total transmission:', ee, T[0])
+        return T, SN
+
     def orthogonalize(self):
         print('NEGF.GF.orthogonalize: Orthogonalizing device region quantities')
+        # Spectral functions etc remain in the nonorthogonal basis
+        for name in ['AL', 'ALT', 'AR', 'ARGLG', 'TT', 'GammaL', 'GammaR']:
+            self.__lazy[name] = getattr(self, name)
         self.OrthogonalDeviceRegion = True
+        self.RGFinput = None
         self.HNO = self.H.copy() # nonorthogonal device Hamiltonian (needed)
 
         # Device part
@@ -852,7 +1591,8 @@ class GF(object):
 
         # Orthogonalize Greens functions
         self.Gr = MM.mm(Usi, self.Gr, Usi)
-        self.Ga = MM.dagger(self.Gr)
+        nuo, nuoL, nuoR = self.nuo, self.nuoL, self.nuoR
+        self.GrL, self.GrR, self.GrLrow = self.Gr[:, 0:nuoL], self.Gr[:, nuo-nuoR:nuo], self.Gr[0:nuoL, :]
 
     def __calcEigChan(self, A1, G2, Left, channels=10):
         # Calculate Eigenchannels using recipe from PRB
@@ -145,6 +145,10 @@ def GetOptions(argv):
                    help='k-point along a3 where e-ph couplings are evaluated [%(default)s]')
     p.add_argument('-g', '--WriteGradients', dest='WriteGradients', action='store_true', default=False,
                    help='Write real-space gradients dH/dR to NetCDF [default=%(default)s]')
+    p.add_argument('--sparse', dest='sparse', action='store_true', default=False,
+                   help='Assemble the displaced Hamiltonians as sparse matrices when computing the gradients dH/dR (saves memory for large systems) [default=%(default)s]')
+    p.add_argument('--HScache', dest='HScache', default=False, action='store_true',
+                   help='Keep the parsed TSHS files in sidecar caches (<file>.cache directories) for a faster startup of subsequent runs [default=%(default)s]')
 
     options = p.parse_args(argv)
 
@@ -327,7 +331,7 @@ class OTSrun(FCrun): # Only TranSiesta run
 
 class OSrun(object):
 
-    def __init__(self, onlySdir, kpoint, atype=N.complex):
+    def __init__(self, onlySdir, kpoint, atype=N.complex, cache=False):
         print('Phonons.GetOnlyS: Reading from: ' + onlySdir)
         onlySfiles = glob.glob(onlySdir+'/*.onlyS*')
         onlySfiles.sort()
@@ -339,7 +343,7 @@ class OSrun(object):
             onlyS = {}
             Displ = {}
             for file in onlySfiles:
-                thisHS = SIO.HS(file)
+                thisHS = SIO.HS(file, cache=cache)
                 thisHS.setkpoint(kpoint, atype=atype)
                 S = thisHS.S
                 del thisHS
@@ -530,15 +534,17 @@ class DynamicalMatrix(object):
         self.UUdisp = UUdisp
         self.UUcl = UUcl
 
-    def PrepareGradients(self, onlySdir, kpoint, DeviceFirst, DeviceLast, AbsEref, atype, TSrun=False):
+    def PrepareGradients(self, onlySdir, kpoint, DeviceFirst, DeviceLast, AbsEref, atype, TSrun=False, sparse=False,
+                         HScache=False):
         print('\nPhonons.PrepareGradients: Setting up various arrays')
         self.atype = atype
+        self.HScache = HScache # Read the TSHS files through sidecar caches
         self.kpoint = kpoint
         self.OrbIndx, nao = self.FCRs[0].GetOrbitalIndices()
-        self.TSHS0 = SIO.HS(self.TSHS[0])
+        self.TSHS0 = SIO.SharedHS(self.TSHS[0], cache=HScache)
         self.TSHS0.setkpoint(kpoint, atype=atype)
         if not TSrun:
-            OS = OSrun(onlySdir, kpoint, atype=atype)
+            OS = OSrun(onlySdir, kpoint, atype=atype, cache=HScache)
             self.dS = OS.dS
             # OS.S0 and TSHS0.S should be identical, but with some versions/compilations
             # of TranSIESTA this is NOT always the case away from k=0 (GammaPoint is OK).
@@ -565,22 +571,29 @@ class DynamicalMatrix(object):
         self.DeviceFirst = DeviceFirst
         self.DeviceLast = DeviceLast
         self.AbsEref = AbsEref
+        self.sparse = sparse
 
     def GetGradient(self, Atom, Axis):
         print('\nPhonons.GetGradient: Computing dH[%i,%i]'%(Atom, Axis))
         # Read TSHS files
-        TSHSm = SIO.HS(self.TSHS[Atom, Axis, -1])
-        TSHSm.setkpoint(self.kpoint, atype=self.atype)
-        TSHSp = SIO.HS(self.TSHS[Atom, Axis, 1])
-        TSHSp.setkpoint(self.kpoint, atype=self.atype)
+        TSHSm = SIO.SharedHS(self.TSHS[Atom, Axis, -1], cache=self.HScache)
+        TSHSm.setkpoint(self.kpoint, atype=self.atype, sparse=self.sparse)
+        TSHSp = SIO.SharedHS(self.TSHS[Atom, Axis, 1], cache=self.HScache)
+        TSHSp.setkpoint(self.kpoint, atype=self.atype, sparse=self.sparse)
         # Use Fermi energy of equilibrium calculation as energy reference?
         if self.AbsEref:
             print('Computing gradient with absolute energy reference')
             for iSpin in range(self.nspin):
-                TSHSm.H[iSpin, :, :] += (TSHSm.ef-self.TSHS0.ef)*TSHSm.S
-                TSHSp.H[iSpin, :, :] += (TSHSp.ef-self.TSHS0.ef)*TSHSp.S
+                TSHSm.H[iSpin] = TSHSm.H[iSpin]+(TSHSm.ef-self.TSHS0.ef)*TSHSm.S
+                TSHSp.H[iSpin] = TSHSp.H[iSpin]+(TSHSp.ef-self.TSHS0.ef)*TSHSp.S
         # Compute direct gradient
-        dH = (TSHSp.H-TSHSm.H)/(2*self.Displ[Atom])
+        if self.sparse:
+            # Only the difference is stored as a dense matrix
+            dH = N.empty(self.invS0H0.shape[1:], self.atype)
+            for iSpin in range(self.nspin):
+                dH[iSpin, :, :] = (TSHSp.H[iSpin]-TSHSm.H[iSpin]).toarray()/(2*self.Displ[Atom])
+        else:
+            dH = (TSHSp.H-TSHSm.H)/(2*self.Displ[Atom])
         del TSHSm, TSHSp
         # Orbital range for the displaced atom:
         f, l = self.OrbIndx[Atom-1]
@@ -905,7 +918,8 @@ def main(options):
     DM.ComputePhononModes(DM.mean)
     # Compute e-ph coupling
     if options.CalcCoupl:
-        DM.PrepareGradients(options.onlySdir, options.kpoint, options.DeviceFirst, options.DeviceLast, options.AbsEref, options.atype)
+        DM.PrepareGradients(options.onlySdir, options.kpoint, options.DeviceFirst, options.DeviceLast, options.AbsEref, options.atype,
+                            sparse=options.sparse, HScache=options.HScache)
         DM.ComputeEPHcouplings(options.PBCFirst, options.PBCLast, options.EPHAtoms, options.Restart, options.CheckPointNetCDF,
                                WriteGradients=options.WriteGradients)
     # Write data to files
@@ -37,6 +37,7 @@ import sys
 import glob
 import os
 import ast
+import copy
 import time
 import Inelastica.misc.valuecheck as VC
 import Inelastica.io.log as Log
@@ -108,6 +109,8 @@ def GetOptions(argv):
     # Use spectral matrices?
     p.add_option("--SpectralCutoff", dest="SpectralCutoff", help="Cutoff value for SpectralMatrix functions (for ordinary matrix representation set cutoff<=0.0) [default=%default]",
                  type='float', default=0.0)
+    p.add_option("--RGF", dest='RGF', default=False, action='store_true',
+                 help="Use the block-tridiagonal recursive Green's function solver instead of inverting the full device matrix [%default]")
     p.add_option("-n", "--nCPU", dest='nCPU', default=1, type='int',
                  help="Number of processors [%default]")
 
@@ -128,6 +131,8 @@ def GetOptions(argv):
                  help="Tolerance for the iterative linear solver (scipy.linalg.isolve.gmres) [default=%default]")
     p.add_option("--savelocwfs", dest='savelocwfs', default=False, action='store_true',
                  help="Save localized-basis wave functions.")
+    p.add_option("--HScache", dest='HScache', default=False, action='store_true',
+                 help="Keep the parsed TSHS files in sidecar caches (<file>.cache directories) for a faster startup of subsequent runs [default=%default]")
 
     (options, args) = p.parse_args(argv)
 
@@ -192,8 +197,12 @@ def main(options):
             print('(...by possibly using saved localized-basis states)\n')
         else:
             print('STM calculation starts.')
-    args = [(options, ik) for ik in doK]
-    tmp = MP.runParallel(calcTSWFPar, args, nCPU=options.nCPU)
+    if len(doK) > 0:
+        # Read the inputs common to all k-points once, the workers share them
+        shared = readSharedInputs(options)
+        args = [(options, ik, shared) for ik in doK]
+        tmp = MP.runParallel(calcTSWFPar, args, nCPU=options.nCPU)
+        MP.freeShared(shared)
 
     print('Calculating k-point averaged STM image')
 
@@ -259,8 +268,82 @@ def main(options):
 ########################################################
 
 
-def calcTSWF(options, ikpoint):
+def readSharedInputs(options):
+    """
+    Read the inputs common to all k-points once in the main process: the
+    TSHS files, the basis and the TotalPotential/Rho grids. The large
+    arrays are copied to shared memory blocks (see misc.multiproc) and
+    the main process keeps only the blocks, the k-point workers attach
+    zero-copy views of them (see attachSharedInputs).
+    Returns the (picklable) shared inputs, free with MP.freeShared.
+    """
+    shared = {'HS': []}
+    names = ['Hsparse', 'Ssparse', 'xij', 'listh', 'numh', 'listhptr', 'sparseRows', 'sparseCols']
+    keys = []
+    for fn, BufferAtoms in [(options.fnL, N.empty((0,))), (options.fnR, N.empty((0,))),
+                            (options.TSHS, options.buffer), (options.systemlabel+'.TSHS', N.empty((0,)))]:
+        key = SIO.SharedHSkey(fn, BufferAtoms)
+        if key in keys:
+            continue
+        keys += [key]
+        HS = SIO.HS(fn, BufferAtoms=BufferAtoms, cache=options.HScache)
+        arrays = MP.shareArrays(HS, names)
+        for name in arrays:
+            setattr(HS, name, None) # Keep only the shared copy
+        shared['HS'] += [(fn, BufferAtoms, HS, arrays)]
+        if fn == options.TSHS:
+            nua, lasto = HS.nua, HS.lasto
+        if fn == options.systemlabel+'.TSHS':
+            shared['Ef'] = HS.ef
+
+    # Basis of the device region
+    L = options.bufferL
+    #Pad lasto with zeroes to enable basis generation...
+    tmp = N.zeros((nua+L+1,), N.int)
+    tmp[L:] = lasto
+    basis = SIO.BuildBasis(options.fn,
+                           options.DeviceAtoms[0]+L,
+                           options.DeviceAtoms[1]+L, tmp)
+    basis.ii -= L
+    arrays = MP.shareArrays(basis, ['ii', 'L', 'M', 'delta', 'coff', 'orb'])
+    for name in arrays:
+        setattr(basis, name, None)
+    shared['basis'] = (basis, arrays)
+
+    # Grids
+    print('Reading potential from:    TotalPotential.grid.nc')
+    file = NC.Dataset('TotalPotential.grid.nc', 'r')
+    shared['NN'] = [len(file.dimensions['n1']), len(file.dimensions['n2']), len(file.dimensions['n3'])]
+    shared['cell'] = N.array(file.variables['cell'][:], N.float)
+    shared['pot'] = MP.SharedArray(N.array(file.variables['gridfunc'][0], N.float))
+    file.close()
+    print('Reading DFT density from:  Rho.grid.nc')
+    file = NC.Dataset('Rho.grid.nc', 'r')
+    shared['rho'] = MP.SharedArray(N.array(file.variables['gridfunc'][0], N.float))
+    file.close()
+    return shared
+
+
+def attachSharedInputs(shared):
+    """
+    Inputs of a k-point worker from the shared inputs of readSharedInputs.
+    The TSHS instances are registered with io.siesta.SharedHS, i.e., the
+    NEGF electrodes and device GF use them without reading the files.
+    """
+    inputs = {'HS': [], 'Ef': shared['Ef'], 'NN': shared['NN'], 'cell': shared['cell']}
+    for fn, BufferAtoms, HS, arrays in shared['HS']:
+        HS = MP.attachArrays(copy.copy(HS), arrays)
+        SIO.registerSharedHS(HS, fn, BufferAtoms)
+        inputs['HS'] += [HS] # Keeps the registry entries alive
+    basis, arrays = shared['basis']
+    inputs['basis'] = MP.attachArrays(copy.copy(basis), arrays)
+    inputs['pot'], inputs['rho'] = shared['pot'].array, shared['rho'].array
+    return inputs
+
+
+def calcTSWF(options, ikpoint, shared):
     kpoint = options.kpoints.k[ikpoint]
+    inputs = attachSharedInputs(shared)
 
     def calcandwrite(A, txt, kpoint, ikpoint):
         if isinstance(A, MM.SpectralMatrix):
@@ -298,7 +381,7 @@ def calcTSWF(options, ikpoint):
             print('------------------------------------------------------')
             print('Finite-difference calculation of vacuum states starts!')
             timeFD = time.clock()
-            STMFD.main(options, kpoint, ikpoint)
+            STMFD.main(options, kpoint, ikpoint, inputs)
             print('FD calculation in k-point folder '+str(ikpoint)+'/ done in '+str(N.round((time.clock()-timeFD)/60, 2))+' min.')
             print('------------------------------------------------------')
             if options.savelocwfs == False:
@@ -309,37 +392,28 @@ def calcTSWF(options, ikpoint):
     geom = MG.Geom(XV, BufferAtoms=options.buffer)
 
     #Set up device Greens function
-    elecL = NEGF.ElectrodeSelfEnergy(options.fnL, options.NA1L, options.NA2L, options.voltage/2.)
+    elecL = NEGF.ElectrodeSelfEnergy(options.fnL, options.NA1L, options.NA2L, options.voltage/2., TSHScache=options.HScache)
     elecL.scaling = options.scaleSigL
     elecL.semiinf = options.semiinfL
-    elecR = NEGF.ElectrodeSelfEnergy(options.fnR, options.NA1R, options.NA2R, -options.voltage/2.)
+    elecR = NEGF.ElectrodeSelfEnergy(options.fnR, options.NA1R, options.NA2R, -options.voltage/2., TSHScache=options.HScache)
     elecR.scaling = options.scaleSigR
     elecR.semiinf = options.semiinfR
     DevGF = NEGF.GF(options.TSHS, elecL, elecR, Bulk=options.UseBulk,
                     DeviceAtoms=options.DeviceAtoms,
-                    BufferAtoms=options.buffer)
+                    BufferAtoms=options.buffer, TSHScache=options.HScache)
 
     DevGF.calcGF(options.energy+options.eta*1.0j, kpoint[0:2], ispin=options.iSpin,
-                 etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff)
+                 etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff,
+                 RGF=options.RGF)
     NEGF.SavedSig.close() #Make sure saved Sigma is written to file
     #Transmission
     print('Transmission Ttot(%.4feV) = %.16f'%(options.energy, N.trace(DevGF.TT).real))
 
-    #Build basis
+    #Basis and grid (see readSharedInputs)
     options.nspin = DevGF.HS.nspin
-    L = options.bufferL
-    #Pad lasto with zeroes to enable basis generation...
-    lasto = N.zeros((DevGF.HS.nua+L+1,), N.int)
-    lasto[L:] = DevGF.HS.lasto
-    basis = SIO.BuildBasis(options.fn,
-                           options.DeviceAtoms[0]+L,
-                           options.DeviceAtoms[1]+L, lasto)
-    basis.ii -= L
-
-    file = NC.Dataset('TotalPotential.grid.nc', 'r')
-    N1, N2, N3 = len(file.dimensions['n1']), len(file.dimensions['n2']), len(file.dimensions['n3'])
-    cell = file.variables['cell'][:]
-    file.close()
+    basis = inputs['basis']
+    N1, N2, N3 = inputs['NN']
+    cell = inputs['cell']
 
     #Find device region in a3 axis
     U = LA.inv(N.array([cell[0]/N1, cell[1]/N2, cell[2]/N3]).transpose())
@@ -355,8 +429,8 @@ def calcTSWF(options, ikpoint):
     calcandwrite(DevGF.AR, 'AR', kpoint, ikpoint)
 
 
-def calcTSWFPar(resQue, ii, options, ik):
-    calcTSWF(options, ik)
+def calcTSWFPar(resQue, ii, options, ik, shared):
+    calcTSWF(options, ik, shared)
     resQue.put((ii, True))
 
 
@@ -24,8 +24,12 @@ import Inelastica.physics.constants as PC
 import Inelastica.io.siesta as SIO
 
 
-def main(options, kpoint, ikpoint):
-    Ef = SIO.HS(options.systemlabel+'.TSHS').ef/PC.Rydberg2eV
+def main(options, kpoint, ikpoint, inputs=None):
+    # inputs: common inputs read by STM.readSharedInputs (Ef, pot, rho)
+    if inputs is None:
+        Ef = SIO.HS(options.systemlabel+'.TSHS').ef/PC.Rydberg2eV
+    else:
+        Ef = inputs['Ef']/PC.Rydberg2eV
     kpt = ikpoint
     pathkpt = './'+options.DestDir+'/'+str(kpt)+'/'
     print('k-point: '+str(ikpoint)+'/')
@@ -36,7 +40,7 @@ def main(options, kpoint, ikpoint):
     posZMol, posZTip = LayersAndTipheight(options, kpoint, ikpoint)
 
     #Read total potential, loc-basis states, lattice constants etc.
-    tmp = readDFT(options, kpoint, pathkpt, posZMol, posZTip)
+    tmp = readDFT(options, kpoint, pathkpt, posZMol, posZTip, inputs)
     Subwfs, Tipwfs, Vsub, Vtip = tmp[0], tmp[1], tmp[2], tmp[3]
     scSize, ucSize, Max, dS, theta = tmp[4], tmp[5], tmp[6], tmp[7], tmp[8]
     SubChans, TipChans, SubPot, TipPot, SubRho, TipRho, MeshCutoff = tmp[9], tmp[10], tmp[11], tmp[12], tmp[13], tmp[14], tmp[15]
@@ -145,14 +149,17 @@ def LayersAndTipheight(options, kpoint, ikpoint):
     return posZMol, posZTip
 
 
-def readDFT(options, kpt, pathkpt, posZMol, posZTip):
-    ncfile = NC.Dataset('TotalPotential.grid.nc', 'r')
-    print('\nReading potential from:    TotalPotential.grid.nc')
-    pot = N.array(ncfile.variables['gridfunc'][:], N.float)[0]
+def readDFT(options, kpt, pathkpt, posZMol, posZTip, inputs=None):
+    if inputs is None:
+        ncfile = NC.Dataset('TotalPotential.grid.nc', 'r')
+        print('\nReading potential from:    TotalPotential.grid.nc')
+        pot = N.array(ncfile.variables['gridfunc'][:], N.float)[0]
 
-    print('Reading DFT density from:  Rho.grid.nc')
-    ncfile = NC.Dataset('Rho.grid.nc', 'r')
-    rho = N.array(ncfile.variables['gridfunc'][:], N.float)[0]
+        print('Reading DFT density from:  Rho.grid.nc')
+        ncfile = NC.Dataset('Rho.grid.nc', 'r')
+        rho = N.array(ncfile.variables['gridfunc'][:], N.float)[0]
+    else: # Shared with the other k-points
+        pot, rho = inputs['pot'], inputs['rho']
 
     #Import supercell grid from one localized-basis state
     tmp = NC.Dataset(pathkpt+options.systemlabel+'.AL0.nc', 'r')
@@ -84,6 +84,8 @@ def GetOptions(argv):
                  help='Number of electronic bands to be included in netCDF output (lower energy bands) [default=%(default)s]')
     p.add_argument('--FermiSurface', dest='FermiSurface', action='store_true', default=False,
                  help='Write FermiSurface.BXSF file for visualization of the Fermi surface? [default=%(default)s]')
+    p.add_argument('--kBatch', dest='kBatch', type=int, default=64,
+                 help='Number of electronic k-points for which the Hamiltonian is assembled at once (with --TSdir) [default=%(default)s]')
 
     options = p.parse_args(argv)
 
@@ -195,8 +197,20 @@ class Supercell_DynamicalMatrix(PH.DynamicalMatrix):
                 H_k[..., fmb:lmb+1, fnb:lnb+1] += phase*H[..., fm:lm+1, fn:ln+1]
         return H_k
 
-    def ComputeElectronStates(self, kpoint, verbose=True, TSrun=False):
-        if TSrun:
+    def ElectronHSBatch(self, kpoints):
+        # H, S (TSrun) for a list of k-points with unit of '2*pi/a'
+        # assembled at once, see io.siesta.HS.setkpoints
+        kpt = N.array(kpoints)/(2*N.pi)
+        kpt2 = MM.mm(kpt, N.transpose(N.array([self.Sym.a1, self.Sym.a2, self.Sym.a3])))
+        return self.TSHS0.setkpoints(kpt2, atype=N.complex)
+
+    def ComputeElectronStates(self, kpoint, verbose=True, TSrun=False, HSk=None):
+        if TSrun and HSk is not None:
+            # H, S from ElectronHSBatch
+            if verbose:
+                print('SupercellPhonons.ComputeElectronStates: k = ', kpoint, '(1/Ang)')
+            self.h0_k, self.s0_k = HSk
+        elif TSrun:
             # kpoint has unit of '2*pi/a'
             kpt = kpoint/(2*N.pi)
             kpt2 = MM.mm(N.array([self.Sym.a1, self.Sym.a2, self.Sym.a3]), kpt)
@@ -536,10 +550,16 @@ def main(options):
         ncf.sync()
         # Loop over kpoints
         for i, k in enumerate(kpts):
+            HSk = None
+            if TSrun:
+                # Assemble H, S for the next batch of k-points
+                if i%options.kBatch == 0:
+                    Hbatch, Sbatch = SCDM.ElectronHSBatch(kpts[i:i+options.kBatch])
+                HSk = (Hbatch[i%options.kBatch], Sbatch[i%options.kBatch])
             if i < 100: # Print only for the first 100 points
-                ev, evec = SCDM.ComputeElectronStates(k, verbose=True, TSrun=TSrun)
+                ev, evec = SCDM.ComputeElectronStates(k, verbose=True, TSrun=TSrun, HSk=HSk)
             else:
-                ev, evec = SCDM.ComputeElectronStates(k, verbose=False, TSrun=TSrun)
+                ev, evec = SCDM.ComputeElectronStates(k, verbose=False, TSrun=TSrun, HSk=HSk)
                 # otherwise something simple
                 if i%100 == 0: print('%i out of %i k-points computed'%(i, len(kpts)))
             if i == 0:
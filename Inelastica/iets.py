@@ -32,8 +32,11 @@ Classes
 from __future__ import print_function
 
 import numpy as N
+import numpy.linalg as LA
 import netCDF4 as NC4
 import sys
+import threading
+import collections
 import Inelastica.physics.constants as PC
 import Inelastica.misc.valuecheck as VC
 import Inelastica.io.log as Log
@@ -119,6 +122,22 @@ def GetOptions(argv):
                    help='Scale factor to interpolate between LOE-WBA (0.0) and generalized LOE (1.0), see PRB 89, 081405(R) (2014) [default: %(default)s]')
     p.add_argument('--VfracL', dest='VfracL', type=float, default=0.5,
                    help='Voltage fraction over the left-center interface [default: %(default)s]')
+    p.add_argument('--SigBatch', dest='SigBatch', type=int, default=0,
+                   help='Number of phonon modes for which the electrode self-energies are computed together in one vectorized pass (0 = one energy at a time) [default: %(default)s]')
+    p.add_argument('--SigCacheMB', dest='SigCacheMB', type=float, default=256.0,
+                   help='Memory budget (MB) per electrode for reusing recently computed self-energies [default: %(default)s]')
+    p.add_argument('--HScache', dest='HScache', default=False, action='store_true',
+                   help='Keep the parsed TSHS files in sidecar caches (<file>.cache directories) for a faster startup of subsequent runs [default: %(default)s]')
+    p.add_argument('--lean', dest='lean', default=False, action='store_true',
+                   help='Do not keep the spectral functions AL, AR etc of the Green\'s functions once used, i.e., evaluate them on each access (less memory for large devices, more time) [default: %(default)s]')
+    p.add_argument('--GFsnap', dest='GFsnap', type=float, default=0.0,
+                   help='Energy tolerance (eV) within which the generalized LOE reuses the Green\'s function of a nearby, already computed energy (0 = no reuse) [default: %(default)s]')
+    p.add_argument('--GFCacheMB', dest='GFCacheMB', type=float, default=1024.0,
+                   help='Memory budget (MB) for the Green\'s functions kept for reuse between phonon modes with --GFsnap > 0 (generalized LOE) [default: %(default)s]')
+    p.add_argument('--ModeScreen', dest='modeScreen', type=float, default=0.0,
+                   help='Skip the phonon modes whose ||M||_F^2 is below this fraction of the largest one, i.e., whose e-ph traces are bounded by this fraction of the largest bound (4 ||M||_F^2 times the largest spectral norm squared of the GF quantities, taken at the Fermi energy: a bound for LOEscale=0, an estimate for the generalized LOE), the skipped modes are reported in DestDir/<SystemLabel>.IN.screen (0 = no screening) [default: %(default)s]')
+    p.add_argument('--PhBatchMB', dest='PhBatchMB', type=float, default=512.0,
+                   help='Memory cap (MB) for the block of phonon modes whose e-ph couplings are read (and for LOE-WBA evaluated) together [default: %(default)s]')
 
     # Parse the options
     options = p.parse_args(argv)
@@ -151,10 +170,12 @@ def main(options):
     VfracL = options.VfracL # default is 0.5
     print('Inelastica: Voltage fraction over left-center interface: VfracL =', VfracL)
     # Set up electrodes and device Greens function
-    elecL = NEGF.ElectrodeSelfEnergy(options.fnL, options.NA1L, options.NA2L, options.voltage*VfracL)
+    elecL = NEGF.ElectrodeSelfEnergy(options.fnL, options.NA1L, options.NA2L, options.voltage*VfracL, cacheMB=options.SigCacheMB,
+                                     TSHScache=options.HScache)
     elecL.scaling = options.scaleSigL
     elecL.semiinf = options.semiinfL
-    elecR = NEGF.ElectrodeSelfEnergy(options.fnR, options.NA1R, options.NA2R, options.voltage*(VfracL-1.))
+    elecR = NEGF.ElectrodeSelfEnergy(options.fnR, options.NA1R, options.NA2R, options.voltage*(VfracL-1.), cacheMB=options.SigCacheMB,
+                                     TSHScache=options.HScache)
     elecR.scaling = options.scaleSigR
     elecR.semiinf = options.semiinfR
     # Read phonons
@@ -164,7 +185,8 @@ def main(options):
     # Work with GFs etc for positive (V>0: \mu_L>\mu_R) and negative (V<0: \mu_L<\mu_R) bias voltages
     GFp = NEGF.GF(options.TSHS, elecL, elecR,
                   Bulk=options.UseBulk, DeviceAtoms=options.DeviceAtoms,
-                  BufferAtoms=options.buffer)
+                  BufferAtoms=options.buffer, TSHScache=options.HScache,
+                  lean=options.lean)
     # Prepare lists for various trace factors
     #GF.dGnout = []
     #GF.dGnin = []
@@ -181,7 +203,8 @@ def main(options):
     #
     GFm = NEGF.GF(options.TSHS, elecL, elecR,
                   Bulk=options.UseBulk, DeviceAtoms=options.DeviceAtoms,
-                  BufferAtoms=options.buffer)
+                  BufferAtoms=options.buffer, TSHScache=options.HScache,
+                  lean=options.lean)
     GFm.P1T = N.zeros(len(hw), N.float)     # M.A.M.A (total e-h damping)
     GFm.P2T = N.zeros(len(hw), N.float)     # M.AL.M.AR (emission)
     GFm.ehDampL = N.zeros(len(hw), N.float) # M.AL.M.AL (L e-h damping)
@@ -206,6 +229,8 @@ def main(options):
     GFm.TeF = TeF
     # Check consistency of PHrun vs TSrun inputs
     IntegrityCheck(options, GFp, NCfile)
+    # Modes to compute, the traces of skipped modes remain zero
+    modes, kept = screenModes(options, GFp, NCfile, hw, (hw > options.modeCutoff).nonzero()[0])
     # Calculate trace factors one mode at a time
     print('Inelastica: LOEscale =', options.LOEscale)
     if options.LOEscale == 0.0:
@@ -214,35 +239,140 @@ def main(options):
                    etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff)
         GFm.calcGF(options.energy+options.eta*1.0j, options.kpoint[0:2], ispin=options.iSpin,
                    etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff)
-        for ihw in (hw > options.modeCutoff).nonzero()[0]:
-            calcTraces(options, GFp, GFm, basis, NCfile, ihw)
-            calcTraces(options, GFm, GFp, basis, NCfile, ihw)
+        # Same GFs for all modes, i.e., the traces are evaluated for blocks of modes
+        for ihws, Ms in readCouplings(options, NCfile, modes, GFp.nuo, copies=12, kept=kept):
+            calcTracesBatch(options, GFp, GFm, Ms, ihws)
+            calcTracesBatch(options, GFm, GFp, Ms, ihws)
+            for ihw, M in zip(ihws, Ms):
+                calcNoiseTraces(options, GFp, GFm, M, ihw)
+                calcNoiseTraces(options, GFm, GFp, M, ihw)
         writeFGRrates(options, GFp, hw, NCfile)
     else:
         # LOEscale=1.0 => Generalized LOE, PRB 89, 081405(R) (2014) [arXiv:1312.7625]
-        for ihw in (hw > options.modeCutoff).nonzero()[0]:
-            GFp.calcGF(options.energy+hw[ihw]*options.LOEscale*VfracL+options.eta*1.0j, options.kpoint[0:2], ispin=options.iSpin,
-                       etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff)
-            GFm.calcGF(options.energy+hw[ihw]*options.LOEscale*(VfracL-1.)+options.eta*1.0j, options.kpoint[0:2], ispin=options.iSpin,
-                       etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff)
-            calcTraces(options, GFp, GFm, basis, NCfile, ihw)
+        # GFp and GFm only differ in the energy, i.e., they share the snapshots
+        if options.GFsnap > 0:
+            snaps = GFSnapshots(options, tol=options.GFsnap, maxMB=options.GFCacheMB)
+        else:
+            snaps = GFSnapshots(options, maxMB=0.0)
+        # Reading the next block of couplings in the background is only safe
+        # without netCDF access from the main thread (the netCDF library is not thread-safe)
+        couplings = readCouplings(options, NCfile, modes, GFp.nuo, prefetch=not options.signc, kept=kept)
+        couplings = ((ihw, M) for ihws, Ms in couplings for ihw, M in zip(ihws, Ms))
+        for i, (ihw, M) in enumerate(couplings):
+            if options.SigBatch > 0 and i%options.SigBatch == 0:
+                # Self-energies for the next block of modes in one go
+                Elist = [LOEenergies(options, hw[j]) for j in modes[i:i+options.SigBatch]]
+                if VfracL == 0.5:
+                    Elist = [E[:2] for E in Elist]
+                # Not those of energies reusing a snapshot
+                Elist = snaps.pending(N.concatenate(Elist))
+                if len(Elist) > 0:
+                    GFp.precalcSigLR(Elist, [options.kpoint], ispin=options.iSpin,
+                                     etaLead=options.etaLead, useSigNCfiles=options.signc)
+            Ep, Em, Ep2, Em2 = LOEenergies(options, hw[ihw])
+            snaps.calcGF(GFp, Ep)
+            snaps.calcGF(GFm, Em)
+            calcTraces(options, GFp, GFm, basis, NCfile, ihw, M)
             if VfracL != 0.5:
-                GFp.calcGF(options.energy-hw[ihw]*options.LOEscale*(VfracL-1.)+options.eta*1.0j, options.kpoint[0:2], ispin=options.iSpin,
-                           etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff)
-                GFm.calcGF(options.energy-hw[ihw]*options.LOEscale*VfracL+options.eta*1.0j, options.kpoint[0:2], ispin=options.iSpin,
-                           etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff)
-            calcTraces(options, GFm, GFp, basis, NCfile, ihw)
+                snaps.calcGF(GFp, Ep2)
+                snaps.calcGF(GFm, Em2)
+            calcTraces(options, GFm, GFp, basis, NCfile, ihw, M)
+        print('Inelastica: %i unique GF evaluations for %i modes (%s)'%(snaps.evaluations, len(modes), snaps))
 
     # Multiply traces with voltage-dependent functions
     V, I, dI, ddI, BdI, BddI = calcIETS(options, GFp, GFm, basis, hw)
     NCfile.close()
     NEGF.SavedSig.close()
+    print('Inelastica: Left electrode', elecL.cache)
+    print('Inelastica: Right electrode', elecR.cache)
     Log.PrintMainFooter(options)
     return V, I, dI, ddI, BdI, BddI
 
 ########################################################
 
 
+class GFSnapshots(object):
+
+    """
+    Energy-keyed store of GF snapshots (see NEGF.GF.snapshot) for the
+    generalized LOE. calcGF reuses the snapshot of the nearest computed
+    energy within tol (eV, 0 = only identical energies) and otherwise
+    calls GF.calcGF and keeps its snapshot. When the memory budget (MB)
+    is exceeded the snapshots used longest ago are dropped (maxMB=0
+    disables the store).
+    """
+
+    def __init__(self, options, tol=0.0, maxMB=1024.0):
+        self.options, self.tol, self.maxMB = options, tol, maxMB
+        self.data = collections.OrderedDict() # energy: (snapshot, nbytes)
+        self.nbytes = 0
+        self.calls, self.evaluations, self.evictions = 0, 0, 0
+
+    def calcGF(self, GF, ee):
+        # GF.calcGF(ee) for the quantities used by calcTraces
+        self.calls += 1
+        if len(self.data) > 0:
+            energies = list(self.data.keys())
+            dist = N.abs(N.array(energies)-ee)
+            ii = N.argmin(dist)
+            if dist[ii] <= self.tol:
+                # Move to the end (most recently used)
+                snap = self.data.pop(energies[ii])
+                self.data[energies[ii]] = snap
+                GF.restore(snap[0])
+                return
+        options = self.options
+        GF.calcGF(ee, options.kpoint[0:2], ispin=options.iSpin,
+                  etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff)
+        self.evaluations += 1
+        snap = GF.snapshot()
+        size = 0
+        for val in snap.values():
+            if isinstance(val, MM.SpectralMatrix):
+                size += val.L.nbytes+val.R.nbytes
+            else:
+                size += val.nbytes
+        budget = self.maxMB*1024**2
+        if size > budget:
+            return
+        self.data[ee] = (snap, size)
+        self.nbytes += size
+        while self.nbytes > budget:
+            old = self.data.popitem(last=False)[1]
+            self.nbytes -= old[1]
+            self.evictions += 1
+
+    def pending(self, energies):
+        """
+        The energies (in the order of the calls to calcGF) for which calcGF
+        evaluates the GF, i.e., not reusing a snapshot (evictions ignored)
+        """
+        if self.maxMB <= 0:
+            return N.array(energies)
+        known, res = list(self.data.keys()), []
+        for ee in energies:
+            if len(known) == 0 or N.min(N.abs(N.array(known)-ee)) > self.tol:
+                known.append(ee)
+                res.append(ee)
+        return N.array(res)
+
+    def __str__(self):
+        return 'GFSnapshots: %i entries (%.1f/%.1f MB), calls= %i, evaluations= %i, evictions= %i, tolerance= %.1e eV'\
+            %(len(self.data), self.nbytes/1024.**2, self.maxMB, self.calls, self.evaluations, self.evictions, self.tol)
+
+
+def LOEenergies(options, hw):
+    """
+    Energies at which GFp and GFm are evaluated for a mode hw in the generalized LOE.
+    The last two are only used for an asymmetric voltage drop (VfracL != 0.5).
+    """
+    VfracL = options.VfracL
+    return N.array([options.energy+hw*options.LOEscale*VfracL+options.eta*1.0j,
+                    options.energy+hw*options.LOEscale*(VfracL-1.)+options.eta*1.0j,
+                    options.energy-hw*options.LOEscale*(VfracL-1.)+options.eta*1.0j,
+                    options.energy-hw*options.LOEscale*VfracL+options.eta*1.0j])
+
+
 def IntegrityCheck(options, GF, NCfile):
     # Perform consistency checks for device region in
     # PH and TS calculations by comparing coordinates
@@ -324,79 +454,253 @@ def IntegrityCheck(options, GF, NCfile):
         sys.exit('Inelastica: Error - inconsistency detected for device region.\n')
 
 
-def calcTraces(options, GF1, GF2, basis, NCfile, ihw):
+def screenModes(options, GF, NCfile, hw, modes):
+    """
+    Screening of the phonon modes with negligible e-ph couplings.
+    Each trace tr(M.Q1.M.Q2) of calcTraces is bounded by
+    ||M||_F^2 ||Q1||_2 ||Q2||_2 <= ||M||_F^2 a^2, where a is the largest
+    spectral norm of the GF quantities (A, AL, AR, ALT, ARGLG) at the
+    energies of the traces. Modes with a bound below options.modeScreen
+    times the largest bound, i.e., with ||M||_F^2 below this fraction of
+    the largest one whatever a is, are dropped and written to
+    DestDir/SystemLabel.IN.screen. The absolute bounds reported there use
+    a of GF at the Fermi energy, which is the bound for the LOE-WBA
+    (LOEscale=0) but only an estimate for the generalized LOE, whose
+    traces use the GFs at E+-hw*LOEscale*Vfrac.
+    Returns the modes to compute and the couplings {ihw: M} of those read
+    here within options.PhBatchMB (for readCouplings).
+    """
+    if options.modeScreen <= 0.0 or len(modes) == 0:
+        return modes, None
+    a = 0.0
+    for Q in [GF.A, GF.AL, GF.AR, GF.ALT, GF.ARGLG]:
+        if isinstance(Q, MM.SpectralMatrix):
+            Q = Q.full()
+        a = max(a, LA.norm(Q, 2))
+    normM = N.empty(len(modes), N.float)
+    kept, nkept = {}, int(options.PhBatchMB*1024.**2/(16.*GF.nuo**2))
+    for ihws, Ms in readCouplings(options, NCfile, modes, GF.nuo):
+        normM[N.searchsorted(modes, ihws)] = N.sqrt(N.sum(N.abs(Ms)**2, axis=(1, 2)))
+        for ihw, M in zip(ihws, Ms):
+            if len(kept) < nkept:
+                kept[ihw] = M.copy() # Not a view of the whole block
+    # nHT and HT are sums of three and (twice) two such traces
+    bound = 4*normM**2*a**2
+    if options.LOEscale == 0.0:
+        kind = 'bound'
+    else:
+        kind = 'estimate'
+    if N.max(bound) == 0.0:
+        print('Inelastica: Mode screening skipped, all e-ph couplings vanish')
+        return modes, kept
+    keep = bound >= options.modeScreen*N.max(bound)
+    skipped = N.sum(bound[~keep])
+    print('Inelastica: Mode screening (tolerance %.1e) skips %i of %i modes, sum of their trace %ss %.3e (%.2e of the largest)'
+          %(options.modeScreen, len(modes)-N.sum(keep), len(modes), kind, skipped, skipped/N.max(bound)))
+
+    f = open('%s/%s.IN.screen'%(options.DestDir, options.systemlabel), 'w')
+    if kind == 'bound':
+        f.write('# Mode screening with tolerance %.3e, e-ph traces bounded by 4 ||M||_F^2 a^2 with a = %.6e\n'%(options.modeScreen, a))
+    else:
+        f.write('# Mode screening with tolerance %.3e, e-ph traces estimated by 4 ||M||_F^2 a^2 with a = %.6e at the Fermi energy\n'%(options.modeScreen, a))
+        f.write('# (not a bound for LOEscale = %.3f, the relative values ||M||_F^2/max ||M||_F^2 hold for any a)\n'%options.LOEscale)
+    f.write('# Skipped %i of %i modes, sum of the skipped %ss %.6e (%.6e of the largest)\n'
+            %(len(modes)-N.sum(keep), len(modes), kind, skipped, skipped/N.max(bound)))
+    f.write('# ihw     hw (eV)        ||M||_F (eV)    %-12s  rel. %-8s skipped\n'%(kind, kind))
+    for ii, ihw in enumerate(modes):
+        f.write('%5i  %.6e  %.6e  %.6e  %.6e  %i\n'
+                %(ihw, hw[ihw], normM[ii], bound[ii], bound[ii]/N.max(bound), not keep[ii]))
+    f.close()
+    for ihw in modes[~keep]:
+        kept.pop(ihw, None)
+    return modes[keep], kept
+
+
+def readCouplings(options, NCfile, modes, nuo, copies=2, prefetch=True, kept=None):
+    """
+    Generator over blocks of the phonon modes yielding (ihws, Ms), where
+    Ms[i] is the e-ph coupling (He_ph+1j*ImHe_ph, spin options.iSpin) of
+    mode ihws[i]. Each block is a contiguous range of modes read in one
+    netCDF read and holds as many modes as fit in options.PhBatchMB for
+    "copies" complex (nuo, nuo) matrices per mode, i.e., gaps in modes
+    (see screenModes) start a new block. With prefetch the next block is
+    read on a background thread while the current block is in use.
+    Blocks of modes found in kept ({ihw: M}, see screenModes) are taken
+    from there instead of being read.
+    """
+    nb = max(1, int(options.PhBatchMB*1024.**2/(copies*16.*nuo**2)))
+    blocks = []
+    for ihw in modes:
+        if len(blocks) > 0 and len(blocks[-1]) < nb and ihw == blocks[-1][-1]+1:
+            blocks[-1].append(ihw)
+        else:
+            blocks.append([ihw])
+    blocks = [N.array(ihws, N.int) for ihws in blocks]
+    hasIm = 'ImHe_ph' in NCfile.variables
+    if not hasIm:
+        print('Warning: Variable ImHe_ph not found')
+    print('Inelastica: Reading e-ph couplings in %i block(s) of up to %i modes'%(len(blocks), nb))
+
+    def read(ihws, res):
+        try:
+            lo, hi = ihws[0], ihws[-1]+1
+            M = N.array(NCfile.variables['He_ph'][lo:hi, options.iSpin, :, :], N.complex)
+            if hasIm:
+                M += 1.j*N.array(NCfile.variables['ImHe_ph'][lo:hi, options.iSpin, :, :], N.complex)
+            res.append(M)
+        except Exception as e:
+            res.append(e)
+
+    def isKept(ihws):
+        return kept is not None and all([ihw in kept for ihw in ihws])
+
+    res, thread = [], None
+    for ii, ihws in enumerate(blocks):
+        if thread is not None:
+            thread.join()
+        elif isKept(ihws):
+            res.append(N.array([kept[ihw] for ihw in ihws]))
+        else:
+            read(ihws, res)
+        Ms = res.pop()
+        if isinstance(Ms, Exception):
+            raise Ms
+        if kept is not None:
+            for ihw in ihws:
+                kept.pop(ihw, None)
+        if prefetch and ii+1 < len(blocks) and not isKept(blocks[ii+1]):
+            thread = threading.Thread(target=read, args=(blocks[ii+1], res))
+            thread.start()
+        else:
+            thread = None
+        yield ihws, Ms
+
+
+def calcTracesBatch(options, GF1, GF2, Ms, ihws):
+    """
+    The e-ph traces of calcTraces (without the LOE-WBA checks and the noise
+    terms, see calcNoiseTraces) for a block of modes sharing GF1 and GF2,
+    Ms[i] being the coupling of mode ihws[i] (see readCouplings).
+    The products with the GF quantities are done for all modes at once.
+    """
+    # GF quantities Q = A.B (spectral matrix: A=L, B=R, otherwise B=None for
+    # the identity) by (GF, name), each evaluated once (also for lean GFs)
+    Q = {}
+    for ii, GF, names in [(1, GF1, ['ARGLG', 'ALT', 'A', 'AL', 'AR']), (2, GF2, ['ARGLG', 'A', 'AL', 'AR'])]:
+        for name in names:
+            val = getattr(GF, name)
+            Q[ii, name] = (val.L, val.R) if isinstance(val, MM.SpectralMatrix) else (val, None)
+    prod = {}
+
+    def BMA(q1, q2):
+        # B1.M.A2 for all modes, reused between the traces
+        B, A = Q[q1][1], Q[q2][0]
+        key = (None if B is None else q1, q2)
+        if not key in prod:
+            BM = Ms if B is None else N.matmul(B, Ms)
+            prod[key] = N.matmul(BM, A)
+        return prod[key]
+
+    def trMQMQ(q1, q2):
+        # tr(M.Q1.M.Q2) = tr(B1.M.A2.B2.M.A1)
+        return N.einsum('mij,mji->m', BMA(q1, q2), BMA(q2, q1))
+
+    t1 = trMQMQ((1, 'ARGLG'), (2, 'AR'))
+    t2 = trMQMQ((2, 'ARGLG'), (1, 'AL'))
+    K23 = t1.imag+t2.imag
+    K4 = trMQMQ((1, 'ALT'), (2, 'AR'))
+    aK23 = 2*(t1.real-t2.real) # asymmetric part
+    traces = [('nHT', K23+K4), ('HT', aK23),
+              ('P1T', trMQMQ((1, 'A'), (2, 'A'))), ('P2T', trMQMQ((1, 'AL'), (2, 'AR'))),
+              ('ehDampL', trMQMQ((1, 'AL'), (2, 'AL'))), ('ehDampR', trMQMQ((1, 'AR'), (2, 'AR')))]
+    for name, val in traces:
+        for ii, ihw in enumerate(ihws):
+            getattr(GF1, name)[ihw] = NEGF.AssertReal(val[ii], '%s[%i]'%(name, ihw))
+
+
+def calcTraces(options, GF1, GF2, basis, NCfile, ihw, M=None):
     # Calculate various traces over the electronic structure
-    # Electron-phonon couplings
+    # Electron-phonon couplings (M: already read, see readCouplings)
     ihw = int(ihw)
-    M = N.array(NCfile.variables['He_ph'][ihw, options.iSpin, :, :], N.complex)
-    try:
-        M += 1.j*N.array(NCfile.variables['ImHe_ph'][ihw, options.iSpin, :, :], N.complex)
-    except:
-        print('Warning: Variable ImHe_ph not found')
-    # Calculation of intermediate quantity
-    MARGLGM = MM.mm(M, GF1.ARGLG, M)
-    MARGLGM2 = MM.mm(M, GF2.ARGLG, M)
+    if M is None:
+        M = N.array(NCfile.variables['He_ph'][ihw, options.iSpin, :, :], N.complex)
+        try:
+            M += 1.j*N.array(NCfile.variables['ImHe_ph'][ihw, options.iSpin, :, :], N.complex)
+        except:
+            print('Warning: Variable ImHe_ph not found')
+    # Products of M with the GF quantities shared by the traces below,
+    # tr(M.Q1.M.Q2) = trace_mm(M.Q1, M.Q2) without the full product
+    MQ1 = dict((q, MM.mm(M, getattr(GF1, q))) for q in ['ARGLG', 'ALT', 'A', 'AL', 'AR'])
+    MQ2 = dict((q, MM.mm(M, getattr(GF2, q))) for q in ['ARGLG', 'A', 'AL', 'AR'])
     # LOE expressions in compact form
-    t1 = MM.mm(MARGLGM, GF2.AR)
-    t2 = MM.mm(MARGLGM2, GF1.AL)
+    t1 = MM.trace_mm(MQ1['ARGLG'], MQ2['AR']) # tr(M.ARGLG1.M.AR2)
+    t2 = MM.trace_mm(MQ2['ARGLG'], MQ1['AL']) # tr(M.ARGLG2.M.AL1)
     # Note that compared with Eq. (10) of PRB89, 081405 (2014) we here use
     # the definition B_lambda = MM.trace(t1-dagger(t2)), which in turn gives
     # ReB = MM.trace(t1).real-MM.trace(t2).real
     # ImB = MM.trace(t1).imag+MM.trace(t2).imag
-    K23 = MM.trace(t1).imag+MM.trace(t2).imag
-    K4 = MM.trace(MM.mm(M, GF1.ALT, M, GF2.AR))
-    aK23 = 2*(MM.trace(t1).real-MM.trace(t2).real) # asymmetric part
+    K23 = t1.imag+t2.imag
+    K4 = MM.trace_mm(MQ1['ALT'], MQ2['AR'])
+    aK23 = 2*(t1.real-t2.real) # asymmetric part
     # Non-Hilbert term defined here with a minus sign
     GF1.nHT[ihw] = NEGF.AssertReal(K23+K4, 'nHT[%i]'%ihw)
     GF1.HT[ihw] = NEGF.AssertReal(aK23, 'HT[%i]'%ihw)
     # Power, damping and current rates
-    GF1.P1T[ihw] = NEGF.AssertReal(MM.trace(MM.mm(M, GF1.A, M, GF2.A)), 'P1T[%i]'%ihw)
-    GF1.P2T[ihw] = NEGF.AssertReal(MM.trace(MM.mm(M, GF1.AL, M, GF2.AR)), 'P2T[%i]'%ihw)
-    GF1.ehDampL[ihw] = NEGF.AssertReal(MM.trace(MM.mm(M, GF1.AL, M, GF2.AL)), 'ehDampL[%i]'%ihw)
-    GF1.ehDampR[ihw] = NEGF.AssertReal(MM.trace(MM.mm(M, GF1.AR, M, GF2.AR)), 'ehDampR[%i]'%ihw)
+    GF1.P1T[ihw] = NEGF.AssertReal(MM.trace_mm(MQ1['A'], MQ2['A']), 'P1T[%i]'%ihw)
+    GF1.P2T[ihw] = NEGF.AssertReal(MM.trace_mm(MQ1['AL'], MQ2['AR']), 'P2T[%i]'%ihw)
+    GF1.ehDampL[ihw] = NEGF.AssertReal(MM.trace_mm(MQ1['AL'], MQ2['AL']), 'ehDampL[%i]'%ihw)
+    GF1.ehDampR[ihw] = NEGF.AssertReal(MM.trace_mm(MQ1['AR'], MQ2['AR']), 'ehDampR[%i]'%ihw)
     # Remains from older version (see before rev. 219):
     #GF.dGnout.append(EC.calcCurrent(options,basis,GF.HNO,mm(Us,-0.5j*(tmp1-dagger(tmp1)),Us)))
     #GF.dGnin.append(EC.calcCurrent(options,basis,GF.HNO,mm(Us,mm(G,MA1M,Gd)-0.5j*(tmp2-dagger(tmp2)),Us)))
     # NB: TF Should one use GF.HNO (nonorthogonal) or GF.H (orthogonalized) above?
 
     if options.LOEscale == 0.0:
-        # Check against original LOE-WBA formulation
-        isym1 = MM.mm(GF1.ALT, M, GF2.AR, M)
-        isym2 = MM.mm(MM.dagger(GF1.ARGLG), M, GF2.A, M)
-        isym3 = MM.mm(GF1.ARGLG, M, GF2.A, M)
-        isym = MM.trace(isym1)+1j/2.*(MM.trace(isym2)-MM.trace(isym3))
-        print('LOE-WBA check: Isym diff', K23+K4-isym)
-        iasym1 = MM.mm(MM.dagger(GF1.ARGLG), M, GF2.AR-GF2.AL, M)
-        iasym2 = MM.mm(GF1.ARGLG, M, GF2.AR-GF2.AL, M)
-        iasym = MM.trace(iasym1)+MM.trace(iasym2)
-        print('LOE-WBA check: Iasym diff', aK23-iasym)
-
-        # Compute inelastic shot noise terms according to the papers
-        # Haupt, Novotny & Belzig, PRB 82, 165441 (2010) and
-        # Avriller & Frederiksen, PRB 86, 155411 (2012)
-        # Zero-temperature limit
-        TT = MM.mm(GF1.GammaL, GF1.AR) # this matrix has the correct shape for MM
-        ReGr = (GF1.Gr+GF1.Ga)/2.
-        tmp = MM.mm(GF1.Gr, M, ReGr, M, GF1.AR)
-        tmp = tmp+MM.dagger(tmp)
-        Tlambda0 = MM.mm(GF1.GammaL, tmp)
-        tmp1 = MM.mm(M, GF1.AR, M)
-        tmp2 = MM.mm(M, GF1.A, M, GF1.Gr, GF1.GammaR)
-        tmp = tmp1+1j/2.*(MM.dagger(tmp2)-tmp2)
-        Tlambda1 = MM.mm(GF1.GammaL, GF1.Gr, tmp, GF1.Ga)
-        MARGL = MM.mm(M, GF1.AR, GF1.GammaL)
-        tmp1 = MM.mm(MARGL, GF1.AR, M)
-        tmp2 = MM.mm(MARGL, GF1.Gr, M, GF1.Gr, GF1.GammaR)
-        tmp = tmp1+tmp2
-        tmp = tmp + MM.dagger(tmp)
-        Qlambda = MM.mm(-GF1.Ga, GF1.GammaL, GF1.Gr, tmp)
-        tmp = -2*TT
-        OneMinusTwoT = tmp+N.identity(len(GF1.GammaL))
-        # Store relevant traces
-        GF1.dIel[ihw] = NEGF.AssertReal(MM.trace(Tlambda0), 'dIel[%i]'%ihw)
-        GF1.dIinel[ihw] = NEGF.AssertReal(MM.trace(Tlambda1), 'dIinel[%i]'%ihw)
-        GF1.dSel[ihw] = NEGF.AssertReal(MM.trace(MM.mm(OneMinusTwoT, Tlambda0)), 'dSel[%i]'%ihw)
-        GF1.dSinel[ihw] = NEGF.AssertReal(MM.trace(Qlambda+MM.mm(OneMinusTwoT, Tlambda1)), 'dSinel[%i]'%ihw)
+        calcNoiseTraces(options, GF1, GF2, M, ihw)
+
+
+def calcNoiseTraces(options, GF1, GF2, M, ihw):
+    # LOE-WBA check and inelastic noise traces (LOEscale=0.0),
+    # requires GF1.nHT[ihw] and GF1.HT[ihw] from calcTraces or calcTracesBatch
+    K23K4, aK23 = GF1.nHT[ihw], GF1.HT[ihw]
+    # Check against original LOE-WBA formulation
+    isym1 = MM.trace_mm(GF1.ALT, M, GF2.AR, M)
+    isym2 = MM.trace_mm(MM.dagger(GF1.ARGLG), M, GF2.A, M)
+    isym3 = MM.trace_mm(GF1.ARGLG, M, GF2.A, M)
+    isym = isym1+1j/2.*(isym2-isym3)
+    print('LOE-WBA check: Isym diff', K23K4-isym)
+    iasym1 = MM.trace_mm(MM.dagger(GF1.ARGLG), M, GF2.AR-GF2.AL, M)
+    iasym2 = MM.trace_mm(GF1.ARGLG, M, GF2.AR-GF2.AL, M)
+    iasym = iasym1+iasym2
+    print('LOE-WBA check: Iasym diff', aK23-iasym)
+
+    # Compute inelastic shot noise terms according to the papers
+    # Haupt, Novotny & Belzig, PRB 82, 165441 (2010) and
+    # Avriller & Frederiksen, PRB 86, 155411 (2012)
+    # Zero-temperature limit
+    TT = MM.mm(GF1.GammaL, GF1.AR) # this matrix has the correct shape for MM
+    ReGr = (GF1.Gr+GF1.Ga)/2.
+    tmp = MM.mm(GF1.Gr, M, ReGr, M, GF1.AR)
+    tmp = tmp+MM.dagger(tmp)
+    Tlambda0 = MM.mm(GF1.GammaL, tmp)
+    tmp1 = MM.mm(M, GF1.AR, M)
+    tmp2 = MM.mm(M, GF1.A, M, GF1.Gr, GF1.GammaR)
+    tmp = tmp1+1j/2.*(MM.dagger(tmp2)-tmp2)
+    Tlambda1 = MM.mm(GF1.GammaL, GF1.Gr, tmp, GF1.Ga)
+    MARGL = MM.mm(M, GF1.AR, GF1.GammaL)
+    tmp1 = MM.mm(MARGL, GF1.AR, M)
+    tmp2 = MM.mm(MARGL, GF1.Gr, M, GF1.Gr, GF1.GammaR)
+    tmp = tmp1+tmp2
+    tmp = tmp + MM.dagger(tmp)
+    # Qlambda = -Ga.GammaL.Gr.tmp (only the trace is needed)
+    trQlambda = MM.trace_mm(-GF1.Ga, GF1.GammaL, GF1.Gr, tmp)
+    tmp = -2*TT
+    OneMinusTwoT = tmp+N.identity(len(GF1.GammaL))
+    # Store relevant traces
+    GF1.dIel[ihw] = NEGF.AssertReal(MM.trace(Tlambda0), 'dIel[%i]'%ihw)
+    GF1.dIinel[ihw] = NEGF.AssertReal(MM.trace(Tlambda1), 'dIinel[%i]'%ihw)
+    GF1.dSel[ihw] = NEGF.AssertReal(MM.trace_mm(OneMinusTwoT, Tlambda0), 'dSel[%i]'%ihw)
+    GF1.dSinel[ihw] = NEGF.AssertReal(trQlambda+MM.trace_mm(OneMinusTwoT, Tlambda1), 'dSinel[%i]'%ihw)
 
 
 def calcIETS(options, GFp, GFm, basis, hw):
@@ -429,50 +733,51 @@ def calcIETS(options, GFp, GFm, basis, hw):
     wp = (1+N.sign(Vl))/2. # weights for positive V
     wm = (1-N.sign(Vl))/2. # weights for negative V
 
+    # Mode-resolved quantities are evaluated for all modes at once as (modes,Vgrid)
+    modes = (hw > options.modeCutoff).nonzero()[0]
+    w = hw[modes][:, N.newaxis] # (modes,1)
+
+    def onVgrid(Tp, Tm):
+        # Traces of GFp for V>0 and GFm for V<0 (modes,Vgrid)
+        return wm*Tm[modes][:, N.newaxis]+wp*Tp[modes][:, N.newaxis]
+
+    def coth(t):
+        t = N.clip(t, -700, 700)
+        return N.cosh(t)/N.sinh(t)
+
     # Mode occupation and power dissipation
     Pow = N.zeros((len(hw), NN), N.float) # (modes,Vgrid)
     nPh = N.zeros((len(hw), NN), N.float)
     t0 = N.clip(Vl/kT, -700, 700)
     cosh0 = N.cosh(t0) # Vgrid
     sinh0 = N.sinh(t0)
-    for i in (hw > options.modeCutoff).nonzero()[0]:
-        P1T = wm*GFm.P1T[i]+wp*GFp.P1T[i]
-        P2T = wm*GFm.P2T[i]+wp*GFp.P2T[i]
-        # Bose distribution
-        nB = 1/(N.exp(N.clip(hw[i]/kT, -300, 300))-1) # number
-        t1 = N.clip(hw[i]/(2*kT), -700, 700) # number
-        coth1 = N.cosh(t1)/N.sinh(t1)
-        # Emission rate and e-h damping
-        damp = P1T*hw[i]/N.pi # Vgrid
-        emis = P2T*(hw[i]*(cosh0-1)*coth1-Vl*sinh0)/(N.cosh(2*t1)-cosh0)/N.pi
-        # Determine mode occupation
-        if options.PhHeating:
-            nPh[i, :] = emis/(hw[i]*P1T/N.pi+options.PhExtDamp)+nB
-        else:
-            nPh[i, :] = nB
-        # Mode-resolved power dissipation
-        Pow[i, :] = hw[i]*((nB-nPh[i])*damp+emis)
+    P1T = onVgrid(GFp.P1T, GFm.P1T)
+    P2T = onVgrid(GFp.P2T, GFm.P2T)
+    # Bose distribution
+    nB = 1/(N.exp(N.clip(w/kT, -300, 300))-1) # (modes,1)
+    t1 = N.clip(w/(2*kT), -700, 700) # (modes,1)
+    coth1 = coth(t1)
+    # Emission rate and e-h damping
+    damp = P1T*w/N.pi
+    emis = P2T*(w*(cosh0-1)*coth1-Vl*sinh0)/(N.cosh(2*t1)-cosh0)/N.pi
+    # Determine mode occupation
+    if options.PhHeating:
+        nPh[modes] = emis/(w*P1T/N.pi+options.PhExtDamp)+nB
+    else:
+        nPh[modes] = nB
+    # Mode-resolved power dissipation
+    Pow[modes] = w*((nB-nPh[modes])*damp+emis)
 
     # Current: non-Hilbert part (InH)
-    InH = N.zeros((NN,), N.float) # Vgrid
-    IsymF = N.zeros((NN,), N.float)
-    for i in (hw > options.modeCutoff).nonzero()[0]:
-        nHT = wm*GFm.nHT[i]+wp*GFp.nHT[i] # Vgrid
-        t1 = hw[i]/(2*kT) # number
-        t1 = N.clip(t1, -700, 700)
-        coth1 = N.cosh(t1)/N.sinh(t1)
-        t2 = (hw[i]+Vl)/(2*kT) # Vgrid
-        t2 = N.clip(t2, -700, 700)
-        coth2 = N.cosh(t2)/N.sinh(t2)
-        t3 = (hw[i]-Vl)/(2*kT) # Vgrid
-        t3 = N.clip(t3, -700, 700)
-        coth3 = N.cosh(t3)/N.sinh(t3) # Vgrid
-        # Isym function
-        Isym = 0.5*(hw[i]+Vl)*(coth1-coth2) # Vgrid
-        Isym -= 0.5*(hw[i]-Vl)*(coth1-coth3)
-        # non-Hilbert part
-        InH += (Isym+2*Vl*nPh[i])*nHT # Vgrid
-        IsymF += Isym
+    nHT = onVgrid(GFp.nHT, GFm.nHT)
+    coth2 = coth((w+Vl)/(2*kT))
+    coth3 = coth((w-Vl)/(2*kT))
+    # Isym function
+    Isym = 0.5*(w+Vl)*(coth1-coth2)
+    Isym -= 0.5*(w-Vl)*(coth1-coth3)
+    # non-Hilbert part
+    InH = N.sum((Isym+2*Vl*nPh[modes])*nHT, axis=0) # Vgrid
+    IsymF = N.sum(Isym, axis=0)
 
     # Current: Add Landauer part, GFm.TeF = GFp.TeF
     InH += GFp.TeF*Vl # Vgrid
@@ -482,38 +787,30 @@ def calcIETS(options, GFp, GFm, basis, hw):
         import scipy.special as SS
         print("Inelastica: Computing asymmetric term using digamma function,")
         print("... see G. Bevilacqua et al., Eur. Phys. J. B (2016) 89: 3")
-        IH = N.zeros((NN,), N.float)
-        IasymF = N.zeros((NN,), N.float)
-        for i in (hw > options.modeCutoff).nonzero()[0]:
-            v0 = hw[i]/(2*N.pi*kT)
-            vp = (hw[i]+Vl)/(2*N.pi*kT)
-            vm = (hw[i]-Vl)/(2*N.pi*kT)
-            Iasym = kT*(2*v0*SS.psi(1.j*v0)-vp*SS.psi(1.j*vp)-vm*SS.psi(1.j*vm)).real
-            IasymF += Iasym
-            IH += GFp.HT[i]*N.array(Vl > 0.0, dtype=int)*Iasym
-            IH += GFm.HT[i]*N.array(Vl < 0.0, dtype=int)*Iasym
+        v0 = w/(2*N.pi*kT)
+        vp = (w+Vl)/(2*N.pi*kT)
+        vm = (w-Vl)/(2*N.pi*kT)
+        Iasym = kT*(2*v0*SS.psi(1.j*v0)-vp*SS.psi(1.j*vp)-vm*SS.psi(1.j*vm)).real
+        IasymF = N.sum(Iasym, axis=0)
+        HT = GFp.HT[modes][:, N.newaxis]*(Vl > 0.0)+GFm.HT[modes][:, N.newaxis]*(Vl < 0.0)
+        IH = N.sum(HT*Iasym, axis=0)
     except:
         print("Computing using explit Hilbert transformation")
-        IH = N.zeros((NN,), N.float)
-        IasymF = N.zeros((NN,), N.float)
-        # Prepare box/window function on array
-        Vl2 = N.outer(Vl, N.ones(Egrid.shape))
-        Egrid2 = N.outer(N.ones(Vl.shape), Egrid)
-        # Box/window function nF(E-Vl2)-nF(E-0):
-        kasse = MM.box(0, -Vl2, Egrid2, kT) # (Vgrid,Egrid)
-        ker = None
-        for i in (hw > options.modeCutoff).nonzero()[0]:
-            # Box/window function nF(E-hw)-nF(E+hw)
-            tmp = MM.box(-hw[i], hw[i], Egrid, kT)
-            hilb, ker = MM.Hilbert(tmp, ker) # Egrid
-            # Calculate Iasym for each bias point
-            for j in range(len(Vl)):
-                Iasym = MM.trapez(Egrid, kasse[j]*hilb, equidistant=True).real/2
-                IasymF[j] += Iasym
-                if Vl[j] > 0:
-                    IH[j] += GFp.HT[i]*Iasym
-                else:
-                    IH[j] += GFm.HT[i]*Iasym
+        # Box/window function nF(E-Vl)-nF(E-0) (Vgrid,Egrid)
+        kasse = MM.box(0, -Vl[:, N.newaxis], Egrid, kT)
+        # The Hilbert transform is linear, i.e., only the sums over the modes
+        # of the box/window functions nF(E-hw)-nF(E+hw) are transformed:
+        # total (IasymF) and weighted with HT of GFp (V>0) and GFm (V<=0)
+        boxes = MM.box(-w, w, Egrid, kT) # (modes,Egrid)
+        hilb, ker = MM.Hilbert(N.sum(boxes, axis=0))
+        hilbp, ker = MM.Hilbert(N.dot(GFp.HT[modes], boxes), ker)
+        hilbm, ker = MM.Hilbert(N.dot(GFm.HT[modes], boxes), ker)
+        # Trapez integration over Egrid for all bias points
+        d = N.ones(len(Egrid))*(Egrid[1]-Egrid[0])
+        d[0], d[-1] = d[0]/2, d[-1]/2
+        Iasym = N.dot(kasse, d[:, N.newaxis]*N.array([hilb, hilbp, hilbm]).T).real/2 # (Vgrid,3)
+        IasymF = Iasym[:, 0]
+        IH = N.where(Vl > 0, Iasym[:, 1], Iasym[:, 2])
 
     # Compute inelastic shot noise terms here:
     absVl = N.absolute(Vl)
@@ -722,25 +1019,18 @@ def Broaden(options, VV, II):
     BdV = dV[tmp:-tmp]
     BddV = ddV[tmp:-tmp]
 
-    # Initiate derivatives
-    BdI = 0*BdV
-    BddI = 0*BddV
+    # Modulation phases, (bias,phase) grids below
+    wt = (N.array(list(range(200)))/200.0-0.5)*N.pi
 
     # Calculate first derivative with Vrms broadening
-    for iV, V in enumerate(BdV):
-        SIO.printDone(iV, len(BdV), 'Inelastica.Broaden: First-derivative Vrms broadening')
-        wt = (N.array(list(range(200)))/200.0-0.5)*N.pi
-        VL = V+VA*N.sin(wt)
-        dIL = MM.interpolate(VL, dV, dI)
-        BdI[iV] = 2/N.pi*N.sum(dIL*(N.cos(wt)**2))*(wt[1]-wt[0])
+    VL = BdV[:, N.newaxis]+VA*N.sin(wt)
+    dIL = MM.interpolate(VL.reshape((-1,)), dV, dI).reshape(VL.shape)
+    BdI = 2/N.pi*N.sum(dIL*(N.cos(wt)**2), axis=1)*(wt[1]-wt[0])
 
     # Calculate second derivative with Vrms broadening
-    for iV, V in enumerate(BddV):
-        SIO.printDone(iV, len(BddV), 'Inelastica.Broaden: Second-derivative Vrms broadening')
-        wt = (N.array(list(range(200)))/200.0-0.5)*N.pi
-        VL = V+VA*N.sin(wt)
-        ddIL = MM.interpolate(VL, ddV, ddI)
-        BddI[iV] = 8.0/3.0/N.pi*N.sum(ddIL*(N.cos(wt)**4))*(wt[1]-wt[0])
+    VL = BddV[:, N.newaxis]+VA*N.sin(wt)
+    ddIL = MM.interpolate(VL.reshape((-1,)), ddV, ddI).reshape(VL.shape)
+    BddI = 8.0/3.0/N.pi*N.sum(ddIL*(N.cos(wt)**4), axis=1)*(wt[1]-wt[0])
 
     # Reduce to one voltage grid
     NN = options.biasPoints
@@ -27,6 +27,8 @@ import numpy as N
 import numpy.linalg as LA
 import struct
 import os.path
+import copy
+import weakref
 import sys
 import gzip
 import netCDF4 as NC4
@@ -59,6 +61,10 @@ else:
     fortranLong = 'i'
 
 
+# Format version of the sidecar caches of parsed TSHS files (see HS)
+HScacheVersion = 1
+
+
 def SIO_open(filename, mode='r'):
     "A io.siesta redefinition of the function open() to handle gzip format"
     try:
@@ -289,6 +295,62 @@ def ReadFortranBin(fortfile, dtype, num, printLength=False, unpack=True):
         return fbin
 
 
+def ReadFortranRecords(filename):
+    """
+    Map a Fortran binary file as an array of bytes (numpy.memmap, gzipped
+    files are decompressed into a preallocated buffer) and scan the record
+    markers once. Returns (buf, offsets, lengths) where record i holds
+    the bytes buf[offsets[i]:offsets[i]+lengths[i]].
+    """
+    if not os.path.isfile(filename) and os.path.isfile(filename+'.gz'):
+        filename += '.gz'
+    if filename[-3:] == '.gz':
+        # Uncompressed size (modulo 2**32) from the gzip trailer
+        with open(filename, 'rb') as f:
+            f.seek(-4, 2)
+            size = struct.unpack('<I', f.read(4))[0]
+        buf = N.empty(size, N.uint8)
+        with gzip.open(filename, 'rb') as f:
+            view, pos = memoryview(buf), 0
+            while pos < size:
+                nread = f.readinto(view[pos:])
+                if nread == 0:
+                    break
+                pos += nread
+            rest = f.read()
+        if pos < size:
+            buf = buf[:pos]
+        elif len(rest) > 0:
+            buf = N.concatenate((buf, N.frombuffer(rest, N.uint8)))
+    else:
+        buf = N.memmap(filename, N.uint8, 'r')
+    marker = fortranPrefix+fortranLong
+    msize = struct.calcsize(marker)
+    offsets, lengths, pos = [], [], 0
+    while pos < len(buf):
+        nbytes = struct.unpack_from(marker, buf, pos)[0]
+        end = pos+msize+nbytes
+        if nbytes < 0 or end+msize > len(buf) or struct.unpack_from(marker, buf, end)[0] != nbytes:
+            print('io.siesta.ReadFortranRecords: Error reading Fortran formatted binary file')
+            sys.exit(1)
+        offsets.append(pos+msize)
+        lengths.append(nbytes)
+        pos = end+msize
+    return buf, N.array(offsets, N.int64), N.array(lengths, N.int64)
+
+
+def FortranRecordData(buf, offsets, lengths, dtype, first=0, count=1):
+    """
+    Data of the Fortran records first,...,first+count-1 (see
+    ReadFortranRecords) concatenated into one array of type dtype.
+    """
+    if count == 1:
+        data = N.array(buf[offsets[first]:offsets[first]+lengths[first]])
+    else:
+        data = N.concatenate([buf[offsets[ii]:offsets[ii]+lengths[ii]] for ii in range(first, first+count)])
+    return data.view(dtype)
+
+
 def ReadWFSFile(filename):
     """
     TF/071008
@@ -1552,6 +1614,7 @@ class HS(object):
     - *N*                        : Size of matrices
     - *H[ispin,i,j]*             : Hamiltonian
     - *S[i,j]*                   : Overlap
+    - *sparse*                   : H[ispin] and S are scipy.sparse CSR matrices (see setkpoint)
 
     Internal variables from TS (**NOTE**: index described as fortran
     definition -- all python lists start with index 0!):
@@ -1583,17 +1646,28 @@ class HS(object):
     - *listhptr(1:nuo)*          : Start of row-1 in sparse matrix
     - *atomindx(1:nuo)*          : Atom index corresponding to orbital in unitcell
     - *rcell(1:3,1:3)*           : Reciprocal lattice vectors (ivec,ixyz) (rcell . cell = I)
+    - *latticeR, latticeH, latticeS* : Blocks H_R, S_R per lattice translation R (see setkpoints)
 
     For onlyS: Hsparse is not avalable and gamma point is assumed
 
     For gamma: xij is set to 0 and indxuo set manually to 1:nou and -1 for nou+1:no to catch errors!
 
+    With cache=True the arrays above are kept in a
+    sidecar directory *fn.cache* (one memory-mapped .npy file per array),
+    which is used instead of parsing fn as long as the size and
+    modification time of fn are unchanged.
     """
 
-    def __init__(self, fn, BufferAtoms=N.empty((0,)), UseF90helpers=True):
+    def __init__(self, fn, BufferAtoms=N.empty((0,)), UseF90helpers=True, cache=False):
         self.fn = fn
+        self.BufferAtoms = N.array(BufferAtoms, N.int).reshape((-1,))
         if UseF90helpers and fn.endswith('.gz'):
-            sys.exit('io.siesta.HS.__init__: F90helpers do not support reading of gzipped TSHS-files. Please unzip and try again.\n')
+            if BufferAtoms.size > 0:
+                sys.exit('io.siesta.HS.__init__: F90helpers do not support reading of gzipped TSHS-files. Please unzip and try again.\n')
+            print('io.siesta.HS.__init__: F90helpers do not support gzipped TSHS-files, using the python reader')
+            UseF90helpers = False
+        if cache and self.readCache(UseF90helpers):
+            return
 
         if UseF90helpers and F90imported:
             print('io.siesta.HS.__init__: Reading %s' % fn)
@@ -1649,6 +1723,85 @@ class HS(object):
         if not self.gamma and not self.onlyS and self.version == 0:
             self.removeUnitCellXij(UseF90helpers) # Remove phase change in unitcell
         self.resetkpoint() # save time by not repeating
+        if cache:
+            self.writeCache(UseF90helpers)
+
+    def __cacheKey(self, UseF90helpers):
+        st = os.stat(self.fn)
+        return {'version': HScacheVersion, 'size': st.st_size, 'mtime': st.st_mtime,
+                'BufferAtoms': [int(ii) for ii in self.BufferAtoms], 'F90': bool(UseF90helpers and F90imported)}
+
+    def contentHash(self):
+        """
+        md5 hash of the TSHS file content and buffer atoms (kept in the cache)
+        """
+        if not 'hash' in self.__dict__:
+            import hashlib
+            md5 = hashlib.md5()
+            with SIO_open(self.fn, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    md5.update(block)
+            md5.update(N.array(self.BufferAtoms, N.int64).tobytes())
+            self.hash = md5.hexdigest()
+        return self.hash
+
+    def readCache(self, UseF90helpers=True):
+        """
+        Read the sidecar cache of fn, returns False if missing or outdated
+        """
+        import pickle
+        cachedir = self.fn+'.cache'
+        try:
+            with open(cachedir+'/header.pkl', 'rb') as f:
+                header = pickle.load(f)
+            if header['key'] != self.__cacheKey(UseF90helpers):
+                print('io.siesta.HS.readCache: Outdated cache %s' % cachedir)
+                return False
+            arrays = {}
+            for name in header['arrays']:
+                arrays[name] = N.load(cachedir+'/'+name+'.npy', mmap_mode='r')
+        except (IOError, OSError, EOFError, KeyError, ValueError, pickle.UnpicklingError):
+            return False
+        print('io.siesta.HS.__init__: Reading cache %s' % cachedir)
+        self.__dict__.update(header['attrs'])
+        self.__dict__.update(arrays)
+        print("Found %i atoms, (%i, %i) orbitals in super-, unit-cell" % (self.nua, self.no, self.nuo))
+        self.resetkpoint()
+        return True
+
+    def writeCache(self, UseF90helpers=True):
+        """
+        Write the parsed arrays (and content hash) to the sidecar cache of fn
+        """
+        import pickle
+        import shutil
+        cachedir = self.fn+'.cache'
+        tmpdir = cachedir+'.tmp%i' % os.getpid()
+        self.contentHash()
+        attrs, arrays = {}, []
+        for name, value in self.__dict__.items():
+            if name in ['fn', 'kpoint', 'sparse', 'H', 'S']:
+                continue
+            if isinstance(value, N.ndarray):
+                arrays.append(name)
+            else:
+                attrs[name] = value
+        try:
+            if os.path.isdir(tmpdir):
+                shutil.rmtree(tmpdir)
+            os.mkdir(tmpdir)
+            for name in arrays:
+                N.save(tmpdir+'/'+name+'.npy', self.__dict__[name])
+            header = {'key': self.__cacheKey(UseF90helpers), 'attrs': attrs, 'arrays': arrays}
+            with open(tmpdir+'/header.pkl', 'wb') as f:
+                pickle.dump(header, f, 2)
+            if os.path.isdir(cachedir):
+                shutil.rmtree(cachedir)
+            os.rename(tmpdir, cachedir)
+            print('io.siesta.HS.writeCache: Wrote %s' % cachedir)
+        except (IOError, OSError):
+            print('io.siesta.HS.writeCache: Could not write %s' % cachedir)
+            shutil.rmtree(tmpdir, ignore_errors=True)
 
     def resetkpoint(self):
         """
@@ -1656,6 +1809,7 @@ class HS(object):
         The garbage collector cannot tell if H or S will be used subsequently
         """
         self.kpoint = N.array([1e10, 1e10, 1e10], N.float)
+        self.sparse = False
         if 'H' in dir(self):
             del self.H
         if 'S' in dir(self):
@@ -1673,64 +1827,64 @@ class HS(object):
         """
         print('io.siesta.__ReadTSHSFile: Reading %s' % filename)
         self.version = 0
-        # Open binary Fortran file
-        fortfile = SIO_open(filename, 'rb')
-        nau, nou, nos, nspin, maxnh = ReadFortranBin(fortfile, fortranLong, 5)
-        xa = N.reshape(N.array(ReadFortranBin(fortfile, 'd', 3*nau)), (nau, 3))*PC.Bohr2Ang
+        # Map the binary Fortran file and locate all records
+        buf, offsets, lengths = ReadFortranRecords(filename)
+        irec = [0] # Next record
+
+        def read(dtype, count=1):
+            data = FortranRecordData(buf, offsets, lengths, dtype, irec[0], count)
+            irec[0] += count
+            return data
+        iL, dL, lL = N.int32, N.float64, N.uint32 # Fortran integer, double and logical
+        if len(offsets) == 0 or lengths[0] != 5*N.dtype(iL).itemsize:
+            print('io.siesta.__ReadTSHSFile: Error reading Fortran formatted binary file')
+            sys.exit(1)
+        nau, nou, nos, nspin, maxnh = [int(ii) for ii in read(iL)]
+        xa = N.reshape(read(dL), (nau, 3))*PC.Bohr2Ang
         xa = N.require(xa.T, requirements=['A', 'F'])
-        isa = ReadFortranBin(fortfile, fortranLong, nau); del isa
-        ucell = N.transpose(N.reshape(N.array(ReadFortranBin(fortfile, 'd', 9)), (3, 3)))*PC.Bohr2Ang
-        gamma = ReadFortranBin(fortfile, 'L', 1)[0] != 0        # Read boolean (works with ifort)
-        onlyS = ReadFortranBin(fortfile, 'L', 1)[0] != 0        # Read boolean (works with ifort)
-        ts_gamma_scf = ReadFortranBin(fortfile, 'L', 1)[0] != 0 # Read boolean (works with ifort)
-        ts_kscell = N.reshape(N.array(ReadFortranBin(fortfile, fortranLong, 9)), (3, 3))
-        ts_kdispl = N.array(ReadFortranBin(fortfile, 'd', 3))
-        istep, ia1 = ReadFortranBin(fortfile, fortranLong, 2)
-        lasto = N.array(ReadFortranBin(fortfile, fortranLong, nau+1))
+        isa = read(iL); del isa
+        ucell = N.transpose(N.reshape(read(dL), (3, 3)))*PC.Bohr2Ang
+        gamma = bool(read(lL)[0] != 0)  # Read boolean (works with ifort)
+        onlyS = bool(read(lL)[0] != 0)  # Read boolean (works with ifort)
+        ts_gamma_scf = bool(read(lL)[0] != 0) # Read boolean (works with ifort)
+        ts_kscell = N.reshape(read(iL), (3, 3))
+        ts_kdispl = read(dL)
+        istep, ia1 = [int(ii) for ii in read(iL)]
+        lasto = N.array(read(iL), N.int)
         if not gamma:
-            indxuo = N.array(ReadFortranBin(fortfile, fortranLong, nos))
+            indxuo = N.array(read(iL), N.int)
         else:
             # For gamma point make indxuo such that indexes not pointing to unitcell give error, i.e., -1.
             tmp1 = N.array(list(range(1, nou+1)), N.int)
             tmp2 = -N.ones((nos-nou), N.int)
             indxuo = N.concatenate((tmp1, tmp2))
-        numhg = N.array(ReadFortranBin(fortfile, fortranLong, nou))
-        qtot, temp = ReadFortranBin(fortfile, 'd', 2)
+        numhg = N.array(read(iL), N.int)
+        qtot, temp = [float(ii) for ii in read(dL)]
         temp = temp * PC.Rydberg2eV
-        ef = ReadFortranBin(fortfile, 'd', 1)[0]*PC.Rydberg2eV
-        listh = []
-        for ii in range(nou):
-            listh += list(ReadFortranBin(fortfile, fortranLong, numhg[ii]))
-        listh = N.array(listh)
-        Ssparse, cnt = N.zeros(maxnh, N.float), 0
-        for ii in range(nou):
-            Ssparse[cnt:cnt+numhg[ii]] = ReadFortranBin(fortfile, 'd', numhg[ii])
-            cnt = cnt+numhg[ii]
+        ef = float(read(dL)[0])*PC.Rydberg2eV
+        # The sparse matrices are stored with one record per orbital
+        listh = N.array(read(iL, nou), N.int)
+        Ssparse = N.array(read(dL, nou), N.float)
         if not onlyS:
             Hsparse = N.zeros((nspin, maxnh), N.float, order='F')
             for ispin in range(nspin):
-                cnt = 0
-                for ii in range(nou):
-                    Hsparse[ispin, cnt:cnt+numhg[ii]] = ReadFortranBin(fortfile, 'd', numhg[ii])
-                    cnt = cnt+numhg[ii]
+                Hsparse[ispin, :] = read(dL, nou)
             Hsparse = Hsparse.T*PC.Rydberg2eV
             Hsparse = N.require(Hsparse, requirements=['A', 'F'])
 
         if not gamma:
-            # Read xij
-            xij = N.zeros((maxnh, 3), N.float, order='F')
-            cnt = 0
-            for ii in range(nou):
-                tmp = ReadFortranBin(fortfile, 'd', numhg[ii]*3)
-                tmp = N.reshape(tmp, (3, numhg[ii]))
-                xij[cnt:cnt+numhg[ii], :] = tmp.T
-                cnt = cnt+numhg[ii]
-            xij = xij.T*PC.Bohr2Ang
+            # Read xij, each record holds (3, numhg[ii]) values
+            tmp = read(dL, nou)
+            rowstart = N.zeros(nou, N.int)
+            rowstart[1:] = N.cumsum(numhg[:-1])
+            rows = N.repeat(N.arange(nou), numhg)
+            indx = 3*rowstart[rows]+N.arange(maxnh)-rowstart[rows]
+            xij = N.array([tmp[indx+ixyz*numhg[rows]] for ixyz in range(3)])*PC.Bohr2Ang
             xij = N.require(xij, requirements=['A', 'F'])
 
         else:
             xij = N.zeros((3, maxnh), N.float, order='F')
-        fortfile.close()
+        buf = None # Release the mapping (read() closes over buf, so it cannot be deleted)
 
         general = [nau, nou, nos, nspin, maxnh, gamma, onlyS, istep, ia1, qtot, temp, ef]
         sparse = [lasto, numhg, listh, indxuo]
@@ -1785,38 +1939,96 @@ class HS(object):
                                              listh=self.listh,
                                              atomindx=self.atomindx)
         else:
-            for iuo in range(self.nuo):
-                for jnz in range(self.numh[iuo]):
-                    jo = self.listh[self.listhptr[iuo]+jnz]-1
-                    juo = self.indxuo[self.listh[self.listhptr[iuo]+jnz]-1]-1
-                    ia, ja = self.atomindx[iuo]-1, self.atomindx[juo]-1
-                    #if juo==jo and N.max(abs(self.xij[self.listhptr[iuo]+jnz,:]))>0.1:
-                    #    print self.xij[self.listhptr[iuo]+jnz,:]
-                    self.xij[:, self.listhptr[iuo]+jnz] = self.xij[:, self.listhptr[iuo]+jnz]-\
-                                                          (self.xa[:, ja]-self.xa[:, ia])
-                    #if juo==jo and N.max(abs(self.xij[self.listhptr[iuo]+jnz,:]))>0.1:
-                    #    print self.xij[self.listhptr[iuo]+jnz,:]
-                    #if juo!=jo and N.max(abs(self.xij[self.listhptr[iuo]+jnz,:]))<0.1:
-                    #    print self.xij[self.listhptr[iuo]+jnz,:]
-
-    def setkpoint(self, kpoint, UseF90helpers=True, atype=N.complex, verbose=True):
-        "Make full matrices from sparse for specific k-point"
+            rows, cols = self.sparseIndices()
+            ia, ja = self.atomindx[rows]-1, self.atomindx[cols]-1
+            self.xij[:, :self.maxnh] = self.xij[:, :self.maxnh]-(self.xa[:, ja]-self.xa[:, ia])
+
+    def sparseIndices(self):
+        """
+        Row and (unit cell) column index of each of the maxnh sparse elements,
+        i.e., Hsparse[ind] is a contribution to H(rows[ind], cols[ind]).
+        """
+        if not 'sparseRows' in self.__dict__:
+            self.sparseRows = N.repeat(N.arange(self.nuo), self.numh[:self.nuo])
+            self.sparseCols = (N.array(self.listh[:self.maxnh], N.int)-1)%self.nuo
+        return self.sparseRows, self.sparseCols
+
+    def setkpoint(self, kpoint, UseF90helpers=True, atype=N.complex, verbose=True, sparse=False):
+        """
+        Make full matrices from sparse for specific k-point.
+        With sparse=True, S and H[ispin] are scipy.sparse CSR matrices
+        (H is an object array over spin) instead of dense arrays.
+        """
         kpoint = N.array(kpoint, N.float)
         if self.gamma:
             VC.Check("same-kpoint", abs(kpoint),
                      "Trying to set non-zero k-point for Gamma point calculation.")
-        if N.any(N.abs(self.kpoint-kpoint) > VC.GetCheck("same-kpoint")):
+        if N.any(N.abs(self.kpoint-kpoint) > VC.GetCheck("same-kpoint")) or sparse != self.sparse:
             if verbose:
                 print("io.siesta.HS.setkpoint: %s k = %s" % (self.fn, str(kpoint)) )
             self.kpoint = kpoint
-            self.S = self.setkpointhelper(self.Ssparse, kpoint, UseF90helpers, atype=atype)
-            if not self.onlyS:
+            self.sparse = sparse
+            self.S = self.setkpointhelper(self.Ssparse, kpoint, UseF90helpers, atype=atype, sparse=sparse)
+            if not self.onlyS and sparse:
+                self.H = N.empty((self.nspin,), object)
+                for ispin in range(self.nspin):
+                    self.H[ispin] = self.setkpointhelper(self.Hsparse[:, ispin], kpoint, atype=atype, sparse=True) \
+                        - self.ef * self.S
+            elif not self.onlyS:
                 self.H = N.empty((self.nspin, self.nuo, self.nuo), atype)
                 for ispin in range(self.nspin):
                     self.H[ispin, :, :] = self.setkpointhelper(self.Hsparse[:, ispin], kpoint, UseF90helpers, atype=atype) \
                         - self.ef * self.S
 
-    def setkpointhelper(self, Sparse, kpoint, UseF90helpers=True, atype=N.complex):
+    def latticeDecomposition(self):
+        """
+        Decompose the sparse matrices into blocks of the unique lattice
+        translations R (in units of the lattice vectors, i.e., rcell.xij):
+            H_k(i,j) = sum_R exp(2 pi i k.R) H_R(i,j)
+        Sets latticeR[iR, 1:3] and the scipy.sparse matrices latticeS and
+        latticeH[ispin] of shape (nuo*nuo, nR) holding H_R(i,j) in column iR.
+        """
+        import scipy.sparse as SS
+        frac = N.dot(self.rcell, self.xij[:, :self.maxnh]).T
+        self.latticeR, iR = N.unique(N.round(frac, 8), axis=0, return_inverse=True)
+        rows, cols = self.sparseIndices()
+        indx = rows*self.nuo+cols
+        shape = (self.nuo*self.nuo, len(self.latticeR))
+        self.latticeS = SS.csr_matrix((self.Ssparse[:self.maxnh], (indx, iR)), shape=shape)
+        if not self.onlyS:
+            self.latticeH = [SS.csr_matrix((self.Hsparse[:self.maxnh, ispin], (indx, iR)), shape=shape)
+                             for ispin in range(self.nspin)]
+
+    def setkpoints(self, kpoints, atype=N.complex):
+        """
+        Full matrices for a list of k-points (same units as setkpoint)
+        from the lattice decomposition (see latticeDecomposition, done
+        once and kept on the shared instance of SharedHS views).
+        Returns H[ik, ispin, i, j] (None for onlyS) and S[ik, i, j],
+        the k-point of setkpoint (H, S) is not changed.
+        """
+        kpoints = N.array(kpoints, N.float).reshape((-1, 3))
+        if self.gamma:
+            VC.Check("same-kpoint", abs(kpoints),
+                     "Trying to set non-zero k-point for Gamma point calculation.")
+        lattice = getattr(self, 'shared', self)
+        if not 'latticeR' in lattice.__dict__:
+            lattice.latticeDecomposition()
+        nk, nuo = len(kpoints), self.nuo
+        phase = N.exp(2.0j*N.pi*N.dot(lattice.latticeR, kpoints.T)) # phase[iR, ik]
+        if (atype == N.float) or (atype == N.float32) or (atype == N.float64):
+            part = lambda M: M.real
+        else:
+            part = lambda M: M
+        S = N.array(part(lattice.latticeS.dot(phase).T).reshape((nk, nuo, nuo)), atype)
+        if self.onlyS:
+            return None, S
+        H = N.empty((nk, self.nspin, nuo, nuo), atype)
+        for ispin in range(self.nspin):
+            H[:, ispin] = part(lattice.latticeH[ispin].dot(phase).T).reshape((nk, nuo, nuo))-self.ef*S
+        return H, S
+
+    def setkpointhelper(self, Sparse, kpoint, UseF90helpers=True, atype=N.complex, sparse=False):
         """
         Make full matrices from sparse for specific k-point
         NOTE: Assumption for Fourier transform
@@ -1829,7 +2041,19 @@ class HS(object):
 
         For efficiency this routine is normally run in Fortran90. Compile with f2py:
         cd F90;source compile.bat
+
+        With sparse=True a scipy.sparse CSR matrix is returned, assembled
+        directly from the sparse elements with vectorized phase factors.
         """
+        if sparse:
+            import scipy.sparse as SS
+            rows, cols = self.sparseIndices()
+            phase = N.exp(2.0j*N.pi*N.dot(kpoint, N.dot(self.rcell, self.xij)))
+            data = Sparse[:self.maxnh]*phase
+            if (atype == N.float) or (atype == N.float32) or (atype == N.float64):
+                data = data.real
+            Full = SS.csr_matrix((N.array(data, atype), (rows, cols)), shape=(self.nuo, self.nuo))
+            return Full
         if UseF90helpers and F90imported:
             Full = F90.setkpointhelper(nnzs=self.maxnh, sparse=Sparse, kpoint=kpoint,
                                        no_u=self.nuo, numh=self.numh,
@@ -1842,17 +2066,14 @@ class HS(object):
         else:
             Full = N.zeros((self.nuo, self.nuo), atype)
             # Phase factor
-            tmp = N.dot(kpoint, N.dot(self.rcell, self.xij))
+            tmp = N.dot(kpoint, N.dot(self.rcell, self.xij[:, :self.maxnh]))
             phase = N.exp(2.0j*N.pi*tmp)    # exp(2 pi i k*(Rj-Ri)) where i,j from Hij
-
-            for iuo in range(self.nuo):
-                for jz in range(self.numh[iuo]):
-                    si = self.listhptr[iuo]+jz
-                    juo = self.indxuo[self.listh[si]-1]-1
-                #if juo==self.listh[si]-1:
-                #    if phase[si]!=1.0+0.0j:
-                #        print "hej"
-                    Full[iuo, juo] += Sparse[si]*phase[si]
+            data = Sparse[:self.maxnh]*phase
+            if not N.iscomplexobj(Full):
+                data = data.real
+            # Sum the elements onto the unit cell matrix
+            rows, cols = self.sparseIndices()
+            N.add.at(Full, (rows, cols), data)
         if not Full.dtype == atype:
             print('io.siesta: Forcing array from %s to %s' % (Full.dtype, atype))
         if (atype == N.float) or (atype == N.float32) or (atype == N.float64):
@@ -1860,6 +2081,51 @@ class HS(object):
         else:
             return N.array(Full, atype)
 
+# Registry of HS instances shared by SharedHS (freed with the last user)
+HSregistry = weakref.WeakValueDictionary()
+
+
+def SharedHS(fn, BufferAtoms=N.empty((0,)), UseF90helpers=True, cache=False):
+    """
+    HS instance for fn sharing the (read-only) sparse arrays with all
+    other SharedHS instances of the same file (path, modification time
+    and buffer atoms), i.e., each file is read and stored only once per
+    process. Each instance has its own k-point (setkpoint, H, S).
+    The shared data is freed when the last instance is deleted.
+    With cache=True a new file is read through its sidecar cache (see HS).
+    """
+    BufferAtoms = N.array(BufferAtoms).reshape((-1,))
+    key = SharedHSkey(fn, BufferAtoms, UseF90helpers)
+    shared = HSregistry.get(key)
+    if shared is None:
+        shared = HS(fn, BufferAtoms=BufferAtoms, UseF90helpers=UseF90helpers, cache=cache)
+        HSregistry[key] = shared
+    else:
+        print('io.siesta.SharedHS: Reusing %s' % fn)
+    view = copy.copy(shared)
+    view.shared = shared # Keep the shared data alive
+    view.resetkpoint()
+    return view
+
+
+def SharedHSkey(fn, BufferAtoms=N.empty((0,)), UseF90helpers=True):
+    # Registry key of SharedHS: path, modification time and buffer atoms
+    try:
+        mtime = os.path.getmtime(fn)
+    except OSError:
+        mtime = None
+    BufferAtoms = N.array(BufferAtoms).reshape((-1,))
+    return (os.path.abspath(fn), mtime, tuple(int(ii) for ii in BufferAtoms), bool(UseF90helpers))
+
+
+def registerSharedHS(shared, fn, BufferAtoms=N.empty((0,)), UseF90helpers=True):
+    """
+    Make SharedHS(fn, ...) return views of an existing HS instance, e.g.,
+    one built on shared memory arrays in a worker process. The caller
+    keeps shared alive (the registry only holds weak references).
+    """
+    HSregistry[SharedHSkey(fn, BufferAtoms, UseF90helpers)] = shared
+
 # Easy method to read in number of atoms in a TSHS file
 
 
@@ -290,18 +290,15 @@ def _kronrod(n, tol):
 #
     from numpy import pi
     from numpy import zeros
-    from math import floor
     from math import sin
     from math import sqrt
 
-    tau_dim = (n + 1) / 2
-    tau_dim = int(floor(tau_dim))
-    b = zeros(((n+1)/2)+1)
-    tau = zeros(tau_dim)
+    m = (n + 1) // 2
+    b = zeros(m + 1)
+    tau = zeros(m)
     w1 = zeros(n + 1)
     w2 = zeros(n + 1)
     x = zeros(n + 1)
-    m = int(floor((n + 1) / 2))
     even = (2 * m == n)
     d = 2.0
     an = 0.0
@@ -48,7 +48,7 @@ def Hilbert(f, ker=None):
         r = FFT.ifft(fpad*ker)
         return r[0:n]
 
-    if ker != None:
+    if ker is not None:
         # A kernel was specified at the function call
         return transform(f, ker), ker
     else:
@@ -118,12 +118,9 @@ def interpolate(nx, x, y):
     ny : ndarray
         Interpolated function values on nx.
     """
-    ny = N.array([0.0]*len(nx))
-    Lpos = N.searchsorted(x, nx)
-    for ix, pos in enumerate(Lpos):
-        if pos < len(x):
-            ny[ix] = y[pos-1]+(y[pos]-y[pos-1])/(x[pos]-x[pos-1])*(nx[ix]-x[pos-1])
-        else:
-            #TF: NB EXTRAPOLATION condition added!
-            ny[ix] = y[-1]+(y[-1]-y[-2])/(x[-1]-x[-2])*(nx[ix]-x[-1])
-    return ny
+    nx, x, y = N.asarray(nx), N.asarray(x), N.asarray(y)
+    pos = N.searchsorted(x, nx)
+    #TF: NB EXTRAPOLATION condition added! (beyond x[-1] from the last interval)
+    pos[pos >= len(x)] = len(x)-1
+    ny = y[pos-1]+(y[pos]-y[pos-1])/(x[pos]-x[pos-1])*(nx-x[pos-1])
+    return N.array(ny, N.float)
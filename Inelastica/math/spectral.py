@@ -194,6 +194,50 @@ def trace(a):
         return N.trace(a)
 
 
+def __expandSpectral(args):
+    # Split spectral matrices into their dense factors L, R. For the trace,
+    # rotate the product (cyclic) to start with the R of a spectral matrix
+    # such that the remaining contractions are over the small dimension
+    first = None
+    res = []
+    for ii in args:
+        if isinstance(ii, SpectralMatrix):
+            if first is None:
+                first = len(res)+1
+            res += [ii.L, ii.R]
+        else:
+            res += [ii]
+    return res, first
+
+
+def trace_mm(* args):
+    """
+    Returns the trace of the matrix product of the arguments (normal or
+    spectral matrices) without forming the full product, i.e.,
+    the last contraction is done elementwise: tr(X.Y) = sum(X*Y^T).
+    """
+    args, first = __expandSpectral(args)
+    if first is not None:
+        args = args[first:]+args[:first]
+    if len(args) == 1:
+        return N.trace(args[0])
+    half = len(args)//2
+    X, Y = __mm(args[:half]), __mm(args[half:])
+    return N.sum(X*Y.T)
+
+
+def diag_mm(* args):
+    """
+    Returns the diagonal of the matrix product of the arguments (normal or
+    spectral matrices) without forming the full product: diag(X.Y)_i = sum_j X_ij*Y_ji.
+    """
+    args = __expandSpectral(args)[0]
+    if len(args) == 1:
+        return N.diag(args[0])
+    X = __mm(args[:-1])
+    return N.sum(X*args[-1].T, axis=1)
+
+
 def dagger(x):
     """
     Returns the hermitian conjugation of a normal or spectral matrix.
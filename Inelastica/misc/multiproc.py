@@ -9,8 +9,13 @@
 from __future__ import print_function
 
 import multiprocessing as MP
+import numpy as N
 import sys
 import os
+try:
+    from multiprocessing import shared_memory as SHM # python >= 3.8
+except ImportError:
+    SHM = None
 
 
 def runParallel(function, argList, nCPU=None):
@@ -62,3 +67,96 @@ def runParallel(function, argList, nCPU=None):
     else:
         os.environ['OPENBLAS_NUM_THREADS'] = OBLAS
     return res
+
+
+class SharedArray(object):
+    """
+    Copy of a NumPy array in a multiprocessing.shared_memory block,
+    the (zero-copy) view of the block is SharedArray.array and has the
+    memory layout of the original (e.g., Fortran order for f2py).
+    The object pickles to the name of the block, i.e., a spawned worker
+    attaches to the block instead of receiving a copy of the data, a
+    forked worker inherits the mapping.
+    Without shared_memory (python < 3.8) the array is kept as it is
+    (forked workers then share it copy-on-write).
+    Call free() in the creating process when the workers are done.
+    """
+
+    def __init__(self, A):
+        A = N.asarray(A)
+        self.shape, self.dtype, self.owner = A.shape, A.dtype, True
+        self.order = 'F' if N.isfortran(A) else 'C'
+        if SHM is None:
+            self.shm, self.array = None, A
+        else:
+            self.shm = SHM.SharedMemory(create=True, size=max(A.nbytes, 1))
+            self.array = N.ndarray(self.shape, self.dtype, buffer=self.shm.buf, order=self.order)
+            self.array[...] = A
+
+    def __getstate__(self):
+        if self.shm is None:
+            return {'shape': self.shape, 'dtype': self.dtype, 'order': self.order, 'array': self.array}
+        return {'shape': self.shape, 'dtype': self.dtype, 'order': self.order, 'name': self.shm.name}
+
+    def __setstate__(self, state):
+        self.shape, self.dtype, self.order, self.owner = state['shape'], state['dtype'], state['order'], False
+        if 'name' in state:
+            try: # Only the creating process may unlink the block
+                self.shm = SHM.SharedMemory(name=state['name'], track=False) # python >= 3.13
+            except TypeError:
+                self.shm = SHM.SharedMemory(name=state['name'])
+            self.array = N.ndarray(self.shape, self.dtype, buffer=self.shm.buf, order=self.order)
+        else:
+            self.shm, self.array = None, state['array']
+
+    def free(self):
+        # All views of the block (see attachArrays) must be released first
+        if self.shm is not None:
+            self.array = None
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+            self.shm = None
+
+
+def shareArrays(obj, names):
+    """
+    Copy the array attributes "names" of obj (e.g., HS.Hsparse) to
+    SharedArray blocks. Lists of arrays (e.g., basis.orb) are stored in
+    one block. Other attributes are skipped.
+    Returns the (picklable) handles {name: block} for attachArrays and
+    freeShared, obj itself is not changed.
+    """
+    handles = {}
+    for name in names:
+        A = getattr(obj, name, None)
+        if isinstance(A, N.ndarray):
+            handles[name] = SharedArray(A)
+        elif isinstance(A, list) and len(A) > 0 and all([isinstance(a, N.ndarray) for a in A]):
+            block = SharedArray(N.concatenate([a.reshape((-1,)) for a in A]))
+            handles[name] = (block, [a.shape for a in A])
+    return handles
+
+
+def attachArrays(obj, handles):
+    # Set the attributes of obj to zero-copy views of the blocks of shareArrays
+    for name, handle in handles.items():
+        if isinstance(handle, SharedArray):
+            setattr(obj, name, handle.array)
+        else:
+            block, shapes = handle
+            split = N.cumsum([int(N.prod(shape)) for shape in shapes])[:-1]
+            setattr(obj, name, [v.reshape(shape) for v, shape in zip(N.split(block.array, split), shapes)])
+    return obj
+
+
+def freeShared(handles):
+    # Release the shared memory blocks in (nested) handles of shareArrays
+    if isinstance(handles, SharedArray):
+        handles.free()
+    elif isinstance(handles, dict):
+        for handle in handles.values():
+            freeShared(handle)
+    elif isinstance(handles, (list, tuple)):
+        for handle in handles:
+            freeShared(handle)
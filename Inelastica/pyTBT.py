@@ -42,6 +42,11 @@ orthogonal space that is fourier transformed.
 from __future__ import print_function
 
 import numpy as N
+import netCDF4 as NC4
+import copy
+import hashlib
+import os
+import time
 import Inelastica.io.siesta as SIO
 import Inelastica.math as MM
 import Inelastica.NEGF as NEGF
@@ -115,6 +120,40 @@ def GetOptions(argv):
                  help='Use SigNCfiles')
     p.add_argument('--NumChan', dest='numchan', type=int, default=10,
                  help='Number of eigenchannels [%(default)s]')
+    p.add_argument('--SigBatch', dest='SigBatch', type=int, default=0,
+                 help='Number of energies for which the electrode self-energies are computed together in one vectorized pass (0 = one energy at a time) [%(default)s]')
+    p.add_argument('--SigCacheMB', dest='SigCacheMB', type=float, default=256.0,
+                 help='Memory budget (MB) per electrode for reusing recently computed self-energies [%(default)s]')
+    p.add_argument('--ncpu', dest='ncpu', default=1, type=int,
+                 help='Number of worker processes sharing the (energy, k-point) evaluations [%(default)s]')
+    p.add_argument('--blas-threads', dest='blasThreads', default=1, type=int,
+                 help='Number of BLAS/OpenMP threads per worker process when --ncpu > 1 [%(default)s]')
+    p.add_argument('--checkpoint', dest='checkpoint', default=0.0, type=float,
+                 help='Interval (s) between checkpoints of the completed (spin, energy, k-point) evaluations for --resume, e.g. 600, 0 to disable [%(default)s]')
+    p.add_argument('--resume', dest='resume', default=False, action='store_true',
+                 help='Resume from the checkpoint in DestDir if it matches the inputs [%(default)s]')
+    p.add_argument('--nc', dest='nc', default=False, action='store_true',
+                 help='Write transmission, noise, PDOS and MPSH incrementally to DestDir/<label>.<Nk1>x<Nk2>.nc instead of the AVTRANS, AVNOISE, FANO, TRANS and NOISE text files (regenerate them with pyTBT-nc2text) [%(default)s]')
+    p.add_argument('--kTol', dest='kTol', default=0.0, type=float,
+                 help='k-point convergence: refine the k-mesh axes (GK order +1, LIN points x3, single-point LIN axes are kept) until the estimated relative error of the k-averaged total transmission (absolute below T=1e-3) is below this tolerance for all energies, 0 to disable [%(default)s]')
+    p.add_argument('--kMax', dest='kMax', default=100, type=int,
+                 help='Maximum number of k-points per axis for k-point convergence [%(default)s]')
+    p.add_argument('--adaptTol', dest='adaptTol', default=0.0, type=float,
+                 help='Adaptive energy grid: starting from the -N/--Emin/--Emax grid, bisect intervals where the estimated linear interpolation error of the total transmission (or of the total PDOS relative to its maximum) exceeds this tolerance, 0 to disable [%(default)s]')
+    p.add_argument('--adaptMax', dest='adaptMax', default=1000, type=int,
+                 help='Maximum number of energy points of the adaptive energy grid [%(default)s]')
+    p.add_argument('--adaptMinDE', dest='adaptMinDE', default=1e-4, type=float,
+                 help='Smallest spacing of the adaptive energy grid [%(default)s eV]')
+    p.add_argument('--kOuter', dest='kOuter', default=False, action='store_true',
+                 help='Loop over k-points outermost and energies innermost, setting up the device and electrode matrices only once per k-point [%(default)s]')
+    p.add_argument('--RGF', dest='RGF', default=False, action='store_true',
+                 help='Use the block-tridiagonal recursive Green\'s function solver instead of inverting the full device matrix [%(default)s]')
+    p.add_argument('--sparse', dest='sparse', default=False, action='store_true',
+                 help='Assemble the device and electrode H, S as sparse (CSR) matrices at each k-point, saving memory and time for large devices (best combined with --RGF) [%(default)s]')
+    p.add_argument('--HScache', dest='HScache', default=False, action='store_true',
+                 help='Keep the parsed TSHS files in sidecar caches (<file>.cache directories) for a faster startup of subsequent runs [%(default)s]')
+    p.add_argument('--lean', dest='lean', default=False, action='store_true',
+                 help='Do not keep the spectral functions AL, AR etc of the Green\'s functions once used, i.e., evaluate them on each access (less memory for large devices, more time) [%(default)s]')
 
     # Electrode stuff
     p.add_argument('--bulk', dest='UseBulk', default=-1, action='store_true',
@@ -166,146 +205,162 @@ def main(options):
     mesh = Kmesh.kmesh(Nk1, Nk2, Nk3=1, meshtype=[t1, t2, 'LIN'], invsymmetry=not options.skipsymmetry)
     mesh.mesh2file('%s/%s.%ix%i.mesh'%(options.DestDir, options.systemlabel, mesh.Nk[0], mesh.Nk[1]))
     # Setup self-energies and device GF
-    elecL = NEGF.ElectrodeSelfEnergy(options.fnL, options.NA1L, options.NA2L, options.voltage/2.)
-    elecL.scaling = options.scaleSigL
-    elecL.semiinf = options.semiinfL
-    elecR = NEGF.ElectrodeSelfEnergy(options.fnR, options.NA1R, options.NA2R, -options.voltage/2.)
-    elecR.scaling = options.scaleSigR
-    elecR.semiinf = options.semiinfR
-    DevGF = NEGF.GF(options.TSHS, elecL, elecR, Bulk=options.UseBulk,
-                    DeviceAtoms=options.DeviceAtoms,
-                    BufferAtoms=options.buffer)
+    elecL, elecR, DevGF, mesh = setupGF(options, mesh)
     nspin = DevGF.HS.nspin
 
-    # k-sample only self-energies?
-    if options.singlejunction:
-        elecL.mesh = mesh
-        mesh = Kmesh.kmesh(3, 3, 1)
-
+    ev0, es0 = None, None
     if options.dos:
-        DOSL = N.zeros((nspin, len(options.Elist), DevGF.nuo), N.float)
-        DOSR = N.zeros((nspin, len(options.Elist), DevGF.nuo), N.float)
-
         # MPSH projections?
-        MPSHL = N.zeros((nspin, len(options.Elist), DevGF.nuo), N.float)
-        MPSHR = N.zeros((nspin, len(options.Elist), DevGF.nuo), N.float)
         # evaluate eigenstates at Gamma
         import scipy.linalg as SLA
         DevGF.setkpoint(N.zeros(2))
-        ev0, es0 = SLA.eigh(DevGF.H, DevGF.S)
+        if options.sparse:
+            ev0, es0 = SLA.eigh(DevGF.H.toarray(), DevGF.S.toarray())
+        else:
+            ev0, es0 = SLA.eigh(DevGF.H, DevGF.S)
         print('MPSH eigenvalues:', ev0)
         #print 'MPSH eigenvector normalizations:',N.diag(MM.mm(MM.dagger(es0),DevGF.S,es0)).real # right
 
+    # Worker processes for the whole run (see startPool)
+    pool = None
+    if options.ncpu > 1:
+        pool = startPool(options, DevGF, mesh, es0)
+
+    adaptive = None
+    if options.kTol > 0:
+        if options.singlejunction:
+            print('pyTBT: No k-point convergence with --singlejunction, using the given k-mesh')
+        else:
+            # Compute all results on the converged k-mesh
+            mesh, adaptive = convergeKmesh(options, DevGF, mesh, nspin, es0, pool)
+            mesh.mesh2file('%s/%s.%ix%i.mesh'%(options.DestDir, options.systemlabel, mesh.Nk[0], mesh.Nk[1]))
+    if options.adaptTol > 0:
+        # Compute all results on the refined grid, options.Elist is replaced
+        adaptive = adaptEnergies(options, DevGF, mesh, nspin, es0, adaptive, pool)
+
+    if options.dos:
+        DOSL = N.zeros((nspin, len(options.Elist), DevGF.nuo), N.float)
+        DOSR = N.zeros((nspin, len(options.Elist), DevGF.nuo), N.float)
+        MPSHL = N.zeros((nspin, len(options.Elist), DevGF.nuo), N.float)
+        MPSHR = N.zeros((nspin, len(options.Elist), DevGF.nuo), N.float)
+
+    # Checkpoint of the completed (spin, energy, k-point) evaluations
+    ckptFile = '%s/%s.%ix%i.ckpt'%(options.DestDir, options.systemlabel, mesh.Nk[0], mesh.Nk[1])
+    inhash = inputHash(options, DevGF, mesh)
+    ckpt = None
+    if options.resume and adaptive is None:
+        ckpt = readCheckpoint(ckptFile, inhash)
+        if ckpt is not None and options.dos:
+            DOSL[:], DOSR[:], MPSHL[:], MPSHR[:] = ckpt['DOSL'], ckpt['DOSR'], ckpt['MPSHL'], ckpt['MPSHR']
+    lastckpt = time.time()
+
+    outFile = options.DestDir+'/%s.%ix%i'%(options.systemlabel, mesh.Nk[0], mesh.Nk[1])
+    nc = None
+    if options.nc:
+        # Spins completed before the checkpoint are kept
+        nc = NCWriter(outFile+'.nc', options, mesh, nspin, DevGF, ev0, append=ckpt is not None)
+
     # Loop over spin
     for iSpin in range(nspin):
-        # initialize transmission and shot noise arrays
-        Tkpt = N.zeros((len(options.Elist), mesh.NNk, options.numchan+1), N.float)
-        SNkpt = N.zeros((len(options.Elist), mesh.NNk, options.numchan+1), N.float)
+        if ckpt is not None and iSpin < ckpt['iSpin']:
+            print('pyTBT: Spin %i completed before checkpoint'%iSpin)
+            continue
+        # k-resolved transmission and shot noise (with --nc written as computed instead)
+        Tkpt, SNkpt = None, None
+        if not options.nc:
+            Tkpt = N.zeros((len(options.Elist), mesh.NNk, options.numchan+1), N.float)
+            SNkpt = N.zeros((len(options.Elist), mesh.NNk, options.numchan+1), N.float)
+        # Running k-averages of transmission and shot noise (see addK) and of
+        # AL.S, AR.S (projected, see projectDOS, for kOuter and adaptive) for each energy
+        avg, Aavg = {}, {}
+        # (energy, k-point) pairs in loop order, the first 'start' ones are done
+        units, start = unitList(options, mesh), 0
+        if ckpt is not None and iSpin == ckpt['iSpin']:
+            start = int(ckpt['ndone'])
+            if not options.nc:
+                Tkpt[:], SNkpt[:] = ckpt['Tkpt'], ckpt['SNkpt']
+            avg = dict((ie, (T, SN)) for ie, T, SN in zip(ckpt['avgkeys'], ckpt['Tavg'], ckpt['SNavg']))
+            Aavg = dict(zip(ckpt['Aavgkeys'], ckpt['Aavg']))
+            print('pyTBT: Resuming spin %i after %i of %i (energy, k-point) evaluations'%(iSpin, start, len(units)))
+        if adaptive is not None:
+            # Already computed
+            Tkpt, SNkpt, Aavg = adaptive[iSpin]
+            units = []
+            for ie in range(len(options.Elist)):
+                for ik in range(mesh.NNk):
+                    avg[ie] = addK(mesh, ik, Tkpt[ie, ik], SNkpt[ie, ik], avg.get(ie, None))
+                if options.nc:
+                    nc.writeK(iSpin, ie, slice(None), Tkpt[ie], SNkpt[ie])
         # prepare output files
-        outFile = options.DestDir+'/%s.%ix%i'%(options.systemlabel, mesh.Nk[0], mesh.Nk[1])
         if nspin < 2:
             thisspinlabel = outFile
         else:
             thisspinlabel = outFile+['.UP', '.DOWN'][iSpin]
-        fo = open(thisspinlabel+'.AVTRANS', 'w')
-        fo.write('# Nk1(%s)=%i Nk2(%s)=%i eta=%.2e etaLead=%.2e\n'%(mesh.type[0], mesh.Nk[0], mesh.type[1], mesh.Nk[1], options.eta, options.etaLead))
-        fo.write('# E   Ttot(E)   Ti(E)(i=1-%i)   RelErrorTtot(E)\n'%options.numchan)
-        foSN = open(thisspinlabel+'.AVNOISE', 'w')
-        foSN.write('# Nk1(%s)=%i Nk2(%s)=%i eta=%.2e etaLead=%.2e\n'%(mesh.type[0], mesh.Nk[0], mesh.type[1], mesh.Nk[1], options.eta, options.etaLead))
-        foSN.write('# E   SNtot(E)   SNi(E)(i=1-%i)\n'%options.numchan)
-        foFF = open(thisspinlabel+'.FANO', 'w')
-        foFF.write('# Nk1(%s)=%i Nk2(%s)=%i eta=%.2e etaLead=%.2e\n'%(mesh.type[0], mesh.Nk[0], mesh.type[1], mesh.Nk[1], options.eta, options.etaLead))
-        foFF.write('# E   Fano factor \n')
-        # Loop over energy
-        for ie, ee in enumerate(options.Elist):
-            Tavg = N.zeros((options.numchan+1, len(mesh.w)), N.float)
-            SNavg = N.zeros((options.numchan+1, len(mesh.w)), N.float)
-            AavL = N.zeros((DevGF.nuo, DevGF.nuo), N.complex)
-            AavR = N.zeros((DevGF.nuo, DevGF.nuo), N.complex)
-            # Loops over k-points
-            for ik in range(mesh.NNk):
-                DevGF.calcGF(ee+options.eta*1.0j, mesh.k[ik, :2], ispin=iSpin,
-                             etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff)
-                # Transmission and shot noise
-                T, SN = DevGF.calcTEIG(options.numchan)
-                for iw in range(len(mesh.w)):
-                    Tavg[:, iw] += T*mesh.w[iw, ik]
-                    SNavg[:, iw] += SN*mesh.w[iw, ik]
-                Tkpt[ie, ik] = T
-                SNkpt[ie, ik] = SN
-                # DOS calculation:
-                if options.dos:
-                    if options.SpectralCutoff > 0.0:
-                        AavL += mesh.w[0, ik]*MM.mm(DevGF.AL.L, DevGF.AL.R, DevGF.S)
-                        AavR += mesh.w[0, ik]*MM.mm(DevGF.AR.L, DevGF.AR.R, DevGF.S)
-                    else:
-                        AavL += mesh.w[0, ik]*MM.mm(DevGF.AL, DevGF.S)
-                        AavR += mesh.w[0, ik]*MM.mm(DevGF.AR, DevGF.S)
-            # Print calculated quantities
-            err = (N.abs(Tavg[0, 0]-Tavg[0, 1])+N.abs(Tavg[0, 0]-Tavg[0, 2]))/2
-            relerr = err/Tavg[0, 0]
-            print('ispin= %i, e= %.4f, Tavg= %.8f, RelErr= %.1e'%(iSpin, ee, Tavg[0, 0], relerr))
-            transline = '\n%.10f '%ee
-            noiseline = '\n%.10f '%ee
-            for ichan in range(options.numchan+1):
-                if ichan == 0:
-                    transline += '%.8e '%Tavg[ichan, 0]
-                    noiseline += '%.8e '%SNavg[ichan, 0]
-                else:
-                    transline += '%.4e '%Tavg[ichan, 0]
-                    noiseline += '%.4e '%SNavg[ichan, 0]
-            transline += '%.2e '%relerr
-            fo.write(transline)
-            foSN.write(noiseline)
-            foFF.write('\n%.10f %.8e'%(ee, SNavg[0, 0]/Tavg[0, 0]))
-            # Partial density of states:
+        if options.nc:
+            files = None
+        else:
+            files = openText(thisspinlabel, mesh.type, mesh.Nk, options.eta, options.etaLead, options.numchan)
+        if not options.kOuter and not options.nc:
+            # Energies completed before the checkpoint (--nc: already in the file)
+            for ie, ik in units[:start]:
+                if ik == mesh.NNk-1:
+                    done = None
+                    for jk in range(mesh.NNk):
+                        done = addK(mesh, jk, Tkpt[ie, jk], SNkpt[ie, jk], done)
+                    writeEnergy(options, iSpin, ie, done, files)
+        # k-outer: project the DOS for each k-point, all energies are kept until the end
+        project = options.kOuter and options.dos
+        if pool is not None and start < len(units):
+            results = runPool(pool, options, mesh, iSpin, units[start:], project)
+        else:
+            results = calcUnits(options, DevGF, mesh, iSpin, units[start:], es0 if project else None)
+        # Reduce results in loop order, i.e., k-points in ascending order for each energy
+        for iu, ((ie, ik), (T, SN, dos)) in enumerate(results, start):
+            if options.nc:
+                nc.writeK(iSpin, ie, ik, T, SN)
+            else:
+                Tkpt[ie, ik], SNkpt[ie, ik] = T, SN
+            avg[ie] = addK(mesh, ik, T, SN, avg.get(ie, None))
             if options.dos:
-                DOSL[iSpin, ie, :] += N.diag(AavL).real/(2*N.pi)
-                DOSR[iSpin, ie, :] += N.diag(AavR).real/(2*N.pi)
-                MPSHL[iSpin, ie, :] += N.diag(MM.mm(MM.dagger(es0), AavL, es0)).real/(2*N.pi)
-                MPSHR[iSpin, ie, :] += N.diag(MM.mm(MM.dagger(es0), AavR, es0)).real/(2*N.pi)
-                print('ispin= %i, e= %.4f, DOSL= %.4f, DOSR= %.4f'%(iSpin, ee, N.sum(DOSL[iSpin, ie, :]), N.sum(DOSR[iSpin, ie, :])))
-        fo.write('\n')
-        fo.close()
-        foSN.write('\n')
-        foSN.close()
-        foFF.write('\n')
-        foFF.close()
-
-        # Write k-point-resolved transmission
-        fo = open(thisspinlabel+'.TRANS', 'w')
-        for ik in range(mesh.NNk):
-            w = mesh.w[:, ik]
-            fo.write('\n\n# k = %f, %f    w = %f %f %f %f'%(mesh.k[ik, 0], mesh.k[ik, 1], w[0], w[1], w[2], w[3]))
-            for ie, ee in enumerate(options.Elist):
-                transline = '\n%.10f '%ee
-                for ichan in range(options.numchan+1):
-                    if ichan == 0:
-                        transline += '%.8e '%Tkpt[ie, ik, ichan]
-                    else:
-                        transline += '%.4e '%Tkpt[ie, ik, ichan]
-                fo.write(transline)
-        fo.write('\n')
-        fo.close()
-
-        # Write k-point-resolved shot noise
-        fo = open(thisspinlabel+'.NOISE', 'w')
-        for ik in range(mesh.NNk):
-            w = mesh.w[:, ik]
-            fo.write('\n\n# k = %f, %f    w = %f %f %f %f'%(mesh.k[ik, 0], mesh.k[ik, 1], w[0], w[1], w[2], w[3]))
+                Aavg[ie] = Aavg.get(ie, 0.0)+mesh.w[0, ik]*dos
+            if not options.kOuter and ik == mesh.NNk-1:
+                writeEnergy(options, iSpin, ie, avg.pop(ie), files, nc)
+                if options.dos:
+                    addDOS(options, iSpin, ie, projectDOS(Aavg.pop(ie), es0), DOSL, DOSR, MPSHL, MPSHR, nc)
+            if options.checkpoint > 0 and time.time()-lastckpt > options.checkpoint:
+                state = {'iSpin': iSpin, 'ndone': iu+1, 'avgkeys': sorted(avg),
+                         'Tavg': [avg[ie][0] for ie in sorted(avg)], 'SNavg': [avg[ie][1] for ie in sorted(avg)],
+                         'Aavgkeys': sorted(Aavg), 'Aavg': [Aavg[ie] for ie in sorted(Aavg)]}
+                if not options.nc:
+                    state.update({'Tkpt': Tkpt, 'SNkpt': SNkpt})
+                if options.dos:
+                    state.update({'DOSL': DOSL, 'DOSR': DOSR, 'MPSHL': MPSHL, 'MPSHR': MPSHR})
+                if nc:
+                    nc.sync()
+                writeCheckpoint(ckptFile, inhash, state)
+                lastckpt = time.time()
+        if options.kOuter or adaptive is not None:
             for ie, ee in enumerate(options.Elist):
-                noiseline = '\n%.10f '%ee
-                for ichan in range(options.numchan+1):
-                    if ichan == 0:
-                        noiseline += '%.8e '%SNkpt[ie, ik, ichan]
-                    else:
-                        noiseline += '%.4e '%SNkpt[ie, ik, ichan]
-                fo.write(noiseline)
-        fo.write('\n')
-        fo.close()
+                writeEnergy(options, iSpin, ie, avg.pop(ie), files, nc)
+                if options.dos:
+                    addDOS(options, iSpin, ie, Aavg.pop(ie), DOSL, DOSR, MPSHL, MPSHR, nc)
+        if options.nc:
+            nc.sync()
+        else:
+            closeText(files)
+            # Write k-point-resolved transmission and shot noise
+            writeTextK(thisspinlabel+'.TRANS', options.Elist, mesh.k, mesh.w, Tkpt)
+            writeTextK(thisspinlabel+'.NOISE', options.Elist, mesh.k, mesh.w, SNkpt)
 
     # End loop over spin
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if nc:
+        nc.close()
     NEGF.SavedSig.close() # Make sure saved Sigma is written to file
+    print('pyTBT: Left electrode', elecL.cache)
+    print('pyTBT: Right electrode', elecR.cache)
 
     if options.dos:
         # Read basis
@@ -324,9 +379,697 @@ def main(options):
         WriteMPSH(outFile+'.MPSHL.gz', options, DevGF, MPSHL, ev0)
         WriteMPSH(outFile+'.MPSHR.gz', options, DevGF, MPSHR, ev0)
 
+    # All output written, the checkpoint is no longer needed
+    if os.path.isfile(ckptFile):
+        os.remove(ckptFile)
     Log.PrintMainFooter(options)
 
 
+def setupGF(options, mesh):
+    """
+    Returns the electrode self-energies, device GF and the k-mesh of the device
+    (only self-energies k-sampled with options.singlejunction)
+    """
+    elecL = NEGF.ElectrodeSelfEnergy(options.fnL, options.NA1L, options.NA2L, options.voltage/2., cacheMB=options.SigCacheMB,
+                                     sparseHS=options.sparse, TSHScache=options.HScache)
+    elecL.scaling = options.scaleSigL
+    elecL.semiinf = options.semiinfL
+    elecR = NEGF.ElectrodeSelfEnergy(options.fnR, options.NA1R, options.NA2R, -options.voltage/2., cacheMB=options.SigCacheMB,
+                                     sparseHS=options.sparse, TSHScache=options.HScache)
+    elecR.scaling = options.scaleSigR
+    elecR.semiinf = options.semiinfR
+    DevGF = NEGF.GF(options.TSHS, elecL, elecR, Bulk=options.UseBulk,
+                    DeviceAtoms=options.DeviceAtoms,
+                    BufferAtoms=options.buffer, sparse=options.sparse, TSHScache=options.HScache,
+                    lean=options.lean)
+
+    # k-sample only self-energies?
+    if options.singlejunction:
+        elecL.mesh = mesh
+        mesh = Kmesh.kmesh(3, 3, 1)
+
+    # Keep the electrode H, S, H01, S01 for all k-points
+    if options.singlejunction:
+        nk = elecL.mesh.NNk
+    else:
+        nk = mesh.NNk
+    elecL.HScacheSize = nk*options.NA1L*options.NA2L
+    elecR.HScacheSize = nk*options.NA1R*options.NA2R
+    return elecL, elecR, DevGF, mesh
+
+
+def unitList(options, mesh):
+    """
+    (energy, k-point) index pairs in loop order (k-points innermost unless options.kOuter)
+    """
+    nE, nk = len(options.Elist), mesh.NNk
+    if options.kOuter:
+        return [(ie, ik) for ik in range(nk) for ie in range(nE)]
+    return [(ie, ik) for ie in range(nE) for ik in range(nk)]
+
+
+def chunkUnits(options, mesh, units, chunks):
+    """
+    Split units (see unitList) into about the given number of chunks.
+    Chunks contain all k-points of an energy (k-points outermost: a single
+    k-point) and start at multiples of options.SigBatch energies.
+    """
+    nE, nk = len(options.Elist), mesh.NNk
+    if options.kOuter:
+        nchunks = max(1, chunks//nk)
+    else:
+        nchunks = chunks
+    nb = max(1, -(-nE//nchunks))
+    if options.SigBatch > 0:
+        nb = -(-nb//options.SigBatch)*options.SigBatch
+    res, last = [], None
+    for ie, ik in units:
+        key = (ik*options.kOuter, ie//nb)
+        if key != last:
+            res.append([])
+            last = key
+        res[-1].append((ie, ik))
+    return res
+
+
+def calcUnits(options, DevGF, mesh, iSpin, units, es0=None):
+    """
+    Generator of ((ie, ik), calcEk(...)) for the (energy, k-point) index pairs in units,
+    with the DOS projected on es0 (see projectDOS) for each k-point if given
+    """
+    for ie, ik in units:
+        ee = options.Elist[ie]
+        if options.SigBatch > 0 and ie%options.SigBatch == 0 and (options.kOuter or ik == 0):
+            # Self-energies for the next block of energies in one go
+            if options.singlejunction:
+                kpts = DevGF.elecL.mesh.k
+            elif options.kOuter:
+                kpts = mesh.k[ik:ik+1]
+            else:
+                kpts = mesh.k
+            DevGF.precalcSigLR(options.Elist[ie:ie+options.SigBatch]+options.eta*1.0j, kpts, ispin=iSpin,
+                               etaLead=options.etaLead, useSigNCfiles=options.signc)
+        T, SN, dos = calcEk(options, DevGF, ee, mesh.k[ik, :2], iSpin)
+        if dos is not None and es0 is not None:
+            dos = projectDOS(dos, es0)
+        yield (ie, ik), (T, SN, dos)
+
+
+# Device GF etc of pool worker processes, see startPool
+_worker = {}
+
+
+def initWorker(options, mesh, es0):
+    try:
+        # Limit BLAS threads also if BLAS was already loaded
+        import threadpoolctl
+        threadpoolctl.threadpool_limits(options.blasThreads)
+    except ImportError:
+        pass
+    _worker['options'] = copy.copy(options)
+    _worker['elecL'], _worker['elecR'], _worker['DevGF'], _worker['mesh'] = setupGF(options, mesh)
+    _worker['NNk'] = _worker['mesh'].NNk
+    _worker['es0'] = es0
+    print('pyTBT: Worker process %i ready'%os.getpid())
+
+
+def calcChunk(args):
+    iSpin, Elist, mesh, units, project = args
+    w = _worker
+    # Energies and k-points of the current pass (see convergeKmesh, adaptEnergies)
+    w['options'].Elist = Elist
+    if not w['options'].singlejunction and mesh.NNk != w['NNk']:
+        setHScacheSize(w['options'], w['DevGF'], mesh.NNk)
+        w['NNk'] = mesh.NNk
+    return list(calcUnits(w['options'], w['DevGF'], mesh, iSpin, units, w['es0'] if project else None))
+
+
+def startPool(options, DevGF, mesh, es0=None):
+    """
+    Pool of options.ncpu worker processes for the whole run, each with its own
+    GF and electrodes (see setupGF) set up once when the process starts, the
+    MPSH states es0 (see runPool) and options.blasThreads BLAS threads.
+    Close it with pool.close(), pool.join().
+    """
+    import multiprocessing as MP
+    # Workers set up their GF from the k-mesh given to setupGF
+    if options.singlejunction:
+        fullmesh = DevGF.elecL.mesh
+    else:
+        fullmesh = mesh
+    env = {}
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        env[var] = os.environ.get(var, None)
+        os.environ[var] = '%i'%options.blasThreads
+    try:
+        # The worker processes are started here
+        pool = MP.Pool(options.ncpu, initWorker, (options, fullmesh, es0))
+    finally:
+        for var in env:
+            if env[var] is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = env[var]
+    return pool
+
+
+def runPool(pool, options, mesh, iSpin, units, project=False):
+    """
+    Generator of the results of calcUnits for the (energy, k-point) pairs in
+    units of spin iSpin (energies options.Elist, k-points mesh) computed in
+    chunks by the worker processes of pool (see startPool). The DOS is
+    projected on the MPSH states of the pool for each k-point if project.
+    Results are returned in loop order.
+    """
+    chunks = chunkUnits(options, mesh, units, 4*options.ncpu)
+    print('pyTBT: %i chunks of (energy, k-point) pairs on %i processes'%(len(chunks), options.ncpu))
+    for res in pool.imap(calcChunk, [(iSpin, options.Elist, mesh, chunk, project) for chunk in chunks]):
+        for unit in res:
+            yield unit
+
+
+def convergeKmesh(options, DevGF, mesh, nspin, es0=None, pool=None):
+    """
+    k-point convergence: each k-mesh axis with an estimated relative error
+    (see kmeshErrors) of the k-averaged total transmission above
+    options.kTol for any energy is refined, GK by raising the order by one
+    and LIN by tripling the number of points, up to options.kMax points per
+    axis. Results for k-points already computed (or their inverse -k with
+    inversion symmetry) are reused: tripled LIN meshes contain all previous
+    points, whereas Gauss-Kronrod rules of different order are not nested
+    and only share a few points (e.g. k=0). LIN axes with a single point
+    are not refined (see kmeshErrors).
+
+    Returns the final mesh and, for each spin, the arrays Tkpt, SNkpt and
+    the k-averaged DOS (see projectDOS) of the main loop for it. The
+    evaluations are done by the worker processes of pool (see startPool)
+    if given.
+    """
+    for i in range(2):
+        if mesh.type[i] == 'LIN' and mesh.Nk[i] == 1:
+            print('pyTBT: WARNING: k-point convergence does not refine the single k-point axis %i, use at least 3 points (-%s 3) to converge it'%(i+1, 'xy'[i]))
+    cache = {} # k-point -> per spin (Tk, SNk, projected dos) for all energies
+    order = [(mesh.Nk[i]-1)//2 if mesh.type[i] == 'GK' else mesh.Nk[i] for i in range(2)]
+    ipass = 0
+    while True:
+        # Evaluate new k-points
+        todo = [ik for ik in range(mesh.NNk) if kmeshLookup(cache, mesh.k[ik], mesh.invsymmetry) is None]
+        print('pyTBT: k-point convergence pass %i: Nk = %s (%s), %i new k-points'%(ipass, mesh.Nk[:2], mesh.type[:2], len(todo)))
+        if len(todo) > 0:
+            sub = copy.copy(mesh)
+            sub.k, sub.w, sub.NNk = mesh.k[todo], mesh.w[:, todo], len(todo)
+            setHScacheSize(options, DevGF, sub.NNk)
+            units = unitList(options, sub)
+            for ik in range(sub.NNk):
+                cache[kmeshKey(sub.k[ik])] = []
+            for iSpin in range(nspin):
+                Tk = N.zeros((sub.NNk, len(options.Elist), options.numchan+1), N.float)
+                SNk = N.zeros((sub.NNk, len(options.Elist), options.numchan+1), N.float)
+                dosk = [None]*sub.NNk
+                if pool is not None:
+                    results = runPool(pool, options, sub, iSpin, units, True)
+                else:
+                    results = calcUnits(options, DevGF, sub, iSpin, units, es0)
+                for (ie, ik), (T, SN, dos) in results:
+                    Tk[ik, ie], SNk[ik, ie] = T, SN
+                    if options.dos:
+                        if dosk[ik] is None:
+                            dosk[ik] = N.zeros((len(options.Elist),)+dos.shape, dos.dtype)
+                        dosk[ik][ie] = dos
+                for ik in range(sub.NNk):
+                    cache[kmeshKey(sub.k[ik])].append((Tk[ik], SNk[ik], dosk[ik]))
+        # Per axis relative errors
+        relerr = kmeshErrors(options, mesh, cache, nspin)
+        print('pyTBT: k-point convergence pass %i: max relative errors %.2e %.2e'%(ipass, relerr[0], relerr[1]))
+        refine = False
+        for i in range(2):
+            if relerr[i] > options.kTol:
+                if mesh.type[i] == 'GK' and 2*order[i]+3 <= options.kMax:
+                    order[i] += 1
+                    refine = True
+                elif mesh.type[i] == 'LIN' and 3*order[i] <= options.kMax:
+                    order[i] *= 3
+                    refine = True
+        if not refine:
+            break
+        mesh = Kmesh.kmesh(order[0], order[1], Nk3=1, meshtype=mesh.type[:2]+['LIN'], invsymmetry=mesh.invsymmetry)
+        ipass += 1
+    if max(relerr) > options.kTol:
+        print('pyTBT: WARNING: k-point convergence not reached within --kMax %i'%options.kMax)
+    print('pyTBT: Final k-mesh: Nk = %s (%s), NNk = %i'%(mesh.Nk[:2], mesh.type[:2], mesh.NNk))
+    setHScacheSize(options, DevGF, mesh.NNk)
+    adaptive = []
+    for iSpin in range(nspin):
+        res = [kmeshLookup(cache, mesh.k[ik], mesh.invsymmetry)[iSpin] for ik in range(mesh.NNk)]
+        Tkpt = N.array([r[0] for r in res]).transpose(1, 0, 2).copy()
+        SNkpt = N.array([r[1] for r in res]).transpose(1, 0, 2).copy()
+        # k-average DOS in the order of the main loop
+        Aavg = {}
+        if options.dos:
+            for ie in range(len(options.Elist)):
+                for ik in range(mesh.NNk):
+                    Aavg[ie] = Aavg.get(ie, 0.0)+mesh.w[0, ik]*res[ik][2][ie]
+        adaptive.append((Tkpt, SNkpt, Aavg))
+    return mesh, adaptive
+
+
+def kmeshKey(kpoint):
+    return tuple(N.round(kpoint[:2], 10)+0.0)
+
+
+def kmeshLookup(cache, kpoint, invsymmetry=True):
+    """
+    Results of kpoint (or of -kpoint with inversion symmetry) in cache or None
+    """
+    res = cache.get(kmeshKey(kpoint), None)
+    if res is None and invsymmetry:
+        res = cache.get(kmeshKey(-kpoint), None)
+    return res
+
+
+def kmeshErrors(options, mesh, cache, nspin):
+    """
+    Estimated relative errors of the k-averaged total transmission for the
+    two axes of mesh (max over energies and spins) from the results in cache:
+    GK axes compare with the embedded Gauss rule (weights mesh.w[1:3]), LIN
+    axes with the nested mesh with a third of the points on that axis.
+    LIN axes with a single point are not refined (error zero), other LIN
+    axes without nested mesh have infinite errors.
+    """
+    def kavg(m, w, iSpin):
+        T = N.array([kmeshLookup(cache, m.k[ik], m.invsymmetry)[iSpin][0][:, 0] for ik in range(m.NNk)])
+        return N.dot(w, T)
+    relerr = N.zeros(2)
+    for i in range(2):
+        if mesh.type[i] == 'LIN' and mesh.Nk[i] == 1:
+            continue
+        if mesh.type[i] == 'LIN' and mesh.Nk[i]%3 != 0:
+            relerr[i] = N.inf
+            continue
+        for iSpin in range(nspin):
+            T = kavg(mesh, mesh.w[0], iSpin)
+            if mesh.type[i] == 'GK':
+                Tc = kavg(mesh, mesh.w[i+1], iSpin)
+            else:
+                Nk = [(mesh.Nk[j]-1)//2 if mesh.type[j] == 'GK' else mesh.Nk[j] for j in range(2)]
+                Nk[i] = Nk[i]//3
+                coarse = Kmesh.kmesh(Nk[0], Nk[1], Nk3=1, meshtype=mesh.type[:2]+['LIN'], invsymmetry=mesh.invsymmetry)
+                Tc = kavg(coarse, coarse.w[0], iSpin)
+            relerr[i] = max(relerr[i], N.max(N.abs(T-Tc)/N.maximum(N.abs(T), 1e-3)))
+    return relerr
+
+
+def setHScacheSize(options, DevGF, nk):
+    "Keep the electrode H, S, H01, S01 for nk k-points (see setupGF)"
+    DevGF.elecL.HScacheSize = nk*options.NA1L*options.NA2L
+    DevGF.elecR.HScacheSize = nk*options.NA1R*options.NA2R
+
+
+def adaptEnergies(options, DevGF, mesh, nspin, es0=None, adaptive=None, pool=None):
+    """
+    Adaptive refinement of the energy grid options.Elist: in each pass the
+    midpoints of intervals where the estimated error (see interpError) of
+    linear interpolation of the k-averaged total transmission (or of the
+    total PDOS relative to its maximum) exceeds options.adaptTol are added,
+    largest errors first, until no interval fails, options.adaptMax points
+    are reached or intervals would become smaller than options.adaptMinDE.
+
+    options.Elist is replaced by the refined grid and, for each spin, the
+    arrays Tkpt, SNkpt and the k-averaged DOS (see projectDOS) of the main loop
+    are returned for it. The results for options.Elist may be given as
+    adaptive (see convergeKmesh). The evaluations are done by the worker
+    processes of pool (see startPool) if given.
+    """
+    Elist = options.Elist
+    res = {} # energy -> per spin (Tk, SNk, dos)
+    new, ipass = list(Elist), 0
+    if adaptive is not None:
+        # Start from the results for options.Elist
+        for iSpin, (Tkpt, SNkpt, Aavg) in enumerate(adaptive):
+            for ie, ee in enumerate(Elist):
+                res.setdefault(ee, []).append((Tkpt[ie], SNkpt[ie], Aavg.get(ie, None)))
+        new = []
+    while True:
+        if len(new) > 0:
+            print('pyTBT: Adaptive energy grid pass %i: %i new energies'%(ipass, len(new)))
+            options.Elist = N.array(new, N.float)
+            units = unitList(options, mesh)
+            for iSpin in range(nspin):
+                Tkpt = N.zeros((len(new), mesh.NNk, options.numchan+1), N.float)
+                SNkpt = N.zeros((len(new), mesh.NNk, options.numchan+1), N.float)
+                Aavg = {}
+                # k-outer: project the DOS for each k-point (see main)
+                project = options.kOuter and options.dos
+                if pool is not None:
+                    results = runPool(pool, options, mesh, iSpin, units, project)
+                else:
+                    results = calcUnits(options, DevGF, mesh, iSpin, units, es0 if project else None)
+                for (ie, ik), (T, SN, dos) in results:
+                    Tkpt[ie, ik], SNkpt[ie, ik] = T, SN
+                    if options.dos:
+                        Aavg[ie] = Aavg.get(ie, 0.0)+mesh.w[0, ik]*dos
+                for ie, ee in enumerate(new):
+                    if options.dos and not project:
+                        Aavg[ie] = projectDOS(Aavg[ie], es0)
+                    res.setdefault(ee, []).append((Tkpt[ie], SNkpt[ie], Aavg.get(ie, None)))
+        # Estimated interpolation errors on the grid so far
+        Elist = N.array(sorted(res))
+        err = N.zeros(len(Elist)-1)
+        for iSpin in range(nspin):
+            T = N.array([N.dot(mesh.w[0], res[ee][iSpin][0][:, 0]) for ee in Elist])
+            err = N.maximum(err, interpError(Elist, T))
+            if options.dos:
+                D = N.array([N.sum(res[ee][iSpin][2][:2].real)/(2*N.pi) for ee in Elist])
+                err = N.maximum(err, interpError(Elist, D)/max(N.max(N.abs(D)), 1e-10))
+        dE = Elist[1:]-Elist[:-1]
+        todo = N.argsort(-err)
+        todo = todo[(err[todo] > options.adaptTol)*(dE[todo] >= 2*options.adaptMinDE)]
+        todo = todo[:max(0, options.adaptMax-len(Elist))]
+        new = sorted((Elist[todo]+Elist[todo+1])/2)
+        ipass += 1
+        if len(new) == 0:
+            break
+    print('pyTBT: Adaptive energy grid with %i points, max estimated error %.2e'%(len(Elist), max(list(err)+[0.0])))
+    options.Elist = Elist
+    adaptive = []
+    for iSpin in range(nspin):
+        Tkpt = N.array([res[ee][iSpin][0] for ee in Elist])
+        SNkpt = N.array([res[ee][iSpin][1] for ee in Elist])
+        Aavg = {}
+        if options.dos:
+            Aavg = dict((ie, res[ee][iSpin][2]) for ie, ee in enumerate(Elist))
+        adaptive.append((Tkpt, SNkpt, Aavg))
+    return adaptive
+
+
+def interpError(E, y):
+    """
+    Estimated error of linear interpolation of y(E) at the midpoints of
+    the intervals of the (non-uniform) grid E, i.e., h**2/4 times the
+    largest second divided difference of the adjacent point triples.
+    Grids with less than three points give infinite errors.
+    """
+    if len(E) < 3:
+        return N.inf*N.ones(len(E)-1)
+    h = E[1:]-E[:-1]
+    dd2 = N.abs(N.diff(N.diff(y)/h)/(E[2:]-E[:-2]))
+    curv = N.zeros(len(h))
+    curv[:-1] = dd2
+    curv[1:] = N.maximum(curv[1:], dd2)
+    return curv*h**2/4
+
+
+def inputHash(options, DevGF, mesh):
+    """
+    Hash of the inputs determining the results stored in a checkpoint:
+    TSHS and electrode files, k-mesh, energies, eta etc
+    """
+    md5 = hashlib.md5()
+    for fn in [options.TSHS, options.fnL, options.fnR]:
+        with open(fn, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                md5.update(block)
+    data = [mesh.k, mesh.w, options.Elist, options.eta, options.etaLead, options.DeviceAtoms,
+            options.buffer, options.UseBulk, options.voltage, options.scaleSigL, options.scaleSigR,
+            options.numchan, options.dos, options.SpectralCutoff, options.kOuter, options.singlejunction]
+    if options.singlejunction:
+        data += [DevGF.elecL.mesh.k, DevGF.elecL.mesh.w]
+    md5.update(NEGF.myHash(data).encode())
+    return md5.hexdigest()
+
+
+def writeCheckpoint(fn, inhash, state):
+    """
+    Write the dictionary of arrays state to the checkpoint file fn
+    (written to a temporary file and renamed, i.e., atomically)
+    """
+    tmp = fn+'.tmp'
+    with open(tmp, 'wb') as f:
+        N.savez(f, inhash=inhash, **state)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, fn)
+    print('pyTBT: Checkpoint written (spin %i, %i evaluations)'%(state['iSpin'], state['ndone']))
+
+
+def readCheckpoint(fn, inhash):
+    """
+    Returns the state stored in checkpoint file fn if it exists and was
+    written for the same inputs (see inputHash), otherwise None
+    """
+    if not os.path.isfile(fn):
+        print('pyTBT: No checkpoint %s found, starting from scratch'%fn)
+        return None
+    ckpt = dict(N.load(fn))
+    if str(ckpt['inhash']) != inhash:
+        print('pyTBT: Checkpoint %s does not match the inputs, starting from scratch'%fn)
+        return None
+    print('pyTBT: Read checkpoint %s'%fn)
+    return ckpt
+
+
+def calcEk(options, DevGF, ee, kpoint, iSpin):
+    """
+    Transmission and shot noise for energy ee and 2d k-point (eigenchannels
+    resolved as in GF.calcTEIG) and, if options.dos, the array [AL.S, AR.S]
+    for the PDOS and MPSH projections (see projectDOS).
+    """
+    if not options.dos:
+        # Only transmission and shot noise needed
+        T, SN = DevGF.calcTransmission(ee+options.eta*1.0j, kpoint, ispin=iSpin,
+                                       etaLead=options.etaLead, useSigNCfiles=options.signc,
+                                       channels=options.numchan, RGF=options.RGF)
+        return T, SN, None
+    DevGF.calcGF(ee+options.eta*1.0j, kpoint, ispin=iSpin,
+                 etaLead=options.etaLead, useSigNCfiles=options.signc, SpectralCutoff=options.SpectralCutoff,
+                 RGF=options.RGF)
+    # Transmission and shot noise
+    T, SN = DevGF.calcTEIG(options.numchan)
+    # DOS calculation:
+    def AS(A):
+        # A.S, as L.(R.S) for A = L.R (SpectralCutoff or RGF)
+        if options.sparse and isinstance(A, MM.SpectralMatrix):
+            # R.S = (S^T.R^T)^T with a sparse S
+            return MM.mm(A.L, DevGF.S.T.dot(A.R.T).T)
+        elif options.sparse:
+            return DevGF.S.T.dot(A.T).T
+        elif isinstance(A, MM.SpectralMatrix):
+            return MM.mm(A.L, A.R, DevGF.S)
+        return MM.mm(A, DevGF.S)
+    return T, SN, N.array([AS(DevGF.AL), AS(DevGF.AR)])
+
+
+def projectDOS(Aavg, es0):
+    """
+    [diag(AL.S), diag(AR.S), diag(es0^+.AL.S.es0), diag(es0^+.AR.S.es0)]
+    from the (k-averaged) output [AL.S, AR.S] of calcEk
+    """
+    return N.array([N.diag(Aavg[0]), N.diag(Aavg[1]),
+                    N.diag(MM.mm(MM.dagger(es0), Aavg[0], es0)),
+                    N.diag(MM.mm(MM.dagger(es0), Aavg[1], es0))])
+
+
+def addK(mesh, ik, T, SN, avg=None):
+    """
+    Add the transmission and shot noise of k-point ik to the k-averages
+    avg = (Tavg, SNavg) for each set of weights mesh.w (zero if None),
+    summed in k-point order these are the averages of writeEnergy
+    """
+    if avg is None:
+        avg = (N.zeros((len(T), len(mesh.w)), N.float), N.zeros((len(SN), len(mesh.w)), N.float))
+    Tavg, SNavg = avg
+    for iw in range(len(mesh.w)):
+        Tavg[:, iw] += T*mesh.w[iw, ik]
+        SNavg[:, iw] += SN*mesh.w[iw, ik]
+    return avg
+
+
+def writeEnergy(options, iSpin, ie, avg, files=None, nc=None):
+    """
+    Write the k-averaged transmission and shot noise avg (see addK) of
+    energy point ie to the AVTRANS, AVNOISE and FANO files (see openText)
+    and/or the NCWriter nc
+    """
+    ee = options.Elist[ie]
+    Tavg, SNavg = avg
+    # Print calculated quantities
+    err = (N.abs(Tavg[0, 0]-Tavg[0, 1])+N.abs(Tavg[0, 0]-Tavg[0, 2]))/2
+    relerr = err/Tavg[0, 0]
+    print('ispin= %i, e= %.4f, Tavg= %.8f, RelErr= %.1e'%(iSpin, ee, Tavg[0, 0], relerr))
+    if files:
+        writeTextEnergy(files, ee, Tavg[:, 0], SNavg[:, 0], relerr)
+    if nc:
+        nc.writeEnergy(iSpin, ie, Tavg[:, 0], SNavg[:, 0], relerr)
+
+
+def addDOS(options, iSpin, ie, Aavg, DOSL, DOSR, MPSHL, MPSHR, nc=None):
+    """
+    Partial density of states and MPSH projections of energy point ie
+    from the k-averaged output of calcEk (see projectDOS)
+    """
+    DOSL[iSpin, ie, :] += Aavg[0].real/(2*N.pi)
+    DOSR[iSpin, ie, :] += Aavg[1].real/(2*N.pi)
+    MPSHL[iSpin, ie, :] += Aavg[2].real/(2*N.pi)
+    MPSHR[iSpin, ie, :] += Aavg[3].real/(2*N.pi)
+    print('ispin= %i, e= %.4f, DOSL= %.4f, DOSR= %.4f'%(iSpin, options.Elist[ie], N.sum(DOSL[iSpin, ie, :]), N.sum(DOSR[iSpin, ie, :])))
+    if nc:
+        nc.writeDOS(iSpin, ie, DOSL, DOSR, MPSHL, MPSHR)
+
+
+def openText(label, meshtype, Nk, eta, etaLead, numchan):
+    """
+    Open the AVTRANS, AVNOISE and FANO files and write their headers
+    """
+    header = '# Nk1(%s)=%i Nk2(%s)=%i eta=%.2e etaLead=%.2e\n'%(meshtype[0], Nk[0], meshtype[1], Nk[1], eta, etaLead)
+    fo = open(label+'.AVTRANS', 'w')
+    fo.write(header)
+    fo.write('# E   Ttot(E)   Ti(E)(i=1-%i)   RelErrorTtot(E)\n'%numchan)
+    foSN = open(label+'.AVNOISE', 'w')
+    foSN.write(header)
+    foSN.write('# E   SNtot(E)   SNi(E)(i=1-%i)\n'%numchan)
+    foFF = open(label+'.FANO', 'w')
+    foFF.write(header)
+    foFF.write('# E   Fano factor \n')
+    return fo, foSN, foFF
+
+
+def writeTextEnergy(files, ee, Tavg, SNavg, relerr):
+    """
+    Write k-averaged transmission and shot noise (total and eigenchannels)
+    of energy ee to the files returned by openText
+    """
+    fo, foSN, foFF = files
+    transline = '\n%.10f '%ee
+    noiseline = '\n%.10f '%ee
+    for ichan in range(len(Tavg)):
+        if ichan == 0:
+            transline += '%.8e '%Tavg[ichan]
+            noiseline += '%.8e '%SNavg[ichan]
+        else:
+            transline += '%.4e '%Tavg[ichan]
+            noiseline += '%.4e '%SNavg[ichan]
+    transline += '%.2e '%relerr
+    fo.write(transline)
+    foSN.write(noiseline)
+    foFF.write('\n%.10f %.8e'%(ee, SNavg[0]/Tavg[0]))
+
+
+def closeText(files):
+    for f in files:
+        f.write('\n')
+        f.close()
+
+
+def writeTextK(fn, Elist, k, w, Tkpt):
+    """
+    Write k-point-resolved transmission or shot noise Tkpt[E, k, channel]
+    """
+    fo = open(fn, 'w')
+    for ik in range(len(k)):
+        wk = w[:, ik]
+        fo.write('\n\n# k = %f, %f    w = %f %f %f %f'%(k[ik, 0], k[ik, 1], wk[0], wk[1], wk[2], wk[3]))
+        for ie, ee in enumerate(Elist):
+            line = '\n%.10f '%ee
+            for ichan in range(Tkpt.shape[2]):
+                if ichan == 0:
+                    line += '%.8e '%Tkpt[ie, ik, ichan]
+                else:
+                    line += '%.4e '%Tkpt[ie, ik, ichan]
+            fo.write(line)
+    fo.write('\n')
+    fo.close()
+
+
+class NCWriter(object):
+    """
+    Incremental netCDF4 output of pyTBT: energy slices of the k-averaged
+    and k-resolved transmission and shot noise and of the PDOS/MPSH are
+    written to chunked, compressed variables as they are completed.
+    Convert to the text files with nc2text.
+    """
+
+    def __init__(self, fn, options, mesh, nspin, DevGF, ev0=None, append=False):
+        self.fn = fn
+        if append and os.path.isfile(fn):
+            print('pyTBT: Appending to %s'%fn)
+            self.file = NC4.Dataset(fn, 'a')
+            return
+        print('pyTBT: Writing %s'%fn)
+        nc = NC4.Dataset(fn, 'w')
+        self.file = nc
+        nE, nk, nch = len(options.Elist), mesh.NNk, options.numchan+1
+        nc.createDimension('nspin', nspin)
+        nc.createDimension('nE', nE)
+        nc.createDimension('nk', nk)
+        nc.createDimension('nw', len(mesh.w))
+        nc.createDimension('nchan', nch)
+        nc.createDimension('xy', 2)
+        nc.systemlabel = options.systemlabel
+        nc.meshtype = '%s %s'%(mesh.type[0], mesh.type[1])
+        nc.Nk = N.array(mesh.Nk[:2], N.int32)
+        nc.eta = options.eta
+        nc.etaLead = options.etaLead
+        nc.Ef = DevGF.HS.ef
+        nc.createVariable('E', 'd', ('nE',))[:] = options.Elist
+        nc.createVariable('kpt', 'd', ('nk', 'xy'))[:] = mesh.k[:, :2]
+        nc.createVariable('wkpt', 'd', ('nw', 'nk'))[:] = mesh.w
+        # Energy slices as chunks
+        for var in ['T', 'SN']:
+            nc.createVariable(var, 'd', ('nspin', 'nE', 'nchan'), zlib=True, chunksizes=(1, 1, nch))
+            nc.createVariable(var+'k', 'd', ('nspin', 'nE', 'nk', 'nchan'), zlib=True, chunksizes=(1, 1, nk, nch))
+        nc.createVariable('relerr', 'd', ('nspin', 'nE'), zlib=True, chunksizes=(1, 1))
+        if options.dos:
+            nc.createDimension('nuo', DevGF.nuo)
+            nc.createVariable('ev0', 'd', ('nuo',))[:] = ev0
+            for var in ['DOSL', 'DOSR', 'MPSHL', 'MPSHR']:
+                nc.createVariable(var, 'd', ('nspin', 'nE', 'nuo'), zlib=True, chunksizes=(1, 1, DevGF.nuo))
+
+    def writeEnergy(self, iSpin, ie, Tavg, SNavg, relerr):
+        v = self.file.variables
+        v['T'][iSpin, ie], v['SN'][iSpin, ie], v['relerr'][iSpin, ie] = Tavg, SNavg, relerr
+
+    def writeK(self, iSpin, ie, ik, Tk, SNk):
+        # k-resolved results of energy point ie and k-point(s) ik
+        v = self.file.variables
+        v['Tk'][iSpin, ie, ik], v['SNk'][iSpin, ie, ik] = Tk, SNk
+
+    def writeDOS(self, iSpin, ie, DOSL, DOSR, MPSHL, MPSHR):
+        v = self.file.variables
+        v['DOSL'][iSpin, ie], v['DOSR'][iSpin, ie] = DOSL[iSpin, ie], DOSR[iSpin, ie]
+        v['MPSHL'][iSpin, ie], v['MPSHR'][iSpin, ie] = MPSHL[iSpin, ie], MPSHR[iSpin, ie]
+
+    def sync(self):
+        self.file.sync()
+
+    def close(self):
+        self.file.close()
+
+
+def nc2text(fn):
+    """
+    Write the AVTRANS, AVNOISE, FANO, TRANS and NOISE text files
+    from the netCDF4 file fn written by pyTBT with --nc
+    """
+    nc = NC4.Dataset(fn, 'r')
+    v = nc.variables
+    E, k, w = v['E'][:], v['kpt'][:], v['wkpt'][:]
+    meshtype, Nk = nc.meshtype.split(), nc.Nk
+    nspin = len(nc.dimensions['nspin'])
+    for iSpin in range(nspin):
+        label = fn[:-3] if fn.endswith('.nc') else fn
+        if nspin > 1:
+            label += ['.UP', '.DOWN'][iSpin]
+        files = openText(label, meshtype, Nk, nc.eta, nc.etaLead, len(nc.dimensions['nchan'])-1)
+        T, SN, relerr = v['T'][iSpin], v['SN'][iSpin], v['relerr'][iSpin]
+        for ie, ee in enumerate(E):
+            writeTextEnergy(files, ee, T[ie], SN[ie], relerr[ie])
+        closeText(files)
+        writeTextK(label+'.TRANS', E, k, w, v['Tk'][iSpin])
+        writeTextK(label+'.NOISE', E, k, w, v['SNk'][iSpin])
+        print('pyTBT: Wrote %s.{AVTRANS,AVNOISE,FANO,TRANS,NOISE}'%label)
+    nc.close()
+
+
 def WritePDOS(fn, options, DevGF, DOS, basis):
     """
     PDOS from the surface Green's function from electrode calculations
@@ -0,0 +1,84 @@
+from __future__ import print_function
+
+import numpy as N
+import numpy.random as RA
+import Inelastica.math as MM
+import Inelastica.io.siesta as SIO
+import Inelastica.NEGF as NEGF
+
+# Compare the vectorized NumPy fallbacks with the F90 helpers
+tol = 1e-12
+if not SIO.F90imported or not NEGF.F90_lapack_imp:
+    raise SystemExit('Compile the F90 helpers to compare with the NumPy fallbacks')
+
+RA.seed(1)
+maxerr = 0.0
+for fn in ['Self-energy-FCC111/ELEC-1x1/Au3D_BCA.TSHS', 'Self-energy-FCC100/ELEC-1x1/ABAB.TSHS']:
+    elec = NEGF.ElectrodeSelfEnergy(fn, 3, 2)
+    elec.semiinf = 2
+    HS = elec.HS
+
+    # removeUnitCellXij
+    xij = HS.xij.copy()
+    HS.removeUnitCellXij(UseF90helpers=True)
+    xijF90 = HS.xij.copy()
+    HS.xij = N.require(xij, requirements=['A', 'F'])
+    HS.removeUnitCellXij(UseF90helpers=False)
+    err = N.max(abs(HS.xij-xijF90))
+    print('removeUnitCellXij          :', err)
+    maxerr = max(maxerr, err)
+
+    # setkpointhelper
+    for ii in range(3):
+        k = RA.random(3)
+        for Sparse in [HS.Ssparse, HS.Hsparse[:, 0]]:
+            err = N.max(abs(HS.setkpointhelper(Sparse, k, UseF90helpers=True)-
+                            HS.setkpointhelper(Sparse, k, UseF90helpers=False)))
+            print('setkpointhelper            :', err)
+            maxerr = max(maxerr, err)
+
+    # expansion_SE
+    qp = RA.random(2)
+    nuo, nq = HS.nuo, elec.NA1*elec.NA2
+    g0 = N.asfortranarray(RA.random((nuo, nuo, nq))+1j*RA.random((nuo, nuo, nq)))
+    mESH = N.asfortranarray(RA.random((nuo, nuo, nq))+1j*RA.random((nuo, nuo, nq)))
+    ESH1, SGF1 = elec.expandSig(qp, g0, mESH, UseF90helpers=True)
+    ESH2, SGF2 = elec.expandSig(qp, g0, mESH, UseF90helpers=False)
+    err = max(N.max(abs(ESH1-ESH2)), N.max(abs(SGF1-SGF2)))
+    print('expansion_SE               :', err)
+    maxerr = max(maxerr, err)
+
+    # surfaceGreen
+    elec.setupHS(qp)
+    for left in [True, False]:
+        ee = RA.random()+1e-4j
+        err = N.max(abs(elec.F90calcg0(ee, left=left)-elec.calcg0_old(ee, left=left)))
+        print('surfaceGreen               :', err)
+        maxerr = max(maxerr, err)
+
+print('Maximum deviation between F90 and NumPy:', maxerr)
+if maxerr > tol:
+    raise SystemExit('ERROR: NumPy fallbacks do not agree with the F90 helpers')
+print('Tests passed for removeUnitCellXij, setkpointhelper, expansion_SE and surfaceGreen!')
+
+# trace_mm and diag_mm against the trace and diagonal of the full product,
+# for normal and spectral matrices (spectral first, in the middle and last)
+RA.seed(2)
+n = 12
+X = RA.random((4, n, n))+1j*RA.random((4, n, n))
+L = RA.random((n, 3))+1j*RA.random((n, 3))
+A = MM.mm(L, MM.dagger(L))
+SA = MM.SpectralMatrix(A, cutoff=1e-8)
+maxerr = 0.0
+for args in [[X[0]], [X[0], X[1]], [X[0], X[1], X[2]], [X[0], X[1], X[2], X[3]],
+             [SA], [SA, X[0]], [X[0], SA], [X[0], SA, X[1]], [X[0], SA, X[1], SA], [SA, X[0], X[1], X[2]]]:
+    full = MM.mm(*[a.full() if isinstance(a, MM.SpectralMatrix) else a for a in args])
+    err = max(abs(MM.trace_mm(*args)-N.trace(full))/abs(N.trace(full)),
+              N.max(abs(MM.diag_mm(*args)-N.diag(full)))/N.max(abs(N.diag(full))))
+    print('trace_mm/diag_mm (%i matrices):'%len(args), err)
+    maxerr = max(maxerr, err)
+
+print('Maximum relative deviation of trace_mm/diag_mm from the full product:', maxerr)
+if maxerr > tol:
+    raise SystemExit('ERROR: trace_mm/diag_mm do not agree with the full product')
+print('Tests passed for trace_mm and diag_mm!')
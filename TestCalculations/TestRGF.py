@@ -0,0 +1,57 @@
+from __future__ import print_function
+
+import numpy as N
+import numpy.linalg as LA
+import scipy.sparse as SS
+import Inelastica.NEGF as NEGF
+
+# Build a device of M electrode cells stacked along the transport direction
+# from the FCC111 1x1 electrode and compare the recursive Green's function
+# solver with the full inversion of the device matrix
+elec = NEGF.ElectrodeSelfEnergy('Self-energy-FCC111/ELEC-1x1/Au3D_BCA.TSHS', 1, 1)
+elec.semiinf = 2
+ee, kpoint, M = 0.3+1e-4j, N.array([0.1, 0.2]), 8
+
+elec.setupHS(kpoint)
+n = elec.HS.nuo
+H0, H01, S0, S01 = elec.H[0], elec.H01[0], elec.S, elec.S01
+eSmH = N.zeros((M*n, M*n), N.complex)
+for i in range(M):
+    eSmH[i*n:(i+1)*n, i*n:(i+1)*n] = ee*S0-H0
+    if i < M-1:
+        eSmH[i*n:(i+1)*n, (i+1)*n:(i+2)*n] = ee*S01-H01
+        eSmH[(i+1)*n:(i+2)*n, i*n:(i+1)*n] = ee*S01.T.conj()-H01.T.conj()
+# Add a scattering region in the middle
+P = N.random.RandomState(1).rand(n, n)
+eSmH[(M//2)*n:(M//2+1)*n, (M//2)*n:(M//2+1)*n] -= 0.5*(P+P.T)
+# Electrode self-energies
+eSmH[:n, :n] -= elec.getSig(ee, kpoint, left=True, Bulk=False)
+eSmH[-n:, -n:] -= elec.getSig(ee, kpoint, left=False, Bulk=False)
+
+maxerr, allsame = 0.0, True
+for scramble in [False, True]:
+    if scramble:
+        # The orbital ordering of the device need not follow the transport direction
+        perm = N.arange(M*n)
+        N.random.RandomState(2).shuffle(perm[n:-n])
+        eSmH = eSmH[perm][:, perm]
+    Gr = LA.inv(eSmH)
+    blocks = NEGF.blockPartition(eSmH, n, n)
+    # The same from a sparse matrix (as used by NEGF.GF)
+    sparse = SS.csr_matrix(eSmH)
+    blocks2 = NEGF.blockPartition(sparse, n, n)
+    same = len(blocks) == len(blocks2) and all(N.array_equal(b1, b2) for b1, b2 in zip(blocks, blocks2))
+    allsame = allsame and same
+    for A in [eSmH, sparse]:
+        GrL, GrR, GrLrow, GrDiag = NEGF.recursiveGF(A, n, n, blocks)
+        err = max(N.max(abs(GrL-Gr[:, :n])), N.max(abs(GrR-Gr[:, -n:])), N.max(abs(GrLrow-Gr[:n, :])))
+        for bl, G in zip(blocks, GrDiag):
+            err = max(err, N.max(abs(G-Gr[N.ix_(bl, bl)])))
+        print('Scrambled orbitals:', scramble, ' sparse:', SS.issparse(A), ' blocks:', len(blocks), ' same blocks from sparse:', same)
+        print('Max deviation between RGF and full inversion:', err)
+        maxerr = max(maxerr, err)
+
+print('Maximum deviation between RGF and full inversion:', maxerr)
+if maxerr > 1e-10 or not allsame:
+    raise SystemExit('ERROR: RGF does not agree with the full inversion or the blocks from dense and sparse input differ')
+print('Tests passed for blockPartition and recursiveGF!')
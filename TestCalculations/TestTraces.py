@@ -0,0 +1,85 @@
+from __future__ import print_function
+
+import numpy as N
+import numpy.linalg as LA
+import Inelastica.math as MM
+import Inelastica.iets as IETS
+
+# Compare the e-ph traces evaluated for a block of modes at once
+# (calcTracesBatch) with the traces of each mode (calcTraces), for full and
+# spectral matrices and for GFs that evaluate their quantities on each access
+
+
+class ModelGF(object):
+    "GF quantities of a random device (orthogonal basis) with nuoL/nuoR electrode orbitals"
+
+    def __init__(self, ee, nuo=24, nuoL=6, nuoR=6, SpectralCutoff=0.0, lean=False, seed=1):
+        RS = N.random.RandomState(seed)
+        H = RS.rand(nuo, nuo)-0.5
+        H = H+H.T
+        GamL, GamR = RS.rand(nuoL, nuoL), RS.rand(nuoR, nuoR)
+        self.GamL, self.GamR = MM.mm(GamL, GamL.T), MM.mm(GamR, GamR.T)
+        eSmH = ee*N.identity(nuo)-H
+        eSmH[:nuoL, :nuoL] += 0.5j*self.GamL
+        eSmH[-nuoR:, -nuoR:] += 0.5j*self.GamR
+        self.Gr = LA.inv(eSmH)
+        self.nuo, self.nuoL, self.nuoR = nuo, nuoL, nuoR
+        self.SpectralCutoff, self.lean = SpectralCutoff, lean
+        self.store = {}
+        for name in ['nHT', 'HT', 'P1T', 'P2T', 'ehDampL', 'ehDampR']:
+            setattr(self, name, N.zeros(nmodes))
+
+    def quantity(self, name):
+        if name in self.store:
+            return self.store[name]
+        Gr, nuoL, nuoR = self.Gr, self.nuoL, self.nuoR
+        if name == 'AL':
+            val = MM.mm(Gr[:, :nuoL], self.GamL, MM.dagger(Gr[:, :nuoL]))
+        elif name == 'ALT':
+            val = MM.mm(MM.dagger(Gr[:nuoL, :]), self.GamL, Gr[:nuoL, :])
+        elif name == 'AR':
+            val = MM.mm(Gr[:, -nuoR:], self.GamR, MM.dagger(Gr[:, -nuoR:]))
+        elif name == 'ARGLG':
+            AR = self.quantity('AR')
+            if isinstance(AR, MM.SpectralMatrix):
+                return MM.mm(AR.L, AR.R[:, :nuoL], self.GamL, Gr[:nuoL, :])
+            return MM.mm(AR[:, :nuoL], self.GamL, Gr[:nuoL, :])
+        if self.SpectralCutoff > 0.0:
+            val = MM.SpectralMatrix(val, cutoff=self.SpectralCutoff)
+        if not self.lean:
+            self.store[name] = val
+        return val
+
+    AL = property(lambda self: self.quantity('AL'))
+    ALT = property(lambda self: self.quantity('ALT'))
+    AR = property(lambda self: self.quantity('AR'))
+    ARGLG = property(lambda self: self.quantity('ARGLG'))
+    A = property(lambda self: self.AL+self.AR)
+
+
+class Options(object):
+    LOEscale = 1.0
+
+nmodes = 5
+RS = N.random.RandomState(2)
+Ms = RS.rand(nmodes, 24, 24)-0.5
+Ms = Ms+Ms.transpose(0, 2, 1)
+ihws = N.arange(nmodes)
+
+maxerr = 0.0
+for cutoff in [0.0, 1e-8]:
+    for lean in [False, True]:
+        GF1 = ModelGF(0.1+1e-6j, SpectralCutoff=cutoff, lean=lean)
+        GF2 = ModelGF(-0.1+1e-6j, SpectralCutoff=cutoff, lean=lean)
+        IETS.calcTracesBatch(Options, GF1, GF2, Ms, ihws)
+        batch = [getattr(GF1, name).copy() for name in ['nHT', 'HT', 'P1T', 'P2T', 'ehDampL', 'ehDampR']]
+        for ihw in ihws:
+            IETS.calcTraces(Options, GF1, GF2, None, None, ihw, Ms[ihw])
+        single = [getattr(GF1, name) for name in ['nHT', 'HT', 'P1T', 'P2T', 'ehDampL', 'ehDampR']]
+        err = max([N.max(abs(b-s))/max(N.max(abs(s)), 1e-12) for b, s in zip(batch, single)])
+        print('SpectralCutoff= %.0e, lean= %-5s: max relative deviation %.2e'%(cutoff, lean, err))
+        maxerr = max(maxerr, err)
+
+print('Maximum relative deviation between batched and per-mode traces:', maxerr)
+if maxerr > 1e-10:
+    raise SystemExit('ERROR: calcTracesBatch does not agree with calcTraces')
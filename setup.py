@@ -204,6 +204,8 @@ setup(name='Inelastica',
                'Inelastica/scripts/kaverage-IETS',
                'Inelastica/scripts/average-gridfunc',
                'Inelastica/scripts/WriteWavefunctions',
+               'Inelastica/scripts/compact-SigStore',
+               'Inelastica/scripts/pyTBT-nc2text',
                'Inelastica/utils/agr2pdf',
                'Inelastica/utils/bands2xmgr',
                'Inelastica/utils/siesta_cleanup'],